@@ -7,6 +7,7 @@ from wikisearch import process_dump
 from wikisearch import test_keyword_search
 from wikisearch import test_semantic_search
 from wikisearch import make_sample
+from wikisearch import config
 
 from wikisearch.classes.xml_reader import XMLReader
 from wikisearch.classes.cirrussearch_reader import CirrusSearchReader
@@ -41,12 +42,28 @@ if __name__ == '__main__':
     # into OpenSearch
     elif args.task == 'process_cs_dump':
 
+        # In raw mode, the reader sends batches of undecoded lines
+        # and the parse workers do the decoding
+        if args.reader_mode == 'raw':
+            reader_instance=CirrusSearchReader(args.parse_workers, config.CS_NAMESPACE, config.CS_READER_BATCH_SIZE)
+            parser_function=parse_funcs.parse_cirrussearch_batch
+
+        # In passthrough mode, the parse workers turn the batches into
+        # bulk request bytes which go to OpenSearch as they are
+        elif args.reader_mode == 'passthrough':
+            reader_instance=CirrusSearchReader(args.parse_workers, config.CS_NAMESPACE, config.CS_READER_BATCH_SIZE)
+            parser_function=parse_funcs.passthrough_cirrussearch_batch
+
+        else:
+            reader_instance=CirrusSearchReader(args.parse_workers, config.CS_NAMESPACE)
+            parser_function=parse_funcs.parse_cirrussearch_article
+
         # Start the run
         process_dump.run(
             input_stream=GzipFile(args.dump),
             stream_reader=stream_readers.json_lines,
-            reader_instance=CirrusSearchReader(args.parse_workers),
-            parser_function=parse_funcs.parse_cirrussearch_article,
+            reader_instance=reader_instance,
+            parser_function=parser_function,
             args=args
         )
 
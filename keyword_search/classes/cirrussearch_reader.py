@@ -1,11 +1,15 @@
-'''Reader class for CirrusSearch JSON lines data.'''
+'''Reader class for CirrusSearch JSON lines data. In decoded mode, lines are
+decoded by the reader and articles are sent to the parsers one at a time. In raw
+mode, the raw line bytes are sent in batches and the parsers do all of the
+decoding, so reading is no longer limited by the single reader thread.'''
 
 import json
+from wikisearch.functions.record_decoder import decode_cirrus_record
 
 class CirrusSearchReader():
     '''Class to XML objects from CirrusSearch dump.'''
 
-    def __init__(self, parse_workers: int):
+    def __init__(self, parse_workers: int, namespace: int = None, batch_size: int = None):
 
         # Add empty callback function
         self.callback=self._callback_placeholder
@@ -21,6 +25,18 @@ class CirrusSearchReader():
         # done signal when we are finished
         self.parse_workers=parse_workers
 
+        # Only pass on records from this namespace, or all of them if None
+        self.namespace=namespace
+
+        # Number of header and content line pairs to send to the parsers
+        # at a time undecoded, or None to decode them here
+        self.batch_size=batch_size
+
+        # Raw mode header waiting for its content line and
+        # the batch of line pairs waiting to be sent
+        self.header=None
+        self.batch=[]
+
     def _callback_placeholder(self, _):
         '''Placeholder for callback functions. Exists to allow 
         instantiation of the reader before we know what callback
@@ -31,6 +47,11 @@ class CirrusSearchReader():
         '''Accumulates lines from JSON lines data until buffer
         is full, then flushed buffer to parser input queue.'''
 
+        # Leave the decoding to the parsers in raw mode
+        if self.batch_size is not None:
+            self.read_raw_line(line)
+            return
+
         # Check for done signal from stream reader, when
         # we find it, put done in the buffer and flush
         if line == 'done':
@@ -44,8 +65,18 @@ class CirrusSearchReader():
         # If it's not the done signal, process it
         else:
 
-            # Convert line to dictionary
-            line=json.loads(line)
+            # Headers are small and get rewritten for OpenSearch, so convert them
+            # to dictionaries. For content, only decode the fields we index
+            if len(self.buffer) == 0:
+                line=json.loads(line)
+
+            else:
+                line=decode_cirrus_record(line, self.namespace)
+
+                # Drop the record and its header if it was filtered out
+                if line is None:
+                    self.buffer=[]
+                    return
 
             # Add it to the buffer
             self.buffer.append(line)
@@ -70,4 +101,45 @@ class CirrusSearchReader():
 
         # Clear the buffer
         self.buffer = []
-        
\ No newline at end of file
+        
+    def read_raw_line(self, line):
+        '''Pairs up header and content lines without decoding them, sends
+        them to the parser input queue a batch at a time.'''
+
+        # Check for done signal from stream reader, when we find it, send
+        # what is left of the batch, then the done signal to each parser
+        if line == 'done':
+
+            self.flush_batch()
+            self.status_count[0]='done'
+
+            for _ in range(self.parse_workers):
+                self.callback([None, ['done', self.status_count[1]]])
+
+            return
+
+        # Hold on to the header until we have its content line
+        if self.header is None:
+            self.header=line
+            return
+
+        self.batch.append((self.header, line))
+        self.header=None
+
+        if len(self.batch) == self.batch_size:
+            self.flush_batch()
+
+    def flush_batch(self):
+        '''Sends the batch of line pairs, along with the article number
+        of the first one, to the parser input queue.'''
+
+        if len(self.batch) == 0:
+            return
+
+        self.callback([self.batch, ['running', self.status_count[1]]])
+
+        # Update article count
+        self.status_count[1] += len(self.batch)
+
+        # Start a new batch
+        self.batch=[]
@@ -20,15 +20,37 @@ NLP_INGEST_PIPELINE_DESCRIPTION='An NLP ingest pipeline'
 XML_PARSE_WORKERS=1
 CS_PARSE_WORKERS=1
 
+# Only index CirrusSearch records from this namespace, e.g. 0 for articles.
+# None indexes every record in the dump
+CS_NAMESPACE=None
+
+# How the CirrusSearch reader sends records to the parse workers, 'raw' sends
+# undecoded lines in batches of CS_READER_BATCH_SIZE articles and leaves all of
+# the decoding to the parse workers, 'decoded' decodes them in the reader and
+# 'passthrough' sends the dump lines to OpenSearch's bulk API as raw bytes
+CS_READER_MODE='raw'
+CS_READER_BATCH_SIZE=100
+
+# Fields of each record to send in passthrough mode, None sends whole records
+# as they are in the dump, without decoding anything. Naming fields decodes and
+# re-encodes every record in the parse workers, about the cost of the decoded
+# reader mode, in exchange for smaller bulk requests
+CS_PASSTHROUGH_FIELDS=None
+
+# Strip XML dump wikicode with the fast regex based stripper where it is safe to, pages
+# it can't handle still go to mwparserfromhell. False uses mwparserfromhell for everything
+XML_FAST_WIKITEXT_STRIP=True
+
 # Default number of workers to start for outputting parsed
 # documents to file or OpenSearch index can be overridden
 # via command line argument
 XML_OUTPUT_WORKERS=4
 CS_OUTPUT_WORKERS=4
 
-# Default number of documents to index via bulk call to OpenSearch
-# can be overridden via command line argument
-BULK_BATCH_SIZE=5
+# Default size in bytes of each bulk call to OpenSearch, documents are
+# added until the next one would go over, can be overridden via command
+# line argument
+BULK_BYTE_BUDGET=5 * 1024 * 1024
 
 # Default dump data files can be overridden via command line argument
 XML_INPUT_FILE='wikisearch/data/enwiki-20240320-pages-articles-multistream.xml.bz2'
@@ -67,12 +67,12 @@ def parse_arguments() -> argparse.Namespace:
         metavar=''
     )
 
-    # Add argument to specify bulk upsert batch size
+    # Add argument to specify bulk upsert request size
     parser.add_argument(
-        '--upsert_batch',
+        '--upsert_bytes',
         required=False,
-        default=config.BULK_BATCH_SIZE,
-        help='number of documents per bulk upsert batch',
+        default=config.BULK_BYTE_BUDGET,
+        help='maximum size in bytes of each bulk upsert request',
         metavar=''
     )
 
@@ -86,6 +86,16 @@ def parse_arguments() -> argparse.Namespace:
         metavar=''
     )
 
+    # Add argument for CirrusSearch reader mode
+    parser.add_argument(
+        '--reader_mode',
+        required=False,
+        choices=['raw', 'decoded', 'passthrough'],
+        default=config.CS_READER_MODE,
+        help='where CirrusSearch lines get decoded, in parse workers, the reader or not at all: [raw, decoded, passthrough]',
+        metavar=''
+    )
+
     # Add argument for status monitor output
     parser.add_argument(
         '--status_monitor',
@@ -128,6 +138,10 @@ def parse_arguments() -> argparse.Namespace:
         if args.output_workers is None:
             args.output_workers=config.CS_OUTPUT_WORKERS
 
+        # Passthrough mode only produces bulk request bytes
+        if args.reader_mode == 'passthrough' and args.output != 'opensearch':
+            parser.error('--reader_mode passthrough requires --output opensearch')
+
     # Task dependent defaults for search testing
     if args.task == 'search_test':
         if args.index is None:
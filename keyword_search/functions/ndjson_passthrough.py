@@ -0,0 +1,52 @@
+'''Functions to build OpenSearch bulk API request bytes in the parse workers, so
+the output workers only have to join them up and send them. CirrusSearch JSON
+lines are passed through with as little decoding as possible, the dump is already
+in bulk format, so header lines are rewritten at the byte level and content lines
+are sent as they are by default. Cutting them down to the fields we index means
+decoding and re-encoding every record, which costs about as much as the decoded
+reader mode, so it only pays when the smaller requests matter more than the parse
+workers' time.'''
+
+from __future__ import annotations
+import json
+import re
+from semantic_search.functions.selective_json import loads, dumps
+
+# Pulls the action out of a dump header line, e.g. b'{"index":{"_type":"_doc","_id":"12"}}'
+HEADER_ACTION=re.compile(rb'^\s*\{\s*"(\w+)"')
+
+
+def serialize_bulk_pair(header: dict, content: dict) -> bytes:
+    '''Takes bulk request header and content dictionaries, returns
+    them as a bulk request fragment, i.e. two lines of JSON.'''
+
+    return dumps(header) + b'\n' + dumps(content) + b'\n'
+
+
+def rewrite_header(header: bytes, index_name: str, id_num: int) -> bytes:
+    '''Takes CirrusSearch header line, returns bulk header line for the target
+    index without the unsupported _type and with the id replaced by a sequential
+    number, like update_cs_index does for decoded headers. The dump headers only
+    carry the action, _type and _id, so the new header is built from the action.'''
+
+    action=HEADER_ACTION.match(header)
+    action=action.group(1) if action is not None else b'index'
+
+    return b'{"%s":{"_index":%s,"_id":%d}}\n' % (action, json.dumps(index_name).encode('utf-8'), id_num)
+
+
+def project_content(content: bytes, fields: tuple = None) -> bytes:
+    '''Takes CirrusSearch content line, returns it as it is if fields is None, otherwise
+    decodes it and returns it re-encoded with just the given top level fields. Returns
+    None if a field is missing.'''
+
+    if fields is None:
+        return content.rstrip(b'\n') + b'\n'
+
+    record=loads(content)
+
+    try:
+        return dumps({field: record[field] for field in fields}) + b'\n'
+
+    except KeyError:
+        return None
@@ -1,6 +1,7 @@
 '''Functions for handling output of data to files or indexing into OpenSearch'''
 
 from __future__ import annotations
+import json
 import time
 from opensearchpy import exceptions
 from wikisearch import config
@@ -29,8 +30,7 @@ def output_selector(
         _=write_file(
             output_queue=output_queue,
             article_source=article_source,
-            parse_workers=args.parse_workers,
-            resume=args.resume
+            parse_workers=args.parse_workers
         )
     
     # Send the output to the OpenSearch bulk indexer
@@ -38,9 +38,8 @@ def output_selector(
 
         _=bulk_index_articles(
             output_queue=output_queue,
-            batch_size=args.upsert_batch,
-            parse_workers=args.parse_workers,
-            resume=args.resume
+            byte_budget=args.upsert_bytes,
+            parse_workers=args.parse_workers
         )
 
 def write_file(
@@ -49,7 +48,8 @@ def write_file(
     parse_workers: int
 ) -> None:
 
-    '''Takes documents from parser's output queue, writes to file.'''
+    '''Takes bulk request fragments from parser's output queue,
+    writes the articles in them to file.'''
 
     # Construct output path
     output_path=f'wikisearch/data/articles/{article_source}'
@@ -60,7 +60,7 @@ def write_file(
     # Loop forever
     while True:
 
-        # Get article from queue
+        # Get bulk request fragment from queue
         output=output_queue.get()
 
         # Check for done signal from parser and count it.
@@ -74,36 +74,39 @@ def write_file(
         # If the queue item is not a done signal, process it
         else:
 
-            # Extract title and text
-            title=output[1]['doc']['title']
-            content=output[1]['doc']['text']
+            # Every other line of the fragment is article content
+            for line in output[0].split(b'\n')[1::2]:
 
-            # Format page title for use as a filename
-            file_name=title.replace(' ', '_')
-            file_name=file_name.replace('/', '-')
+                # Extract title and text
+                doc=json.loads(line)['doc']
+                title=doc['title']
+                content=doc['text']
 
-            # Construct output path
-            output = f'{output_path}/{file_name}'
+                # Format page title for use as a filename
+                file_name=title.replace(' ', '_')
+                file_name=file_name.replace('/', '-')
 
-            # Save article to a file
-            with open(output, 'w', encoding='utf-8') as text_file:
-                text_file.write(f'{title}\n{content}')
+                # Save article to a file
+                with open(f'{output_path}/{file_name}', 'w', encoding='utf-8') as text_file:
+                    text_file.write(f'{title}\n{content}')
 
 
 def bulk_index_articles(
     output_queue: multiprocessing.Queue, # type: ignore
-    batch_size: int,
+    byte_budget: int,
     parse_workers: int
 ) -> None:
     
-    '''Batch index documents and insert in to OpenSearch from 
-    parser output queue'''
+    '''Joins up bulk request fragments from the parser output queue until
+    the next one would take the request over the byte budget, then sends
+    the request to OpenSearch as it is. Parse workers do the serializing.'''
 
-    # Start the OpenSearch client and create the index
+    # Start the OpenSearch client
     client=helper_funcs.start_client()
 
-    # List to collect articles from queue until we have enough for a batch
-    incoming_articles = []
+    # Bulk request fragments collected so far and their size in bytes
+    incoming_fragments=[]
+    incoming_bytes=0
 
     # Counter to track how many done signals we have received
     done_count=0
@@ -111,39 +114,53 @@ def bulk_index_articles(
     # Loop forever
     while True:
 
-        # Get article from queue
+        # Get bulk request fragment and its size from queue
         output=output_queue.get()
 
         # Check for done signal from parser and count it.
         if output[0] == 'done':
             done_count+=1
 
-            # If we have seen a done signal from each parse worker, return
+            # If we have seen a done signal from each parse
+            # worker, send what is left and return
             if done_count == parse_workers:
+
+                if incoming_bytes > 0:
+                    send_bulk_request(client, incoming_fragments)
+
                 return
 
-        # If the queue item is not a done signal add it to batch
+        # If the queue item is not a done signal add it to the request
         else:
 
-            # Add it to batch
-            incoming_articles.extend(output)
+            fragment, fragment_bytes=output
+
+            # If this fragment would take the request over budget, send what
+            # we have first, a single fragment over budget gets sent on its own
+            if incoming_bytes > 0 and incoming_bytes + fragment_bytes > int(byte_budget):
+
+                send_bulk_request(client, incoming_fragments)
 
-            # Once we have a full batch, send it to the opensearch bulk insert function
-            # the divide by 2 is necessary because each article is represented by two
-            # elements, the header and the content
-            if len(incoming_articles) // 2 >= int(batch_size):
+                # Empty the list to collect the next request
+                incoming_fragments=[]
+                incoming_bytes=0
 
-                # Once we have all of the articles formatted and collected, insert them
-                # catching any connection timeout errors from OpenSearch
-                try:
+            incoming_fragments.append(fragment)
+            incoming_bytes+=fragment_bytes
 
-                    # Do the insert
-                    _=client.bulk(incoming_articles)
 
-                    # Empty the list of articles to collect the next batch
-                    incoming_articles = []
+def send_bulk_request(client, fragments: list) -> None:
+    '''Joins bulk request fragments and posts them to OpenSearch,
+    retrying after connection timeout or transport errors.'''
+
+    body=b''.join(fragments)
+
+    while True:
+
+        try:
+            _=client.bulk(body=body)
+            return
 
-                # If we catch an connection timeout or transport error, sleep for a bit and
-                # don't clear the cached articles before continuing the loop
-                except (exceptions.ConnectionTimeout, exceptions.TransportError):
-                    time.sleep(10)
\ No newline at end of file
+        # If we catch an connection timeout or transport error, sleep for a bit and try again
+        except (exceptions.ConnectionTimeout, exceptions.TransportError):
+            time.sleep(10)
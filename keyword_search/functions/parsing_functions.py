@@ -1,7 +1,11 @@
 '''Functions to parse data read from dumps and related helper functions'''
 
+import json
 import multiprocessing
-import mwparserfromhell # type: ignore
+from wikisearch import config
+from wikisearch.functions.record_decoder import decode_cirrus_record, in_namespace
+import wikisearch.functions.ndjson_passthrough as passthrough_funcs
+from wikisearch.functions.wikitext import strip_wikicode
 
 def parse_cirrussearch_article(
     input_queue: multiprocessing.Queue,
@@ -32,19 +36,127 @@ def parse_cirrussearch_article(
         # process it
         else:
 
-            # Make some updates to the header to make it compatible with OpenSearch
-            header=update_cs_index(header, index_name, article_num)
+            # Format the header and content for upserting and put the
+            # bulk request fragment into the output queue
+            output_queue.put(format_cirrussearch_article(header, content, index_name, article_num))
 
-            # Alter the content format for upserting
-            #'title', 'text'
-            upsert_content={}
-            upsert_content['doc']={}
-            upsert_content['doc']['title']=content['title']
-            upsert_content['doc']['text']=content['text']
-            #upsert_content['doc_as_upsert']='true'
+def parse_cirrussearch_batch(
+    input_queue: multiprocessing.Queue,
+    output_queue: multiprocessing.Queue,
+    index_name: str,
+    output_workers: int
+) -> None:
+
+    '''Parses batches of raw JSON lines data read from a CirrusSearch
+    dump by the reader in raw mode. Does all of the decoding here.'''
+
+    while True:
+
+        # Get the batch of header and content lines from the article queue
+        batch, status_count=input_queue.get()
+        article_num=status_count[1]
+        status=status_count[0]
+
+        # Check for the done signal from the reader, when we find it,
+        # pass it on to the output workers and return
+        if status == 'done':
+
+            for _ in range(output_workers):
+                output_queue.put(('done', 'done'))
+
+            return
+
+        for line_num, (header, content) in enumerate(batch):
+
+            # Only decode the fields we index, skip records which were filtered out
+            content=decode_cirrus_record(content, config.CS_NAMESPACE)
+
+            if content is None:
+                continue
+
+            # Number articles by their position in the dump
+            output_queue.put(format_cirrussearch_article(
+                json.loads(header),
+                content,
+                index_name,
+                article_num + line_num
+            ))
+
+def passthrough_cirrussearch_batch(
+    input_queue: multiprocessing.Queue,
+    output_queue: multiprocessing.Queue,
+    index_name: str,
+    output_workers: int
+) -> None:
 
-            # Put the result into the output queue
-            output_queue.put((header, upsert_content))
+    '''Turns batches of raw JSON lines data read from a CirrusSearch dump
+    by the reader in raw mode into bulk request bytes, without decoding
+    the headers and only decoding content to cut it down to the fields
+    we index, if asked to.'''
+
+    while True:
+
+        # Get the batch of header and content lines from the article queue
+        batch, status_count=input_queue.get()
+        article_num=status_count[1]
+        status=status_count[0]
+
+        # Check for the done signal from the reader, when we find it,
+        # pass it on to the output workers and return
+        if status == 'done':
+
+            for _ in range(output_workers):
+                output_queue.put(('done', 'done'))
+
+            return
+
+        # Collect the bulk lines for the whole batch
+        lines=[]
+
+        for line_num, (header, content) in enumerate(batch):
+
+            # Skip records from other namespaces without decoding them
+            if config.CS_NAMESPACE is not None and not in_namespace(content, config.CS_NAMESPACE):
+                continue
+
+            content=passthrough_funcs.project_content(content, config.CS_PASSTHROUGH_FIELDS)
+
+            if content is None:
+                continue
+
+            # Number articles by their position in the dump
+            lines.append(passthrough_funcs.rewrite_header(header, index_name, article_num + line_num))
+            lines.append(content)
+
+        # Put the bulk request bytes and their size into the output queue
+        if len(lines) > 0:
+            fragment=b''.join(lines)
+            output_queue.put((fragment, len(fragment)))
+
+def format_cirrussearch_article(
+    header: dict,
+    content: tuple,
+    index_name: str,
+    article_num: int
+) -> tuple:
+
+    '''Takes decoded CirrusSearch header and content record, returns bulk
+    request fragment for upserting to OpenSearch and its size in bytes.'''
+
+    # Make some updates to the header to make it compatible with OpenSearch
+    header=update_cs_index(header, index_name, article_num)
+
+    # Alter the content format for upserting
+    #'title', 'text'
+    upsert_content={}
+    upsert_content['doc']={}
+    upsert_content['doc']['title']=content.title
+    upsert_content['doc']['text']=content.text
+    #upsert_content['doc_as_upsert']='true'
+
+    fragment=passthrough_funcs.serialize_bulk_pair(header, upsert_content)
+
+    return fragment, len(fragment)
 
 def update_cs_index(
     line: dict,
@@ -98,15 +210,9 @@ def parse_xml_article(
         # process it
         else:
 
-            # Convert source string to wikicode
-            wikicode=mwparserfromhell.parse(source)
-
-            # Strip garbage out of wikicode source
-            source_string=wikicode.strip_code(
-                normalize=True,
-                collapse=True,
-                keep_template_params=False
-            )
+            # Strip garbage out of wikicode source, with the fast path
+            # where we can and mwparserfromhell where we can't
+            source_string=strip_wikicode(source)
 
             # Remove extra sections from the end of the document
             source_string=remove_extra_sections(source_string)
@@ -137,8 +243,10 @@ def parse_xml_article(
                 'doc_as_upsert': 'true'
             }
 
-            # Put the result into the output queue
-            output_queue.put((request_header, formatted_article))
+            # Serialize them here, so the output workers only have to join
+            # fragments up, and put the result into the output queue
+            fragment=passthrough_funcs.serialize_bulk_pair(request_header, formatted_article)
+            output_queue.put((fragment, len(fragment)))
 
 
 def fix_bad_symbols(source_string: str) -> str:
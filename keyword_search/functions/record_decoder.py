@@ -0,0 +1,40 @@
+'''Record decoding for CirrusSearch JSON lines. Lines can be pre-filtered by namespace
+at the byte level, and only the fields we index are kept, in a compact typed record
+which is much cheaper to send through the parser queues. The decoder, encoder and
+prefilter are shared with the semantic search pipeline's selective_json module.
+
+Records are not decoded field by field: each line is decoded whole, with orjson if
+it is installed, otherwise with the standard library, and then cut down to the
+fields we index. Walking the raw line in Python to decode just those fields turned
+out slower than either C decoder on whole records.'''
+
+from __future__ import annotations
+from typing import NamedTuple
+from semantic_search.functions.selective_json import decode_fields, in_namespace
+
+class CirrusRecord(NamedTuple):
+    '''The fields of a CirrusSearch record we index.'''
+
+    title: str
+    text: str
+
+
+def decode_cirrus_record(line: bytes, namespace: int = None) -> CirrusRecord:
+    '''Takes CirrusSearch content line, returns CirrusRecord or None if the record
+    is missing a field or, when a namespace is given, is in a different namespace.'''
+
+    # Cheap byte level check before we decode anything, lines
+    # which pass still get their namespace checked once decoded
+    if namespace is not None and in_namespace(line, namespace) is False:
+        return None
+
+    record=decode_fields(line, ('namespace', 'title', 'text'))
+
+    if namespace is not None and record.get('namespace') != namespace:
+        return None
+
+    try:
+        return CirrusRecord(record['title'], record['text'])
+
+    except KeyError:
+        return None
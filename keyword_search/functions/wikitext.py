@@ -0,0 +1,21 @@
+'''Wikicode stripping for XML dump pages. Uses the semantic search pipeline's fast
+regex based stripper, in strict mode, so pages it can't handle safely still go to
+mwparserfromhell. There is one implementation of the stripper, in semantic_search's
+wikitext module, so the two pipelines can't drift apart.'''
+
+from __future__ import annotations
+from semantic_search.functions.wikitext import fast_strip, mwparserfromhell_strip
+from wikisearch import config
+
+def strip_wikicode(source: str) -> str:
+    '''Takes wikicode source string, returns it stripped to plain text. Uses the fast
+    path if it's enabled and the page is safe for it, otherwise mwparserfromhell.'''
+
+    if config.XML_FAST_WIKITEXT_STRIP is True:
+
+        stripped=fast_strip(source)
+
+        if stripped is not None:
+            return stripped
+
+    return mwparserfromhell_strip(source)
@@ -24,9 +24,10 @@ def run(
     # Start multiprocessing manager
     manager=Manager()
 
-    # Set-up queues
+    # Set-up queues, if the reader sends batches of articles, hold
+    # about the same number of articles in the input queue
     output_queue=manager.Queue(maxsize=2000)
-    input_queue=manager.Queue(maxsize=2000)
+    input_queue=manager.Queue(maxsize=max(2000 // (getattr(reader_instance, 'batch_size', None) or 1), 2))
 
     # Add the input queue's put function to the reader class's callback method
     reader_instance.callback=input_queue.put
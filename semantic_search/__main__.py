@@ -12,12 +12,24 @@ import semantic_search.configuration as config
 import semantic_search.classes.luigi_tasks as tasks
 import semantic_search.functions.luigi_helper as helper
 import semantic_search.functions.argument_parser as arg_parser
+import semantic_search.functions.search as search_funcs
+import semantic_search.functions.tuning as tuning
 
 if __name__ == '__main__':
 
     # Parse command line arguments
     args=arg_parser.parse_arguments()
 
+    # Run a query against an existing index instead of the pipeline, if asked
+    if args.task == 'search':
+        search_funcs.print_results(search_funcs.run(args.data_source, args.query))
+        raise SystemExit
+
+    # Or tune the embedding workers and write the recommended configuration
+    if args.task == 'tune':
+        print(json.dumps(tuning.run(args.data_source), indent=4))
+        raise SystemExit
+
     # Load the data source configuration
     source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{args.data_source}.json'
 
@@ -31,16 +43,36 @@ if __name__ == '__main__':
     # Require restart of pipeline from intermediate job, if asked
     helper.force_from(source_config['target_index_name'], args.force_from)
 
-    luigi.build(
-        [
-            # Extract and batch text from raw data
-            tasks.ExtractData(data_source=args.data_source),
-            # Clean and semantically split extracted text
-            tasks.ParseData(data_source=args.data_source),
-            # Calculates embedding vectors for cleaned and chunked text
-            tasks.EmbedData(data_source=args.data_source),
-            # Load data into OpenSearch KNN vector database
-            tasks.LoadData(data_source=args.data_source)
-        ],
-        local_scheduler=True
-    )
+    # Run the stages concurrently as a single streaming task
+    if args.mode == 'streaming':
+
+        luigi.build(
+            [
+                # Extract, parse, embed and load as one bounded pipeline
+                tasks.StreamData(
+                    data_source=args.data_source,
+                    checkpoints=args.checkpoints == 'True'
+                )
+            ],
+            local_scheduler=True
+        )
+
+    # Or run each stage to completion, shard by shard. Luigi workers run
+    # different stages on different shards at the same time, as far as the
+    # per-stage resource limits allow
+    else:
+
+        luigi_config=luigi.configuration.get_config()
+
+        for resource, limit in config.LUIGI_RESOURCES.items():
+            luigi_config.set('resources', resource, str(limit))
+
+        luigi.build(
+            [
+                # Extract and batch text from raw data, then parse, deduplicate,
+                # embed and load each shard and merge the shard summaries
+                tasks.MergeShards(data_source=args.data_source)
+            ],
+            workers=config.LUIGI_WORKERS,
+            local_scheduler=True
+        )
@@ -0,0 +1,118 @@
+'''Benchmarks the extracted text file formats. Extracts records from the head of the
+dump, writes them as hdf5 and as Arrow, then sends the parse tasks for each file to a
+pool of workers which only read their texts. Reports write time, file size, time to
+hand every task to the workers and read it, and the bytes pickled to the workers.
+
+Run from the project root:
+
+    python -m semantic_search.benchmarks.intermediate_format --data_source wikipedia-sample --records 20000
+'''
+
+# Standard imports
+import time
+import json
+import pickle
+import pathlib
+import argparse
+import tempfile
+import multiprocessing as mp
+
+# Internal imports
+import semantic_search.configuration as config
+import semantic_search.functions.intermediate as intermediate
+import semantic_search.functions.parsing as parse_funcs
+import semantic_search.functions.wikipedia_extractor as wikipedia_funcs
+
+def read_task(task: dict) -> int:
+    '''Worker function, reads a parse task's texts the way parse_batch does,
+    returns the number of characters read.'''
+
+    if 'file' in task:
+        task=intermediate.read_extracted_range(task)
+
+    return sum(len(text) for text in task['texts'])
+
+
+def run(data_source: str, n_records: int, batch_size: int, n_workers: int) -> dict:
+    '''Writes and reads the same extracted batches in each format, returns dictionary of timings.'''
+
+    # Load the data source configuration
+    source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
+
+    with open(source_config_path, encoding='UTF-8') as source_config_file:
+        source_config=json.load(source_config_file)
+
+    # Extract batches from the head of the dump, single process
+    source_config['batch_size']=batch_size
+    source_config['num_batches']=-(-n_records // batch_size)
+    source_config['batch_bytes']=float('inf')
+    text_source=source_config.get('text_source', config.DEFAULT_TEXT_SOURCE)
+
+    results=[
+        wikipedia_funcs.extract_wikipedia_text(lines, text_source=text_source)
+        for lines in wikipedia_funcs.yield_line_batches(source_config)
+    ]
+
+    summary={
+        'extracted_batches': len(results),
+        'articles': sum(len(result['texts']) for result in results),
+        'text_characters': sum(len(text) for result in results for text in result['texts']),
+        'parse_task_characters': config.PARSE_TASK_CHARACTERS,
+        'worker_processes': n_workers
+    }
+
+    with tempfile.TemporaryDirectory() as temp_dir, mp.Pool(processes=n_workers) as pool:
+
+        for file_format, file_name in (('hdf5', config.EXTRACTED_TEXT), ('arrow', config.EXTRACTED_TEXT_ARROW)):
+
+            config.INTERMEDIATE_FORMAT=file_format
+            output_file=f'{temp_dir}/{file_name}'
+
+            # Write the batches the way the extractor does
+            start_time=time.time()
+            output=intermediate.open_output(output_file, 'extracted')
+
+            for batch_num, result in enumerate(results):
+                wikipedia_funcs.save_batch(output, batch_num, result)
+
+            output.close()
+
+            summary[f'{file_format}_write_seconds']=time.time() - start_time
+            summary[f'{file_format}_file_bytes']=pathlib.Path(output_file).stat().st_size
+
+            # Hand every parse task to the workers, the way parse_data does
+            start_time=time.time()
+            input_data=intermediate.open_input(output_file)
+            batch_nums=intermediate.batch_nums(input_data)
+
+            if file_format == 'arrow':
+                tasks=list(intermediate.yield_extracted_ranges(output_file, input_data, batch_nums, config.PARSE_TASK_CHARACTERS))
+
+            else:
+                tasks=list(parse_funcs.yield_parse_tasks(input_data, batch_nums, config.PARSE_TASK_CHARACTERS))
+
+            characters=sum(pool.imap(read_task, tasks))
+            read_time=time.time() - start_time
+            intermediate.close_input(input_data)
+
+            summary[f'{file_format}_read_seconds']=read_time
+            summary[f'{file_format}_read_character_rate']=characters / read_time
+            summary[f'{file_format}_parse_tasks']=len(tasks)
+            summary[f'{file_format}_pickled_task_bytes']=sum(len(pickle.dumps(task)) for task in tasks)
+
+    summary['read_speedup']=summary['hdf5_read_seconds'] / summary['arrow_read_seconds']
+    summary['write_speedup']=summary['hdf5_write_seconds'] / summary['arrow_write_seconds']
+
+    return summary
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Benchmarks hdf5 and Arrow extracted text files.')
+    parser.add_argument('--data_source', default='wikipedia-sample', help='data source configuration to read the dump from')
+    parser.add_argument('--records', type=int, default=20000, help='number of records to extract')
+    parser.add_argument('--batch_size', type=int, default=5000, help='records per extracted batch')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count() - 1, help='number of reading worker processes')
+    args=parser.parse_args()
+
+    print(json.dumps(run(args.data_source, args.records, args.batch_size, args.workers), indent=4))
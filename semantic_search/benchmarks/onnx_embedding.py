@@ -0,0 +1,131 @@
+'''Benchmarks the ONNX Runtime embedding backend against the torch backend on the CPU.
+Embeds a sample of chunks from the parsed text with torch, with the exported ONNX model
+and with its int8 version, single process. Reports texts per second for each and how
+closely the ONNX vectors agree with torch's, by cosine similarity and by how often each
+chunk's nearest neighbour in the sample stays the same.
+
+Run from the project root, after the parse step:
+
+    python -m semantic_search.benchmarks.onnx_embedding --data_source wikipedia-sample --chunks 2000
+'''
+
+# Standard imports
+import time
+import json
+import argparse
+
+# PyPI imports
+import numpy as np
+
+# Internal imports
+import semantic_search.configuration as config
+import semantic_search.functions.embedding as embed_funcs
+import semantic_search.functions.onnx_backend as onnx_backend
+import semantic_search.functions.intermediate as intermediate
+
+def read_sample(index_name: str, n_chunks: int) -> list:
+    '''Returns the text of the first n_chunks chunks of the parsed text.'''
+
+    input_data=intermediate.open_input(intermediate.text_file(index_name, 'parsed'))
+    texts=[]
+
+    for batch_num in intermediate.batch_nums(input_data):
+
+        texts.extend(text.decode('utf-8') for text in intermediate.read_texts(input_data, batch_num))
+
+        if len(texts) >= n_chunks:
+            break
+
+    intermediate.close_input(input_data)
+
+    return texts[:n_chunks]
+
+
+def time_embeddings(texts: list, tokenizer, model, device: str) -> tuple:
+    '''Embeds texts in worker batch sized pieces after a warm up batch,
+    returns the embeddings and texts per second.'''
+
+    batch_size=config.EMBEDDING_BATCH_SIZE * config.WORKER_BATCHES_PER_ROUND
+
+    embed_funcs.calculate_embeddings(texts[:config.EMBEDDING_BATCH_SIZE], tokenizer, model, device)
+
+    start_time=time.time()
+
+    embeddings=np.concatenate([
+        embed_funcs.calculate_embeddings(texts[i:i + batch_size], tokenizer, model, device)[0]
+        for i in range(0, len(texts), batch_size)
+    ])
+
+    return embeddings, len(texts) / (time.time() - start_time)
+
+
+def agreement(reference: np.ndarray, embeddings: np.ndarray) -> dict:
+    '''Returns cosine similarity between each reference vector and its counterpart,
+    and the fraction of chunks with the same nearest neighbour by dot product, the
+    score the index uses.'''
+
+    cosines=np.sum(reference * embeddings, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1)
+    )
+
+    reference_scores=reference @ reference.T
+    scores=embeddings @ embeddings.T
+    np.fill_diagonal(reference_scores, -np.inf)
+    np.fill_diagonal(scores, -np.inf)
+
+    return {
+        'mean_cosine': float(np.mean(cosines)),
+        'min_cosine': float(np.min(cosines)),
+        'nearest_neighbour_agreement': float(np.mean(np.argmax(reference_scores, axis=1) == np.argmax(scores, axis=1)))
+    }
+
+
+def run(data_source: str, n_chunks: int, threads: int) -> dict:
+    '''Embeds the same chunks with each backend, returns dictionary of results.'''
+
+    # Load the data source configuration
+    source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
+
+    with open(source_config_path, encoding='UTF-8') as source_config_file:
+        source_config=json.load(source_config_file)
+
+    texts=read_sample(source_config['target_index_name'], n_chunks)
+
+    # Give both backends the same number of threads
+    config.CPU_WORKER_THREADS=threads
+    config.ONNX_INTRA_OP_THREADS=threads
+
+    results={
+        'chunks': len(texts),
+        'threads': threads,
+        'embedding_token_budget': config.EMBEDDING_TOKEN_BUDGET
+    }
+
+    # Reference vectors from torch on the CPU
+    config.EMBEDDING_BACKEND='torch'
+    tokenizer, model=embed_funcs.load_model('cpu')
+    reference, results['torch_rate']=time_embeddings(texts, tokenizer, model, 'cpu')
+
+    # Exported model, then its int8 version
+    config.EMBEDDING_BACKEND='onnx'
+
+    for name, quantized in (('onnx', False), ('onnx_int8', True)):
+
+        session=onnx_backend.load_session(onnx_backend.prepare_model(quantized))
+        embeddings, results[f'{name}_rate']=time_embeddings(texts, tokenizer, session, 'cpu')
+
+        results[f'{name}_speedup']=results[f'{name}_rate'] / results['torch_rate']
+        results[name]=agreement(reference, embeddings)
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Benchmarks ONNX Runtime embedding against torch on the CPU.')
+    parser.add_argument('--data_source', default='wikipedia-sample', help='data source configuration to read the parsed text of')
+    parser.add_argument('--chunks', type=int, default=2000, help='number of chunks to embed')
+    parser.add_argument('--threads', type=int, default=config.ONNX_INTRA_OP_THREADS, help='threads for each backend')
+    args=parser.parse_args()
+
+    print(json.dumps(run(args.data_source, args.chunks, args.threads), indent=4))
@@ -0,0 +1,95 @@
+'''Benchmarks decoding of CirrusSearch records. Compares full json.loads of every
+record with the record decoder, using the standard library and, if it is installed,
+orjson. Reports records per second for each and the size of the decoded records.
+
+Run from the project root:
+
+    python -m semantic_search.benchmarks.record_decoding --data_source wikipedia-sample --records 10000
+'''
+
+# Standard imports
+import time
+import json
+import pickle
+import argparse
+
+# Internal imports
+import semantic_search.configuration as config
+import semantic_search.functions.selective_json as selective_json
+import semantic_search.functions.wikipedia_extractor as wikipedia_funcs
+
+def run(data_source: str, n_records: int) -> dict:
+    '''Decodes the same records with each decoder, returns dictionary of timings.'''
+
+    # Load the data source configuration
+    source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
+
+    with open(source_config_path, encoding='UTF-8') as source_config_file:
+        source_config=json.load(source_config_file)
+
+    text_source=source_config.get('text_source', config.DEFAULT_TEXT_SOURCE)
+
+    # Read one batch of record lines from the head of the dump
+    source_config['batch_size']=n_records
+    source_config['num_batches']='all'
+    source_config['batch_bytes']=float('inf')
+    records=[line for _, line in next(wikipedia_funcs.yield_line_batches(source_config))]
+
+    results={
+        'records': len(records),
+        'record_bytes': sum(len(line) for line in records),
+        'text_source': text_source
+    }
+
+    # Before, decoding every field of every record with the
+    # standard library and filtering afterwards
+    start_time=time.time()
+    full_records=[]
+
+    for line in records:
+        record=json.loads(line)
+
+        if record['namespace'] == 0 and 'Disambiguation pages' not in record['category']:
+            full_records.append(record)
+
+    results['full_json_loads']=len(records) / (time.time() - start_time)
+
+    # After, pre-filtering and keeping only the fields we need, with
+    # the standard library decoder and with orjson if we have it
+    decoders=[('decoder_stdlib', json.loads)]
+
+    if selective_json.FAST_DECODER is True:
+        decoders.append(('decoder_orjson', selective_json.orjson.loads))
+
+    default_loads=selective_json.loads
+
+    for name, loads in decoders:
+
+        selective_json.loads=loads
+        start_time=time.time()
+
+        articles=[selective_json.decode_article(line, text_source) for line in records]
+
+        results[name]=len(records) / (time.time() - start_time)
+
+    selective_json.loads=default_loads
+
+    # How many lines the byte level pre-filter rejects without decoding
+    results['prefiltered_out']=sum(1 for line in records if selective_json.prefilter(line) is False)
+
+    # Size of what a worker holds or sends on for each kept record
+    articles=[article for article in articles if article is not None]
+    results['mean_full_record_pickle_bytes']=sum(len(pickle.dumps(record)) for record in full_records) / max(len(full_records), 1)
+    results['mean_article_record_pickle_bytes']=sum(len(pickle.dumps(article)) for article in articles) / max(len(articles), 1)
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Benchmarks CirrusSearch record decoding.')
+    parser.add_argument('--data_source', default='wikipedia-sample', help='data source configuration to read the dump from')
+    parser.add_argument('--records', type=int, default=10000, help='number of records to benchmark on')
+    args=parser.parse_args()
+
+    print(json.dumps(run(args.data_source, args.records), indent=4))
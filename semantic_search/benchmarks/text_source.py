@@ -0,0 +1,98 @@
+'''Benchmarks Wikipedia text extraction from the wikicode source_text field against
+the pre-rendered text field. Reports extraction rate, JSON decoding time and the
+chunk counts each mode produces for the same records.
+
+Run from the project root:
+
+    python -m semantic_search.benchmarks.text_source --data_source wikipedia-sample --records 2000
+'''
+
+# Standard imports
+import time
+import json
+import argparse
+
+# Internal imports
+import semantic_search.configuration as config
+import semantic_search.functions.parsing as parse_funcs
+import semantic_search.functions.wikipedia_extractor as wikipedia_funcs
+from semantic_search.functions.selective_json import decode_fields
+
+def run(data_source: str, n_records: int) -> dict:
+    '''Extracts and chunks the same records with each text source, single
+    process, returns dictionary of results for each one.'''
+
+    # Load the data source configuration
+    source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
+
+    with open(source_config_path, encoding='UTF-8') as source_config_file:
+        source_config=json.load(source_config_file)
+
+    # Read one batch of record lines from the head of the dump
+    source_config['batch_size']=n_records
+    source_config['num_batches']='all'
+    source_config['batch_bytes']=float('inf')
+    lines=next(wikipedia_funcs.yield_line_batches(source_config))
+    records=[line for _, line in lines]
+
+    results={'records': len(records)}
+
+    # Baseline, decoding every field of every record
+    start_time=time.time()
+
+    for line in records:
+        json.loads(line)
+
+    results['full_decode_seconds']=time.time() - start_time
+
+    for text_source in ('source_text', 'text'):
+
+        fields=('namespace', 'category', 'title', text_source)
+
+        # Decoding only the fields this mode needs
+        start_time=time.time()
+
+        for line in records:
+            decode_fields(line, fields)
+
+        decode_time=time.time() - start_time
+
+        # Whole extraction, decoding included
+        start_time=time.time()
+        extracted=wikipedia_funcs.extract_wikipedia_text(lines, text_source)
+        extraction_time=time.time() - start_time
+
+        # Chunk what we got, to see how the text differs downstream
+        start_time=time.time()
+        parsed=parse_funcs.clean_and_chunk(extracted['texts'])
+        parse_time=time.time() - start_time
+
+        chunk_tokens=parsed['token_offsets'][1:] - parsed['token_offsets'][:-1]
+
+        results[text_source]={
+            'selective_decode_seconds': decode_time,
+            'extraction_seconds': extraction_time,
+            'extraction_rate': len(records) / extraction_time,
+            'extracted_articles': len(extracted['texts']),
+            'extracted_characters': sum(len(text) for text in extracted['texts']),
+            'parse_seconds': parse_time,
+            'chunks': len(parsed['chunks']),
+            'chunks_per_article': len(parsed['chunks']) / max(len(extracted['texts']), 1),
+            'mean_chunk_tokens': float(chunk_tokens.mean()) if len(chunk_tokens) > 0 else 0
+        }
+
+    # Side by side differences
+    results['extraction_speedup']=results['text']['extraction_rate'] / results['source_text']['extraction_rate']
+    results['chunk_count_ratio']=results['text']['chunks'] / max(results['source_text']['chunks'], 1)
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Benchmarks source_text against text extraction.')
+    parser.add_argument('--data_source', default='wikipedia-sample', help='data source configuration to read the dump from')
+    parser.add_argument('--records', type=int, default=2000, help='number of records to benchmark on')
+    args=parser.parse_args()
+
+    print(json.dumps(run(args.data_source, args.records), indent=4))
@@ -0,0 +1,120 @@
+'''Compares the fast wikicode stripper's output with mwparserfromhell's on a sample of
+records, both followed by the rest of the extraction cleaning. Reports how many pages
+the fast path handles, how closely its text matches, by word level similarity and word
+counts, and the pages which differ the most. Optionally writes unified diffs of those
+pages to a file for reading through.
+
+Run from the project root:
+
+    python -m semantic_search.benchmarks.wikitext_fidelity --data_source wikipedia-sample --records 2000
+'''
+
+# Standard imports
+import json
+import difflib
+import argparse
+
+# Internal imports
+import semantic_search.configuration as config
+import semantic_search.functions.wikitext as wikitext
+import semantic_search.functions.wikipedia_extractor as wikipedia_funcs
+from semantic_search.functions.selective_json import decode_article
+
+def clean(stripped: str) -> str:
+    '''Runs the rest of the extraction cleaning on stripped text.'''
+
+    return wikipedia_funcs.remove_thumbnails(wikipedia_funcs.remove_extra_sections(stripped))
+
+
+def run(data_source: str, n_records: int, n_worst: int, diff_output: str = None) -> dict:
+    '''Strips the same records both ways, returns dictionary of fidelity results.'''
+
+    # Load the data source configuration
+    source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
+
+    with open(source_config_path, encoding='UTF-8') as source_config_file:
+        source_config=json.load(source_config_file)
+
+    # Read one batch of record lines from the head of the dump
+    source_config['batch_size']=n_records
+    source_config['num_batches']='all'
+    source_config['batch_bytes']=float('inf')
+    lines=next(wikipedia_funcs.yield_line_batches(source_config))
+
+    articles=[decode_article(line, 'source_text') for _, line in lines]
+    articles=[article for article in articles if article is not None]
+
+    comparisons=[]
+    fallbacks=0
+
+    for article in articles:
+
+        fast_text=wikitext.fast_strip(article.text)
+
+        # Pages the fast path hands to mwparserfromhell come out the same
+        if fast_text is None:
+            fallbacks+=1
+            continue
+
+        reference_words=clean(wikitext.mwparserfromhell_strip(article.text)).split()
+        fast_words=clean(fast_text).split()
+
+        similarity=difflib.SequenceMatcher(None, reference_words, fast_words, autojunk=False).ratio()
+
+        comparisons.append({
+            'title': article.title,
+            'similarity': similarity,
+            'reference_words': len(reference_words),
+            'fast_words': len(fast_words)
+        })
+
+    comparisons.sort(key=lambda comparison: comparison['similarity'])
+    reference_total=sum(comparison['reference_words'] for comparison in comparisons)
+    fast_total=sum(comparison['fast_words'] for comparison in comparisons)
+
+    results={
+        'articles': len(articles),
+        'fast_path_articles': len(comparisons),
+        'fallback_articles': fallbacks,
+        'fallback_rate': fallbacks / max(len(articles), 1),
+        'mean_similarity': sum(comparison['similarity'] for comparison in comparisons) / max(len(comparisons), 1),
+        'identical_articles': sum(1 for comparison in comparisons if comparison['similarity'] == 1),
+        'word_count_ratio': fast_total / max(reference_total, 1),
+        'least_similar': comparisons[:n_worst]
+    }
+
+    # Write out diffs of the least similar pages, a line per word is
+    # easier to read than diffs of whole paragraphs
+    if diff_output is not None:
+
+        worst_titles={comparison['title'] for comparison in comparisons[:n_worst]}
+
+        with open(diff_output, 'w', encoding='utf-8') as diff_file:
+            for article in articles:
+
+                if article.title not in worst_titles:
+                    continue
+
+                diff=difflib.unified_diff(
+                    clean(wikitext.mwparserfromhell_strip(article.text)).split(),
+                    clean(wikitext.fast_strip(article.text)).split(),
+                    fromfile=f'{article.title} (mwparserfromhell)',
+                    tofile=f'{article.title} (fast)',
+                    lineterm=''
+                )
+
+                diff_file.write('\n'.join(diff) + '\n\n')
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Compares fast wikicode stripping with mwparserfromhell.')
+    parser.add_argument('--data_source', default='wikipedia-sample', help='data source configuration to read the dump from')
+    parser.add_argument('--records', type=int, default=2000, help='number of records to compare on')
+    parser.add_argument('--worst', type=int, default=10, help='number of least similar pages to report')
+    parser.add_argument('--diff_output', default=None, help='file to write diffs of the least similar pages to')
+    args=parser.parse_args()
+
+    print(json.dumps(run(args.data_source, args.records, args.worst, args.diff_output), indent=4))
@@ -0,0 +1,83 @@
+'''Benchmarks wikicode stripping. Reports articles per second for mwparserfromhell,
+for the fast stripper on the pages it handles, and for the two together the way the
+extractor runs them, with the fast path falling back to mwparserfromhell.
+
+Run from the project root:
+
+    python -m semantic_search.benchmarks.wikitext_stripping --data_source wikipedia-sample --records 2000
+'''
+
+# Standard imports
+import time
+import json
+import argparse
+
+# Internal imports
+import semantic_search.configuration as config
+import semantic_search.functions.wikitext as wikitext
+import semantic_search.functions.wikipedia_extractor as wikipedia_funcs
+from semantic_search.functions.selective_json import decode_article
+
+def run(data_source: str, n_records: int) -> dict:
+    '''Strips the same records each way, single process, returns dictionary of timings.'''
+
+    # Load the data source configuration
+    source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
+
+    with open(source_config_path, encoding='UTF-8') as source_config_file:
+        source_config=json.load(source_config_file)
+
+    # Read one batch of record lines from the head of the dump
+    source_config['batch_size']=n_records
+    source_config['num_batches']='all'
+    source_config['batch_bytes']=float('inf')
+    lines=next(wikipedia_funcs.yield_line_batches(source_config))
+
+    sources=[decode_article(line, 'source_text') for _, line in lines]
+    sources=[article.text for article in sources if article is not None]
+
+    results={
+        'articles': len(sources),
+        'source_characters': sum(len(source) for source in sources)
+    }
+
+    # Before, mwparserfromhell for everything
+    start_time=time.time()
+
+    for source in sources:
+        wikitext.mwparserfromhell_strip(source)
+
+    results['mwparserfromhell_rate']=len(sources) / (time.time() - start_time)
+
+    # Fast path alone, counting the pages it hands back
+    start_time=time.time()
+    fallbacks=sum(1 for source in sources if wikitext.fast_strip(source) is None)
+    fast_time=time.time() - start_time
+
+    results['fast_path_rate']=len(sources) / fast_time
+    results['fallback_articles']=fallbacks
+    results['fallback_rate']=fallbacks / max(len(sources), 1)
+
+    # After, fast path with fallback
+    start_time=time.time()
+
+    for source in sources:
+        stripped=wikitext.fast_strip(source)
+
+        if stripped is None:
+            wikitext.mwparserfromhell_strip(source)
+
+    results['combined_rate']=len(sources) / (time.time() - start_time)
+    results['speedup']=results['combined_rate'] / results['mwparserfromhell_rate']
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Benchmarks fast wikicode stripping against mwparserfromhell.')
+    parser.add_argument('--data_source', default='wikipedia-sample', help='data source configuration to read the dump from')
+    parser.add_argument('--records', type=int, default=2000, help='number of records to benchmark on')
+    args=parser.parse_args()
+
+    print(json.dumps(run(args.data_source, args.records), indent=4))
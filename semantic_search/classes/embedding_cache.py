@@ -0,0 +1,159 @@
+'''Persistent, content addressed embedding cache. Vectors live in one appendable
+float32 file, a SQLite table maps the hash of each chunk's text, the model name
+and the max token count to the vector's row in that file.'''
+
+# Standard imports
+import os
+import fcntl
+import hashlib
+import pathlib
+import sqlite3
+import threading
+
+# PyPI imports
+import numpy as np
+
+# Internal imports
+import semantic_search.configuration as config
+
+class EmbeddingCache:
+    '''Embedding cache shared across pipeline runs. Lookups and inserts
+    are thread safe, so one thread can read while another writes, and
+    inserts from separate processes take a file lock on the vector file,
+    so concurrent runs can share a cache.'''
+
+    def __init__(self, cache_path: str = config.EMBEDDING_CACHE_PATH):
+
+        pathlib.Path(cache_path).mkdir(parents=True, exist_ok=True)
+
+        self.vector_file_path=f'{cache_path}/{config.EMBEDDING_CACHE_VECTORS}'
+        self.lock=threading.Lock()
+
+        # Hash index, maps chunk keys to rows in the vector file
+        self.index=sqlite3.connect(f'{cache_path}/{config.EMBEDDING_CACHE_INDEX}', check_same_thread=False)
+        self.index.execute('PRAGMA journal_mode=WAL')
+        self.index.execute('PRAGMA synchronous=NORMAL')
+        self.index.execute('CREATE TABLE IF NOT EXISTS vectors (key BLOB PRIMARY KEY, row INTEGER)')
+
+        # Appendable vector file, one float32 row per cached embedding
+        self.vector_file=open(self.vector_file_path, 'ab') # pylint: disable = consider-using-with
+        self.row_bytes=config.EMBEDDING_DIMENSION * np.dtype(np.float32).itemsize
+
+        # Rows past the last indexed one are left over from an interrupted
+        # run, new rows are written after them and they are never read. Drop
+        # any partly written row so that new rows stay aligned
+        fcntl.flock(self.vector_file, fcntl.LOCK_EX)
+
+        try:
+            self.align_vector_file()
+
+        finally:
+            fcntl.flock(self.vector_file, fcntl.LOCK_UN)
+
+        # Everything which changes the embedding goes into the key, including the
+        # backend, since int8 ONNX vectors differ from the torch ones
+        backend=config.EMBEDDING_BACKEND
+
+        if backend == 'onnx' and config.ONNX_QUANTIZE is True:
+            backend='onnx-int8'
+
+        self.key_prefix=f'{config.EMBEDDING_MODEL}\0{config.MAX_TOKENS}\0{backend}\0'.encode('utf-8')
+
+
+    def align_vector_file(self) -> int:
+        '''Truncates the vector file to whole rows, returns the number of rows.
+        Only call while holding the vector file lock.'''
+
+        rows=os.fstat(self.vector_file.fileno()).st_size // self.row_bytes
+        self.vector_file.truncate(rows * self.row_bytes)
+
+        return rows
+
+
+    def make_keys(self, texts: list) -> list:
+        '''Takes list of chunk texts as utf-8 bytes, returns list of cache keys.'''
+
+        keys=[]
+
+        for text in texts:
+            key_hash=hashlib.blake2b(self.key_prefix, digest_size=16)
+            key_hash.update(text)
+            keys.append(key_hash.digest())
+
+        return keys
+
+
+    def lookup(self, keys: list) -> tuple:
+        '''Takes list of cache keys, returns array of the positions in keys which
+        were found and a float32 array of their vectors, in the same order.'''
+
+        rows={}
+
+        with self.lock:
+
+            # SQLite limits the number of parameters in a single query
+            for i in range(0, len(keys), config.EMBEDDING_CACHE_QUERY_SIZE):
+
+                key_batch=keys[i:i + config.EMBEDDING_CACHE_QUERY_SIZE]
+                placeholders=','.join('?' * len(key_batch))
+
+                for key, row in self.index.execute(
+                    f'SELECT key, row FROM vectors WHERE key IN ({placeholders})',
+                    key_batch
+                ):
+                    rows[key]=row
+
+        # Keys are only indexed once their rows are on disk, so the file
+        # holds every row we found, including ones other processes wrote
+        n_rows=os.path.getsize(self.vector_file_path) // self.row_bytes
+
+        hit_positions=np.array([i for i, key in enumerate(keys) if key in rows], dtype=np.int64)
+
+        if len(hit_positions) == 0 or n_rows == 0:
+            return hit_positions[:0], np.empty((0, config.EMBEDDING_DIMENSION), dtype=np.float32)
+
+        # Gather the vectors straight out of a memory map of the vector file
+        vectors=np.memmap(self.vector_file_path, dtype=np.float32, mode='r', shape=(n_rows, config.EMBEDDING_DIMENSION))
+        hit_rows=np.array([rows[keys[i]] for i in hit_positions], dtype=np.int64)
+        hit_vectors=np.array(vectors[hit_rows], dtype=np.float32)
+
+        del vectors
+
+        return hit_positions, hit_vectors
+
+
+    def insert(self, keys: list, vectors: np.ndarray) -> None:
+        '''Takes list of cache keys and the matching vectors, appends them
+        to the vector file and then adds them to the hash index.'''
+
+        with self.lock:
+
+            # Hold the vector file lock over the append and the index insert so
+            # that other processes sharing the cache can't claim the same rows
+            fcntl.flock(self.vector_file, fcntl.LOCK_EX)
+
+            try:
+
+                # The first new row is wherever the file ends now, which
+                # may have moved since we opened it
+                first_row=self.align_vector_file()
+
+                # Write and flush the vectors first, so that an indexed key
+                # always points at a row which is already on disk
+                self.vector_file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+                self.vector_file.flush()
+
+                rows=range(first_row, first_row + len(keys))
+
+                self.index.executemany('INSERT OR IGNORE INTO vectors VALUES (?, ?)', zip(keys, rows))
+                self.index.commit()
+
+            finally:
+                fcntl.flock(self.vector_file, fcntl.LOCK_UN)
+
+
+    def close(self) -> None:
+        '''Closes the vector file and hash index.'''
+
+        self.vector_file.close()
+        self.index.close()
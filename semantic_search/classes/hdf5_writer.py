@@ -0,0 +1,103 @@
+'''Background writer for the pipeline's hdf5 output files. One thread owns the
+file and does every write to it, taking work from a small bounded queue, so the
+stage's main loop can go back to feeding workers while earlier results are
+written. The time the main loop spends waiting on a full queue is the write
+stall, which is reported in the stage summaries.'''
+
+# Standard imports
+import time
+import queue
+import threading
+
+# PyPI imports
+import h5py
+
+# Internal imports
+import semantic_search.configuration as config
+
+class HDF5Writer:
+    '''Owns an hdf5 output file, writes to it from a dedicated thread. Writes
+    are functions which take the file as their first argument, e.g. a stage's
+    save_batch, and run in the order they were submitted. Can be given an
+    already open output instead, e.g. an Arrow IPC file writer, which is
+    closed the same way.'''
+
+    def __init__(self, output_file: str, queue_size: int = config.HDF5_WRITER_QUEUE_SIZE, output=None):
+
+        self.output=h5py.File(output_file, 'w') if output is None else output
+
+        # Results waiting to be written. With the default size of two, one result
+        # can be waiting while another is written, i.e. double buffering
+        self.queue=queue.Queue(maxsize=queue_size)
+
+        # Time the submitting thread spent blocked on a full queue
+        # and time the writer thread spent writing
+        self.stall_seconds=0.0
+        self.write_seconds=0.0
+
+        # First exception raised by a write, raised again on close
+        self.error=None
+
+        self.thread=threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+
+    def submit(self, function, *args) -> None:
+        '''Queues function(output, *args) to run on the writer thread. Blocks if
+        the queue is full, which is counted as write stall time. The arguments
+        must not be changed after they are submitted.'''
+
+        # Don't keep queueing work behind a failed write
+        if self.error is not None:
+            raise self.error
+
+        start_time=time.time()
+        self.queue.put((function, args))
+        self.stall_seconds+=time.time() - start_time
+
+
+    def write_loop(self) -> None:
+        '''Writer thread, runs queued writes until it gets the done signal.'''
+
+        while True:
+
+            work=self.queue.get()
+
+            if work == 'done':
+                return
+
+            # After a failed write, drain the queue so submit never blocks
+            if self.error is not None:
+                continue
+
+            function, args=work
+            start_time=time.time()
+
+            try:
+                function(self.output, *args)
+
+            except Exception as error: # pylint: disable = broad-exception-caught
+                self.error=error
+
+            self.write_seconds+=time.time() - start_time
+
+
+    def close(self) -> dict:
+        '''Waits for the queued writes to finish and closes the file. Raises the
+        first write error, if there was one, otherwise returns dictionary of
+        write timings for the stage summary.'''
+
+        start_time=time.time()
+        self.queue.put('done')
+        self.thread.join()
+        self.stall_seconds+=time.time() - start_time
+
+        self.output.close()
+
+        if self.error is not None:
+            raise self.error
+
+        return {
+            'write_stall_seconds': self.stall_seconds,
+            'writer_busy_seconds': self.write_seconds
+        }
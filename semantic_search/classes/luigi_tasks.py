@@ -9,6 +9,8 @@ import luigi
 # Internal imports
 import semantic_search.configuration as config
 import semantic_search.functions.extract_transform_load as etl_funcs
+import semantic_search.functions.streaming as streaming_funcs
+import semantic_search.functions.luigi_helper as helper
 
 class ExtractData(luigi.Task):
     '''Runs source specific data extraction function. Reads raw data,
@@ -50,10 +52,15 @@ class ExtractData(luigi.Task):
 
 
 class ParseData(luigi.Task):
-    '''Reads extracted data batches, does some text normalization and chunking.'''
+    '''Reads one shard of the extracted data batches, does some text
+    normalization and chunking.'''
 
-    # Take the data source string as a parameter
+    # Take the data source string and shard number as parameters
     data_source=luigi.Parameter()
+    shard=luigi.IntParameter()
+
+    # Parsing uses a pool with a worker for every CPU
+    resources={'cpu_pool': 1}
 
     def requires(self):
         return ExtractData(self.data_source)
@@ -71,11 +78,14 @@ class ParseData(luigi.Task):
 
     def output(self):
 
-        # Construct output file name for extraction summary file
+        # Construct output file name for the shard's parse summary file
         source_config=self.load_data_source_config()
 
-        transform_summary_file=(f"{config.DATA_PATH}/"+
-            f"{source_config['target_index_name']}/{config.PARSE_SUMMARY}")
+        transform_summary_file=helper.data_file(
+            source_config['target_index_name'],
+            config.PARSE_SUMMARY,
+            self.shard
+        )
 
         # Define the parse summary file as the target for this task
         return luigi.LocalTarget(transform_summary_file)
@@ -83,22 +93,75 @@ class ParseData(luigi.Task):
     def run(self):
 
         # Run the transform
-        transform_summary=etl_funcs.parse_data(self.data_source)
+        transform_summary=etl_funcs.parse_data(self.data_source, self.shard)
 
         # Save the transform summary to disk
         with self.output().open('w') as output_file:
             json.dump(transform_summary, output_file)
 
 
+class DeduplicateData(luigi.Task):
+    '''Finds near-duplicate chunks in one shard of the parsed data, so that
+    only one chunk from each cluster is embedded and indexed.'''
+
+    # Take the data source string and shard number as parameters
+    data_source=luigi.Parameter()
+    shard=luigi.IntParameter()
+
+    # Signatures are computed by a pool with a worker for every CPU
+    resources={'cpu_pool': 1}
+
+    def requires(self):
+        return ParseData(self.data_source, self.shard)
+
+    def load_data_source_config(self):
+        '''Loads data source specific configuration dictionary.'''
+
+        # Load the data source configuration
+        source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{self.data_source}.json'
+
+        with open(source_config_path, encoding='UTF-8') as source_config_file:
+            source_config=json.load(source_config_file)
+
+        return source_config
+
+    def output(self):
+
+        # Construct output file name for the shard's deduplication summary file
+        source_config=self.load_data_source_config()
+
+        deduplication_summary_file=helper.data_file(
+            source_config['target_index_name'],
+            config.DEDUPLICATION_SUMMARY,
+            self.shard
+        )
+
+        # Define the deduplication summary file as the target for this task
+        return luigi.LocalTarget(deduplication_summary_file)
+
+    def run(self):
+
+        # Run the deduplication
+        deduplication_summary=etl_funcs.deduplicate_data(self.data_source, self.shard)
+
+        # Save the deduplication summary to disk
+        with self.output().open('w') as output_file:
+            json.dump(deduplication_summary, output_file)
+
+
 class EmbedData(luigi.Task):
-    '''Uses HuggingFace transformers to pre-calculate embeddings for indexing
-    in the next step'''
+    '''Uses HuggingFace transformers to pre-calculate embeddings for one
+    shard, for indexing in the next step'''
 
-    # Take the data source string as a parameter
+    # Take the data source string and shard number as parameters
     data_source=luigi.Parameter()
+    shard=luigi.IntParameter()
+
+    # Embedding uses every configured GPU
+    resources={'gpu_workers': 1}
 
     def requires(self):
-        return ParseData(self.data_source)
+        return DeduplicateData(self.data_source, self.shard)
 
     def load_data_source_config(self):
         '''Loads data source specific configuration dictionary.'''
@@ -113,32 +176,78 @@ class EmbedData(luigi.Task):
 
     def output(self):
 
-        # Construct output file name for embedding summary file
+        # Construct output file name for the shard's embedding summary file
         source_config=self.load_data_source_config()
 
-        embedding_summary_file=(f"{config.DATA_PATH}/"+
-            f"{source_config['target_index_name']}/{config.EMBEDDING_SUMMARY}")
+        embedding_summary_file=helper.data_file(
+            source_config['target_index_name'],
+            config.EMBEDDING_SUMMARY,
+            self.shard
+        )
 
-        # Define the parse summary file as the target for this task
+        # Define the embedding summary file as the target for this task
         return luigi.LocalTarget(embedding_summary_file)
 
     def run(self):
 
         # Run the embedding
-        embedding_summary=etl_funcs.embed_data(self.data_source)
+        embedding_summary=etl_funcs.embed_data(self.data_source, self.shard)
 
-        # Save the transform summary to disk
+        # Save the embedding summary to disk
         with self.output().open('w') as output_file:
             json.dump(embedding_summary, output_file)
 
-class LoadData(luigi.Task):
-    '''Loads prepared data into OpenSearch KNN vector database for semantic search.'''
+
+class CreateIndex(luigi.Task):
+    '''Creates the OpenSearch KNN index which every shard is loaded into.'''
 
     # Take the data source string as a parameter
     data_source=luigi.Parameter()
 
+    def load_data_source_config(self):
+        '''Loads data source specific configuration dictionary.'''
+
+        # Load the data source configuration
+        source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{self.data_source}.json'
+
+        with open(source_config_path, encoding='UTF-8') as source_config_file:
+            source_config=json.load(source_config_file)
+
+        return source_config
+
+    def output(self):
+
+        # Construct output file name for index summary file
+        source_config=self.load_data_source_config()
+
+        index_summary_file=helper.data_file(source_config['target_index_name'], config.INDEX_SUMMARY)
+
+        # Define the index summary file as the target for this task
+        return luigi.LocalTarget(index_summary_file)
+
+    def run(self):
+
+        # Create the index
+        index_summary=etl_funcs.create_index(self.data_source)
+
+        # Save the index summary to disk
+        with self.output().open('w') as output_file:
+            json.dump(index_summary, output_file)
+
+
+class LoadData(luigi.Task):
+    '''Loads one shard of prepared data into OpenSearch KNN vector
+    database for semantic search.'''
+
+    # Take the data source string and shard number as parameters
+    data_source=luigi.Parameter()
+    shard=luigi.IntParameter()
+
+    # Loading uses a pool of connections to the cluster
+    resources={'opensearch': 1}
+
     def requires(self):
-        return ParseData(self.data_source)
+        return [EmbedData(self.data_source, self.shard), CreateIndex(self.data_source)]
 
     def load_data_source_config(self):
         '''Loads data source specific configuration dictionary.'''
@@ -153,11 +262,14 @@ class LoadData(luigi.Task):
 
     def output(self):
 
-        # Construct output file name for extraction summary file
+        # Construct output file name for the shard's load summary file
         source_config=self.load_data_source_config()
 
-        load_summary_file=(f"{config.DATA_PATH}/"+
-            f"{source_config['target_index_name']}/{config.LOAD_SUMMARY}")
+        load_summary_file=helper.data_file(
+            source_config['target_index_name'],
+            config.LOAD_SUMMARY,
+            self.shard
+        )
 
         # Define the load summary file as the target for this task
         return luigi.LocalTarget(load_summary_file)
@@ -165,8 +277,103 @@ class LoadData(luigi.Task):
     def run(self):
 
         # Run the load
-        load_summary=etl_funcs.load_data(self.data_source)
+        load_summary=etl_funcs.load_data(self.data_source, self.shard)
 
         # Save the load summary to disk
         with self.output().open('w') as output_file:
             json.dump(load_summary, output_file)
+
+
+class MergeShards(luigi.Task):
+    '''Runs every shard through the pipeline, then merges the per-shard
+    summaries. The shards are only known once extraction has finished,
+    so they are yielded as dynamic dependencies.'''
+
+    # Take the data source string as a parameter
+    data_source=luigi.Parameter()
+
+    def requires(self):
+        return ExtractData(self.data_source)
+
+    def load_data_source_config(self):
+        '''Loads data source specific configuration dictionary.'''
+
+        # Load the data source configuration
+        source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{self.data_source}.json'
+
+        with open(source_config_path, encoding='UTF-8') as source_config_file:
+            source_config=json.load(source_config_file)
+
+        return source_config
+
+    def output(self):
+
+        # Construct output file name for merged summary file
+        source_config=self.load_data_source_config()
+
+        merged_summary_file=helper.data_file(source_config['target_index_name'], config.MERGED_SUMMARY)
+
+        # Define the merged summary file as the target for this task
+        return luigi.LocalTarget(merged_summary_file)
+
+    def run(self):
+
+        # Work out the number of shards from the extraction summary
+        source_config=self.load_data_source_config()
+
+        with self.input().open('r') as extraction_summary_file:
+            extraction_summary=json.load(extraction_summary_file)
+
+        n_shards=helper.shard_count(source_config, extraction_summary['extracted_batches'])
+
+        # Run the shards, Luigi only schedules the ones which haven't finished yet
+        yield [LoadData(self.data_source, shard) for shard in range(n_shards)]
+
+        # Merge the shard summaries
+        merged_summary=etl_funcs.merge_shard_summaries(self.data_source, n_shards)
+
+        # Save the merged summary to disk
+        with self.output().open('w') as output_file:
+            json.dump(merged_summary, output_file)
+
+
+class StreamData(luigi.Task):
+    '''Runs extraction, parsing, embedding and loading concurrently as one
+    streaming pipeline. Intermediate files are optional checkpoints.'''
+
+    # Take the data source string as a parameter
+    data_source=luigi.Parameter()
+
+    # Save the intermediate hdf5 files along the way, or not
+    checkpoints=luigi.BoolParameter(default=False)
+
+    def load_data_source_config(self):
+        '''Loads data source specific configuration dictionary.'''
+
+        # Load the data source configuration
+        source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{self.data_source}.json'
+
+        with open(source_config_path, encoding='UTF-8') as source_config_file:
+            source_config=json.load(source_config_file)
+
+        return source_config
+
+    def output(self):
+
+        # Construct output file name for streaming summary file
+        source_config=self.load_data_source_config()
+
+        streaming_summary_file=(f"{config.DATA_PATH}/"+
+            f"{source_config['target_index_name']}/{config.STREAMING_SUMMARY}")
+
+        # Define the streaming summary file as the target for this task
+        return luigi.LocalTarget(streaming_summary_file)
+
+    def run(self):
+
+        # Run the streaming pipeline
+        streaming_summary=streaming_funcs.stream_data(self.data_source, self.checkpoints)
+
+        # Save the streaming summary to disk
+        with self.output().open('w') as output_file:
+            json.dump(streaming_summary, output_file)
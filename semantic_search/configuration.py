@@ -18,13 +18,169 @@ TORCH_CACHE='/mnt/fast_scratch/'
 TOKENIZER_NAME='bert-base-uncased'
 MAX_TOKENS=512
 
+# Save chunk token ids from the parse step so the embedding step can skip
+# tokenization. The chunking tokenizer shares its vocabulary with the
+# embedding model, which fits in uint16. Deduplication needs them
+STORE_TOKEN_IDS=True
+TOKEN_ID_DTYPE='uint16'
+
 # Embedding parameters
 EMBEDDING_MODEL='sentence-transformers/msmarco-distilbert-base-tas-b'
-WORKER_GPUS=['cuda:0'] * 6
+WORKER_GPUS=['cuda:0'] * 6 # One embedding worker per device string, 'cpu' is allowed
+CPU_WORKER_THREADS=4 # Torch threads for each embedding worker running on 'cpu'
+
+# Embedding backend, 'torch' runs the model on the WORKER_GPUS devices, 'onnx' exports it
+# to ONNX_MODEL_PATH and runs ONNX_WORKERS CPU workers with ONNX Runtime, for hosts with
+# no GPUs. Each ONNX worker uses ONNX_INTRA_OP_THREADS threads per operator, workers times
+# intra-op threads should not be more than the physical cores. Quantization converts the
+# weights to int8, which is faster on CPUs but changes the vectors slightly. Needs onnxruntime
+EMBEDDING_BACKEND='torch'
+ONNX_MODEL_PATH=f'{DATA_PATH}/onnx_models'
+ONNX_OPSET=17
+ONNX_QUANTIZE=True
+ONNX_WORKERS=2
+ONNX_INTRA_OP_THREADS=8
+ONNX_INTER_OP_THREADS=1
+
+# CPU embedding workers, with either backend, are pinned to their own groups of physical
+# cores, split along NUMA nodes, with their torch, ONNX Runtime, OpenMP and BLAS threads
+# set to the group's core count. With calibration the number of workers is picked by a
+# short run of each candidate count on CPU_CALIBRATION_TEXTS chunks, otherwise it is the
+# configured number of CPU workers. CPU_THREADS_PER_WORKER caps each group's cores, None
+# gives every worker all of its group
+CPU_TOPOLOGY_PINNING=True
+CPU_TOPOLOGY_CALIBRATE=True
+CPU_TOPOLOGY_CANDIDATES=[1, 2, 4, 8]
+CPU_CALIBRATION_TEXTS=64
+CPU_CALIBRATION_ROUNDS=3
+CPU_THREADS_PER_WORKER=None
+
+# Worker batches hold EMBEDDING_BATCH_SIZE * WORKER_BATCHES_PER_ROUND texts, which
+# is the look-ahead window that texts are length sorted within
 EMBEDDING_BATCH_SIZE=8
+EMBEDDING_TOKEN_BUDGET=4096 # Max padded tokens per model batch, texts are bucketed by length
 WORKER_BATCHES_PER_ROUND=100
 
+# Embedding tuner, the tune task runs the embedding workers on TUNE_SAMPLE_CHUNKS parsed
+# chunks for each worker count and thread count, GPU worker counts are per GPU, then for
+# each token budget on the fastest layout. The fastest settings which keep the workers'
+# total peak RSS under TUNE_MAX_RSS_BYTES, None for no limit, are written to
+# TUNED_EMBEDDING_CONFIG, which the embed stage loads over the settings above
+TUNED_EMBEDDING_CONFIG=f'{DATA_PATH}/tuned_embedding_config.json'
+USE_TUNED_EMBEDDING_CONFIG=True
+TUNE_SAMPLE_CHUNKS=800
+TUNE_ROUNDS=3
+TUNE_WORKER_COUNTS=[1, 2, 4, 8]
+TUNE_THREAD_COUNTS=[1, 2, 4, 8]
+TUNE_TOKEN_BUDGETS=[1024, 2048, 4096, 8192, 16384]
+TUNE_MAX_RSS_BYTES=None
+
+# Embedding storage, vectors go in one resizable (N, EMBEDDING_DIMENSION)
+# dataset. Use 'float16' to halve the file again, compression can be
+# None, 'lzf' or 'gzip'
+EMBEDDING_DIMENSION=768
+EMBEDDING_DTYPE='float32'
+EMBEDDING_CHUNK_ROWS=1024
+EMBEDDING_COMPRESSION=None
+
+# Sharding, each shard is parsed, deduplicated, embedded and loaded by its own
+# Luigi tasks. Shards hold a fixed number of extracted batches, SHARD_RECORDS over
+# the data source's batch_size, so SHARD_RECORDS is an upper bound. Shards whose
+# batches were closed early by batch_bytes hold fewer records. Chunk ids are numbered
+# from shard * SHARD_CHUNK_ID_STRIDE so that they are unique across shards
+SHARD_RECORDS=250000
+SHARD_CHUNK_ID_STRIDE=2**32
+SHARD_DIRECTORY='shards'
+
+# Luigi worker processes, and how many shards may run each kind of stage at once.
+# By default one shard can be parsed while another is embedded and a third loaded
+LUIGI_WORKERS=4
+LUIGI_RESOURCES={'cpu_pool': 1, 'gpu_workers': 1, 'opensearch': 1}
+
+# Near-duplicate detection, MinHash signatures of DEDUPLICATION_HASHES permutations
+# split into DEDUPLICATION_BANDS LSH bands. Chunks matching in any band are duplicate
+# candidates, 8 bands of 8 rows puts the threshold near 0.77 Jaccard similarity. Candidates
+# are duplicates if their signatures estimate at least DEDUPLICATION_THRESHOLD similarity.
+# Signatures need STORE_TOKEN_IDS, with DEDUPLICATION=False every chunk is embedded
+DEDUPLICATION=True
+DEDUPLICATION_HASHES=64
+DEDUPLICATION_BANDS=8
+DEDUPLICATION_SEED=42
+DEDUPLICATION_THRESHOLD=0.77
+DEDUPLICATION_GROUP_SIZE=256 # Chunks hashed at a time by each worker
+
+# Persistent embedding cache, shared across runs and data sources. Chunks are
+# keyed by a hash of their text, the embedding model name, MAX_TOKENS and the
+# embedding backend, with ONNX_QUANTIZE
+USE_EMBEDDING_CACHE=True
+EMBEDDING_CACHE_PATH=f'{DATA_PATH}/embedding_cache'
+EMBEDDING_CACHE_VECTORS='vectors.f32'
+EMBEDDING_CACHE_INDEX='index.sqlite'
+EMBEDDING_CACHE_QUERY_SIZE=500 # Keys per lookup query
+
+# OpenSearch cluster nodes, loader workers spread their connections across them
+OPENSEARCH_HOSTS=[{'host': 'localhost', 'port': 9200}]
+
 BULK_INSERT_BATCH_SIZE=128
+LOAD_WORKERS=4
+LOAD_CHECKPOINT_INTERVAL=10 # Seconds between saves of the load checkpoint
+
+# Rows per block read from the embedding file by the loader
+# and number of blocks its prefetch thread reads ahead
+VECTOR_READ_BLOCK_ROWS=16384
+VECTOR_PREFETCH_BLOCKS=2
+
+# Chunk ids per query when fetching search hit payloads from the side store
+SIDE_STORE_FETCH_SIZE=500
+
+# Number of hits returned by the semantic search tool
+SEARCH_RESULTS=10
+
+# Seconds to wait on a worker queue before checking that the worker processes
+# on the other end are still alive, so that a crashed worker fails its stage
+WORKER_POLL_SECONDS=5
+
+# Streaming mode parameters, batches allowed in flight per worker between stages
+STREAMING_BATCHES_IN_FLIGHT=2
+
+# Batch mode work queues, batches read ahead per worker while the extraction and parse
+# stages wait to save the next result in order. Extraction batches close at the data
+# source's batch_size records or once their records add up to batch_bytes, which
+# defaults to EXTRACTION_BATCH_BYTES. Extracted batches are split into parse tasks
+# of about PARSE_TASK_CHARACTERS characters of text
+DISPATCH_BATCHES_IN_FLIGHT=4
+EXTRACTION_BATCH_BYTES=128 * 1024**2
+PARSE_TASK_CHARACTERS=8000000
+
+# Hand batch mode extraction and parse batches, and their results, to and from the pool
+# workers through shared memory segments rather than pickling them through pipes
+SHARED_MEMORY_HANDOFF=True
+
+# Default CirrusSearch record field to extract article text from, 'source_text'
+# is wikicode which has to be stripped, 'text' is plain text already
+# rendered by CirrusSearch. Data source configurations can set their own text_source
+DEFAULT_TEXT_SOURCE='source_text'
+
+# Strip wikicode with the fast regex based stripper where it is safe to, pages it
+# can't handle still go to mwparserfromhell. False uses mwparserfromhell for everything
+FAST_WIKITEXT_STRIP=True
+
+# Per-article budgets in the extraction and parse workers. Articles which take longer
+# than WATCHDOG_TIME_LIMIT seconds, run a worker out of memory or are longer than
+# WATCHDOG_MAX_CHARACTERS are quarantined and, if WATCHDOG_RETRY is True, cleaned the
+# cheap way instead. The cheap parse path only chunks the first WATCHDOG_RETRY_CHARACTERS.
+# Memory limits are bytes each worker's address space may grow by past what it inherited
+# when forked, or None. The tokenizers abort rather than raise when they run out of memory,
+# so parse workers are not limited by default. A stage fails if the watchdog drops more
+# than WATCHDOG_MAX_DROPPED_FRACTION of its articles, the rest are in its quarantine file
+WATCHDOG_TIME_LIMIT=30
+WATCHDOG_MAX_CHARACTERS=2000000
+WATCHDOG_RETRY=True
+WATCHDOG_RETRY_CHARACTERS=100000
+WATCHDOG_EXTRACT_MEMORY_LIMIT=4 * 1024**3
+WATCHDOG_PARSE_MEMORY_LIMIT=None
+WATCHDOG_MAX_DROPPED_FRACTION=0.001
+WATCHDOG_SLOWEST_PAGES=20 # Number of slowest articles listed in each stage's summary
 
 # Default data source to process, can be overridden with command line argument
 DEFAULT_DATA_SOURCE='wikipedia'
@@ -36,13 +192,37 @@ WIKIPEDIA_ESTIMATED_CHUNK_COUNT=20648877
 # last completed task. Can be overridden with command line argument
 DEFAULT_FORCE_START='None'
 
+# Pipeline execution mode, 'batch' runs each task to completion before starting
+# the next, 'streaming' runs all stages concurrently. Can be overridden with
+# command line argument
+DEFAULT_MODE='batch'
+
 # Luigi task summary files
 EXTRACTION_SUMMARY='1.1-extraction_summary.json'
 PARSE_SUMMARY='2.1-parse_summary.json'
 EMBEDDING_SUMMARY='3.1-embedding_summary.json'
 LOAD_SUMMARY='4.1-load_summary.json'
+STREAMING_SUMMARY='5.1-streaming_summary.json'
+DEDUPLICATION_SUMMARY='2.4-deduplication_summary.json'
+INDEX_SUMMARY='4.0-index_summary.json'
+MERGED_SUMMARY='4.3-merged_summary.json'
+
+# Results queued for each stage's hdf5 writer thread, two is double buffering
+HDF5_WRITER_QUEUE_SIZE=2
+
+# Format of the extracted and parsed text files, 'hdf5' or 'arrow'. Arrow files hold
+# one record batch per stage batch and are memory mapped by their readers, parse and
+# deduplication workers are only sent the rows to read. Arrow needs pyarrow
+INTERMEDIATE_FORMAT='hdf5'
 
 # Intermediate data files
 EXTRACTED_TEXT='1.2-extracted_text.h5'
+EXTRACTED_TEXT_ARROW='1.2-extracted_text.arrow'
+EXTRACTION_QUARANTINE='1.3-extraction_quarantine.jsonl'
 PARSED_TEXT='2.2-parsed_text.h5'
+PARSED_TEXT_ARROW='2.2-parsed_text.arrow'
+SIDE_STORE='2.3-chunk_store.sqlite'
+CHUNK_REPRESENTATIVES='2.5-chunk_representatives.h5'
+PARSE_QUARANTINE='2.6-parse_quarantine.jsonl'
 EMBEDDED_TEXT='3.2-embedded_data.h5'
+LOAD_CHECKPOINT='4.2-load_checkpoint.json'
@@ -15,6 +15,26 @@ def parse_arguments() -> argparse.Namespace:
         formatter_class=lambda prog: argparse.HelpFormatter(prog,max_help_position=80)
     )
 
+    # Argument to choose between building the index, searching it
+    # and tuning the embedding workers on its parsed text
+    parser.add_argument(
+        '--task',
+        required=False,
+        choices=['pipeline', 'search', 'tune'],
+        default='pipeline',
+        help='task to run: [pipeline, search, tune]',
+        metavar='TASK'
+    )
+
+    # Argument to specify the query for the search task
+    parser.add_argument(
+        '--query',
+        required=False,
+        default=None,
+        help='query string for the search task',
+        metavar='QUERY'
+    )
+
     # Argument to specify the data source to process
     parser.add_argument(
         '--data_source',
@@ -33,6 +53,30 @@ def parse_arguments() -> argparse.Namespace:
         metavar='DATA_SOURCE'
     )
 
+    # Argument to choose between batch and streaming pipeline execution
+    parser.add_argument(
+        '--mode',
+        required=False,
+        choices=['batch', 'streaming'],
+        default=config.DEFAULT_MODE,
+        help='pipeline execution mode: [batch, streaming]',
+        metavar='MODE'
+    )
+
+    # Argument to save intermediate files as checkpoints in streaming mode
+    parser.add_argument(
+        '--checkpoints',
+        required=False,
+        choices=['True', 'False'],
+        default='False',
+        help='save intermediate hdf5 files in streaming mode: [True, False]',
+        metavar='CHECKPOINTS'
+    )
+
     args=parser.parse_args()
 
+    # The search task has nothing to do without a query
+    if args.task == 'search' and (args.query is None or args.query.strip() == ''):
+        parser.error('--query is required for --task search')
+
     return args
\ No newline at end of file
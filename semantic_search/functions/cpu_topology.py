@@ -0,0 +1,162 @@
+'''CPU topology planning for embedding workers running on the CPU. Reads the host's
+physical cores and NUMA nodes, splits the cores into one group per worker and pins
+each worker to its group, with its thread pools sized to the group's physical cores,
+so that the workers don't oversubscribe the machine or fight over the same cores.'''
+
+# Standard imports
+import os
+import pathlib
+
+# PyPI imports, threadpoolctl is optional
+try:
+    from threadpoolctl import threadpool_limits # pylint: disable = import-error
+    THREADPOOLCTL_AVAILABLE=True
+
+except ImportError:
+    THREADPOOLCTL_AVAILABLE=False
+
+# Environment variables read by the OpenMP and BLAS thread pools
+THREAD_VARIABLES=['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+
+def parse_cpu_list(cpu_list: str) -> list:
+    '''Takes a sysfs CPU list, e.g. 0-3,8-11, returns list of CPU numbers.'''
+
+    cpus=[]
+
+    for cpu_range in cpu_list.strip().split(','):
+
+        if cpu_range == '':
+            continue
+
+        first, _, last=cpu_range.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+
+    return cpus
+
+
+def read_topology() -> list:
+    '''Returns the physical cores this process may run on, as a list of dictionaries
+    of each core's NUMA node and logical CPUs, sorted by node. Read from sysfs, where
+    there is no sysfs every logical CPU is taken to be a core on node 0.'''
+
+    if hasattr(os, 'sched_getaffinity'):
+        available=sorted(os.sched_getaffinity(0))
+
+    else:
+        available=list(range(os.cpu_count()))
+
+    # NUMA node of each logical CPU
+    cpu_nodes={}
+
+    for node_path in pathlib.Path('/sys/devices/system/node').glob('node[0-9]*'):
+        for cpu in parse_cpu_list((node_path / 'cpulist').read_text()):
+            cpu_nodes[cpu]=int(node_path.name.removeprefix('node'))
+
+    # Group the logical CPUs by the physical core they are threads of
+    cores={}
+
+    for cpu in available:
+
+        topology_path=pathlib.Path(f'/sys/devices/system/cpu/cpu{cpu}/topology')
+
+        try:
+            core_key=(
+                int((topology_path / 'physical_package_id').read_text()),
+                int((topology_path / 'core_id').read_text())
+            )
+
+        except (OSError, ValueError):
+            core_key=(0, cpu)
+
+        cores.setdefault(core_key, []).append(cpu)
+
+    return sorted(
+        ({'node': cpu_nodes.get(cpus[0], 0), 'cpus': cpus} for cpus in cores.values()),
+        key=lambda core: (core['node'], core['cpus'][0])
+    )
+
+
+def split_cores(cores: list, n_groups: int) -> list:
+    '''Splits list of cores into n_groups contiguous groups of as equal size as possible.'''
+
+    bounds=[round(i * len(cores) / n_groups) for i in range(n_groups + 1)]
+
+    return [cores[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def plan_workers(cores: list, n_workers: int, threads: int = None) -> list:
+    '''Takes list of cores from read_topology, splits them between n_workers workers,
+    at most one per core. Workers are shared out between the NUMA nodes in proportion
+    to their cores, so that no worker spans two nodes unless there are fewer workers
+    than nodes. Each worker keeps at most threads of its group's cores, if given.
+    Returns list of worker placements, i.e. dictionaries of the worker's NUMA nodes,
+    logical CPUs and thread count, one thread per physical core.'''
+
+    n_workers=max(min(n_workers, len(cores)), 1)
+
+    # Cores on each node
+    node_cores={}
+
+    for core in cores:
+        node_cores.setdefault(core['node'], []).append(core)
+
+    # Fewer workers than nodes, split the cores in node order
+    if n_workers < len(node_cores):
+        groups=split_cores(cores, n_workers)
+
+    else:
+
+        # Each node's share of the workers, rounded down but at least one,
+        # then the remaining workers go to the nodes that were rounded down most
+        shares={node: n_workers * len(node_core_list) / len(cores) for node, node_core_list in node_cores.items()}
+        counts={node: max(int(share), 1) for node, share in shares.items()}
+
+        while sum(counts.values()) < n_workers:
+            node=max(
+                (node for node in counts if counts[node] < len(node_cores[node])),
+                key=lambda node: shares[node] - counts[node]
+            )
+            counts[node]+=1
+
+        # Rounding up nodes to one worker can leave one too many, every
+        # node keeps at least one since there are no fewer workers than nodes
+        while sum(counts.values()) > n_workers:
+            node=max(
+                (node for node in counts if counts[node] > 1),
+                key=lambda node: counts[node] - shares[node]
+            )
+            counts[node]-=1
+
+        groups=[]
+
+        for node, node_core_list in node_cores.items():
+            groups.extend(split_cores(node_core_list, counts[node]))
+
+    if threads is not None:
+        groups=[group[:threads] for group in groups]
+
+    return [
+        {
+            'nodes': sorted({core['node'] for core in group}),
+            'cpus': sorted(cpu for core in group for cpu in core['cpus']),
+            'threads': len(group)
+        }
+        for group in groups
+    ]
+
+
+def pin_worker(placement: dict) -> None:
+    '''Pins the calling process to the placement's logical CPUs and limits
+    its OpenMP and BLAS thread pools to the placement's thread count. Torch
+    and ONNX Runtime threads are set when the model is loaded.'''
+
+    for variable in THREAD_VARIABLES:
+        os.environ[variable]=str(placement['threads'])
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, placement['cpus'])
+
+    # Thread pools which were started before the variables were set
+    if THREADPOOLCTL_AVAILABLE is True:
+        threadpool_limits(placement['threads'])
@@ -0,0 +1,172 @@
+'''Functions for near-duplicate chunk detection. MinHash signatures are computed
+from token 4-gram shingles with numpy, one parsed batch at a time, and clustered
+with LSH banding. Chunks which share a band are only clustered together once their
+signatures show them to be similar to the cluster's representative, so that only one
+chunk per cluster has to be embedded.'''
+
+# PyPI imports
+import numpy as np
+
+# Internal imports
+import semantic_search.configuration as config
+import semantic_search.functions.intermediate as intermediate
+
+# Multiply-shift hash parameters for the MinHash permutations, fixed so
+# that signatures are comparable between batches, workers and runs
+_rng=np.random.default_rng(config.DEDUPLICATION_SEED)
+HASH_MULTIPLIERS=_rng.integers(1, 2**63, size=config.DEDUPLICATION_HASHES, dtype=np.uint64) * 2 + 1
+HASH_OFFSETS=_rng.integers(0, 2**63, size=config.DEDUPLICATION_HASHES, dtype=np.uint64)
+
+# Odd constant for folding each band's rows into one hash
+BAND_PRIME=np.uint64(0x9E3779B97F4A7C15)
+
+# Signature value for chunks too short to have any shingles
+NO_SHINGLES=np.iinfo(np.uint32).max
+
+def compute_band_hashes(batch: tuple) -> tuple:
+    '''Takes a parsed batch's flat token id array and chunk offsets, or a range
+    descriptor of them in an Arrow file, returns (band hashes, signatures, has shingles)
+    arrays with one row per chunk. Chunks are worked through in groups to keep the
+    shingle by hash matrix small.'''
+
+    # Read the token ids a range descriptor points to straight from the file
+    if isinstance(batch, dict):
+        batch=intermediate.read_token_id_range(batch)
+
+    token_ids, token_offsets=batch
+
+    band_hashes=np.empty((len(token_offsets) - 1, config.DEDUPLICATION_BANDS), dtype=np.uint64)
+    all_signatures=np.empty((len(token_offsets) - 1, config.DEDUPLICATION_HASHES), dtype=np.uint32)
+    has_shingles=np.empty(len(token_offsets) - 1, dtype=bool)
+
+    for start in range(0, len(token_offsets) - 1, config.DEDUPLICATION_GROUP_SIZE):
+
+        end=min(start + config.DEDUPLICATION_GROUP_SIZE, len(token_offsets) - 1)
+
+        signatures=minhash_signatures(
+            token_ids[token_offsets[start]:token_offsets[end]],
+            token_offsets[start:end + 1] - token_offsets[start]
+        )
+
+        band_hashes[start:end]=fold_bands(signatures)
+        all_signatures[start:end]=signatures
+        has_shingles[start:end]=signatures[:, 0] != NO_SHINGLES
+
+    return band_hashes, all_signatures, has_shingles
+
+
+def minhash_signatures(token_ids: np.ndarray, token_offsets: np.ndarray) -> np.ndarray:
+    '''Takes flat token id array and chunk offsets, returns uint32 MinHash
+    signature matrix with one row per chunk. Shingles are four consecutive
+    token ids, which pack exactly into one uint64 for uint16 token ids.'''
+
+    n_chunks=len(token_offsets) - 1
+
+    # Chunk number of each token, ignoring the special tokens at either end of each chunk
+    chunk_nums=np.repeat(np.arange(n_chunks), np.diff(token_offsets))
+    inner=np.ones(len(token_ids), dtype=bool)
+    inner[token_offsets[:-1]]=False
+    inner[np.maximum(token_offsets[1:] - 1, 0)]=False
+
+    tokens=token_ids[inner].astype(np.uint64)
+    chunk_nums=chunk_nums[inner]
+
+    # Signatures for chunks with no shingles are left at the marker value
+    signatures=np.full((n_chunks, config.DEDUPLICATION_HASHES), NO_SHINGLES, dtype=np.uint32)
+
+    if len(tokens) < 4:
+        return signatures
+
+    # Pack each run of four tokens into one shingle, keeping only runs inside one chunk
+    shingles=(
+        (tokens[:-3] << np.uint64(48)) |
+        (tokens[1:-2] << np.uint64(32)) |
+        (tokens[2:-1] << np.uint64(16)) |
+        tokens[3:]
+    )
+
+    valid=chunk_nums[:-3] == chunk_nums[3:]
+    shingles=shingles[valid]
+    shingle_chunks=chunk_nums[:-3][valid]
+
+    if len(shingles) == 0:
+        return signatures
+
+    # Hash every shingle with every permutation, the high 32 bits of the multiply-shift
+    # hash are the well mixed ones. Integer overflow wraps, which is what we want.
+    with np.errstate(over='ignore'):
+        hashes=(shingles[:, None] * HASH_MULTIPLIERS[None, :] + HASH_OFFSETS[None, :]) >> np.uint64(32)
+
+    # Shingles are in chunk order, so the minimum of each chunk's run of rows is its signature
+    chunk_starts=np.flatnonzero(np.r_[True, shingle_chunks[1:] != shingle_chunks[:-1]])
+    signatures[shingle_chunks[chunk_starts]]=np.minimum.reduceat(hashes, chunk_starts, axis=0).astype(np.uint32)
+
+    return signatures
+
+
+def fold_bands(signatures: np.ndarray) -> np.ndarray:
+    '''Takes MinHash signature matrix, folds each band of rows
+    into a single uint64 hash. Returns chunks by bands array.'''
+
+    bands=signatures.reshape(len(signatures), config.DEDUPLICATION_BANDS, -1).astype(np.uint64)
+    band_hashes=np.zeros(bands.shape[:2], dtype=np.uint64)
+
+    with np.errstate(over='ignore'):
+        for row in range(bands.shape[2]):
+            band_hashes=band_hashes * BAND_PRIME + bands[:, :, row]
+
+    return band_hashes
+
+
+def find_representatives(band_hashes: np.ndarray, signatures: np.ndarray, has_shingles: np.ndarray) -> np.ndarray:
+    '''Takes chunks by bands hash array and MinHash signature matrix, returns array with
+    the representative chunk id for each chunk. Each chunk is compared to the lowest chunk
+    id it shares a band with and joins its cluster if their estimated Jaccard similarity,
+    the fraction of equal signature values, is at least DEDUPLICATION_THRESHOLD. A chunk
+    whose match is itself a duplicate is compared again with that chunk's representative,
+    and becomes a representative itself if it isn't similar enough, so that clusters don't
+    chain together chunks which have little in common.'''
+
+    labels=np.arange(len(band_hashes), dtype=np.int64)
+    candidates=np.flatnonzero(has_shingles)
+
+    # Candidate pairs, each chunk with the first chunk of its run of equal hashes in
+    # each band. Sorting is stable and candidates are in order, so that is the lowest id
+    matches=np.full(len(band_hashes), len(band_hashes), dtype=np.int64)
+
+    for band in range(band_hashes.shape[1]):
+
+        order=candidates[np.argsort(band_hashes[candidates, band], kind='stable')]
+        sorted_hashes=band_hashes[order, band]
+
+        run_starts=np.flatnonzero(np.r_[True, sorted_hashes[1:] != sorted_hashes[:-1]])
+        run_heads=np.repeat(order[run_starts], np.diff(np.r_[run_starts, len(order)]))
+
+        # Keep the pairs which pass verification, the lowest matching id over the bands
+        paired=run_heads != order
+        verified=similar(signatures, order[paired], run_heads[paired])
+        np.minimum.at(matches, order[paired][verified], run_heads[paired][verified])
+
+    matched=matches < len(band_hashes)
+    labels[matched]=matches[matched]
+
+    # Point chunks whose match is a duplicate at its representative, if
+    # they are similar to it, otherwise make them representatives
+    chained=np.flatnonzero(labels[labels] != labels)
+
+    while len(chained) > 0:
+
+        roots=labels[labels[chained]]
+        labels[chained]=np.where(similar(signatures, chained, roots), roots, chained)
+        chained=np.flatnonzero(labels[labels] != labels)
+
+    return labels
+
+
+def similar(signatures: np.ndarray, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    '''Takes MinHash signature matrix and two arrays of chunk ids, returns boolean array,
+    True where the pair's estimated Jaccard similarity is at least DEDUPLICATION_THRESHOLD.'''
+
+    agreement=np.mean(signatures[first] == signatures[second], axis=1)
+
+    return agreement >= config.DEDUPLICATION_THRESHOLD
@@ -0,0 +1,161 @@
+'''Helpers for running a stage's batches through a worker pool as a dynamic work
+queue. Each worker takes the next batch as soon as it finishes the last one, instead
+of waiting for a round of batches to finish, and the time every task takes is
+tracked so the stage summaries can report how busy the workers were kept. Tasks
+are submitted from the thread which takes the results, never from the pool's own
+task handler thread, so that a failed task can't leave that thread waiting for a
+free slot and the pool can always be terminated.'''
+
+# Standard imports
+import time
+import queue
+import threading
+import itertools
+import collections
+
+# Internal imports
+import semantic_search.configuration as config
+
+def windowed_imap(pool, function, tasks, window: int):
+    '''Yields function's result for each task from the pool, in task order. At most
+    window tasks are submitted ahead of the result being taken, the next task is
+    submitted as each result is taken. Raises the task's error if a task fails.'''
+
+    tasks=iter(tasks)
+    pending=collections.deque(pool.apply_async(function, (task,)) for task in itertools.islice(tasks, window))
+
+    while len(pending) > 0:
+
+        result=pending.popleft().get()
+
+        for task in itertools.islice(tasks, 1):
+            pending.append(pool.apply_async(function, (task,)))
+
+        yield result
+
+
+def windowed_imap_unordered(pool, function, tasks, window: int, stop: threading.Event = None):
+    '''Same as windowed_imap, but yields the results in the order they finish. The
+    next task is submitted once the consumer comes back for the next result, so that
+    a result isn't held back while the tasks iterable waits on an upstream stage.
+    Returns early once stop is set, e.g. when the pool has been terminated and the
+    outstanding results will never arrive.'''
+
+    tasks=iter(tasks)
+    finished=queue.Queue()
+
+    def submit(task):
+        pool.apply_async(
+            function,
+            (task,),
+            callback=lambda result: finished.put((True, result)),
+            error_callback=lambda error: finished.put((False, error))
+        )
+
+    pending=0
+
+    for task in itertools.islice(tasks, window):
+        submit(task)
+        pending+=1
+
+    while pending > 0:
+
+        try:
+            succeeded, result=finished.get(timeout=config.WORKER_POLL_SECONDS)
+
+        except queue.Empty:
+            if stop is not None and stop.is_set() is True:
+                return
+
+            continue
+
+        pending-=1
+
+        if succeeded is False:
+            raise result
+
+        yield result
+
+        for task in itertools.islice(tasks, 1):
+            submit(task)
+            pending+=1
+
+
+def timed_call(function, task):
+    '''Worker side wrapper, returns function's result for task along with
+    the time it took, for the utilization report.'''
+
+    start_time=time.time()
+    result=function(task)
+
+    return result, time.time() - start_time
+
+
+def new_tracker() -> dict:
+    '''Returns an empty worker utilization tracker.'''
+
+    return {'tasks': 0, 'busy_seconds': 0.0, 'max_task_seconds': 0.0}
+
+
+def record_task(tracker: dict, seconds: float) -> None:
+    '''Adds a finished task's time to the tracker.'''
+
+    tracker['tasks']+=1
+    tracker['busy_seconds']+=seconds
+    tracker['max_task_seconds']=max(tracker['max_task_seconds'], seconds)
+
+
+def summarize(tracker: dict, n_workers: int, run_time: float) -> dict:
+    '''Returns dictionary of worker utilization results for a stage's summary.
+    Utilization is the fraction of the workers' time spent on tasks.'''
+
+    available_seconds=n_workers * run_time
+
+    return {
+        'worker_tasks': tracker['tasks'],
+        'worker_busy_seconds': tracker['busy_seconds'],
+        'worker_idle_seconds': max(available_seconds - tracker['busy_seconds'], 0),
+        'worker_utilization': tracker['busy_seconds'] / max(available_seconds, 1e-9),
+        'mean_task_seconds': tracker['busy_seconds'] / max(tracker['tasks'], 1),
+        'max_task_seconds': tracker['max_task_seconds']
+    }
+
+
+def check_workers(workers: list) -> None:
+    '''Raises if any of the worker processes exited with an error.'''
+
+    for worker in workers:
+        if worker.exitcode is not None and worker.exitcode != 0:
+            raise RuntimeError(f'Worker process {worker.name} exited with code {worker.exitcode}')
+
+
+def put_checked(work_queue, item, workers: list) -> None:
+    '''Puts item on a queue read by the worker processes, checking while the
+    queue is full that the workers are still alive. Raises if one has failed or
+    none are left to read the queue.'''
+
+    while True:
+
+        try:
+            work_queue.put(item, timeout=config.WORKER_POLL_SECONDS)
+            return
+
+        except queue.Full:
+            check_workers(workers)
+
+            if not any(worker.is_alive() for worker in workers):
+                raise RuntimeError('No worker processes left to take work from the queue') # pylint: disable = raise-missing-from
+
+
+def get_checked(result_queue, workers: list):
+    '''Gets the next item from a queue written by the worker processes,
+    checking while it is empty that the workers are still alive. Raises
+    if one has failed.'''
+
+    while True:
+
+        try:
+            return result_queue.get(timeout=config.WORKER_POLL_SECONDS)
+
+        except queue.Empty:
+            check_workers(workers)
@@ -1,87 +1,446 @@
 '''Functions to embed text for indexing into KNN index.'''
 
 # Standard imports
+import time
+import resource
 import multiprocessing as mp
 
 # PyPI imports
 import h5py
+import numpy as np
 import torch
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer, AutoModel, BatchEncoding
 
 # Internal imports
 import semantic_search.configuration as config
+import semantic_search.functions.onnx_backend as onnx_backend
+import semantic_search.functions.cpu_topology as cpu_topology
+import semantic_search.functions.dispatch as dispatch
 
-def submit_batches(
-    n_workers: int,
-    batches: list,
-    output_batch_group: h5py._hl.group.Group,
-    batch_count: int
-) -> int:
+def start_workers(
+    devices: list,
+    input_queue: mp.Queue,
+    output_queue: mp.Queue,
+    placements: list = None,
+    barrier=None
+) -> list:
 
-    '''Takes batches list and current batch count, submits batches to worker pool for embedding.
-    Returns updated batch count after receiving and saving worker results.'''
+    '''Starts one long-lived embedding worker process for each device string,
+    pinned to the CPUs of its placement from plan_cpu_workers if given. Workers
+    wait at barrier, if given, once their models are loaded. Returns list of
+    worker processes.'''
 
-    # Holder for results from workers
-    worker_results=[]
+    # ONNX workers load the exported model, export it once here
+    # rather than have every worker race to do it
+    if config.EMBEDDING_BACKEND == 'onnx':
+        onnx_backend.prepare_model(config.ONNX_QUANTIZE)
 
-    # Start the pool
-    pool=mp.Pool(processes=n_workers)
+    # Holder for worker processes
+    workers=[]
 
-    # Holder for results from workers
-    worker_results=[]
+    # Start a worker for each device
+    for worker_num, device in enumerate(devices):
 
-    # Submit each batch to a worker
-    for batch, gpu in zip(batches, config.WORKER_GPUS):
-        worker_result=pool.apply_async(calculate_embeddings, (batch,gpu,))
-        worker_results.append(worker_result)
+        worker=mp.Process(
+            target=embedding_worker,
+            args=(
+                device,
+                input_queue,
+                output_queue,
+                placements[worker_num] if placements is not None else None,
+                barrier
+            )
+        )
 
-    # Collect the results from the workers
-    results=[worker_result.get() for worker_result in worker_results]
+        worker.start()
+        workers.append(worker)
 
-    # Save each result as a batch in the hdf5 file
-    for result in results:
-        output_batch_group.create_dataset(str(batch_count), data=result)
-        batch_count+=1
+    return workers
 
-    return batch_count
 
-def calculate_embeddings(batch: list, gpu: str) -> list:
-    '''Takes batch of text and gpu identifier, calculates and
-    returns text embeddings.'''
+def worker_devices() -> list:
+    '''Returns the device string of each embedding worker, the configured GPUs
+    for the torch backend, or ONNX_WORKERS CPU workers for the ONNX backend.'''
 
-    # Load the model and tokenizer
+    if config.EMBEDDING_BACKEND == 'onnx':
+        return ['cpu'] * config.ONNX_WORKERS
+
+    return config.WORKER_GPUS
+
+
+def plan_cpu_workers(n_workers: int, sample: list = None) -> tuple:
+    '''Splits the host's cores between CPU embedding workers. Given a sample of chunk
+    texts or token ids and with CPU_TOPOLOGY_CALIBRATE, the number of workers is the
+    CPU_TOPOLOGY_CANDIDATES count with the highest measured throughput, otherwise it
+    is n_workers. Returns list of worker placements and dictionary of the topology,
+    layout and calibration results for the embedding summary.'''
+
+    cores=cpu_topology.read_topology()
+
+    topology_summary={
+        'cpu_physical_cores': len(cores),
+        'cpu_logical_cpus': sum(len(core['cpus']) for core in cores),
+        'cpu_numa_nodes': len({core['node'] for core in cores})
+    }
+
+    if sample is not None and config.CPU_TOPOLOGY_CALIBRATE is True:
+
+        calibration=[]
+
+        for candidate in sorted({min(count, len(cores)) for count in config.CPU_TOPOLOGY_CANDIDATES}):
+
+            placements=cpu_topology.plan_workers(cores, candidate, config.CPU_THREADS_PER_WORKER)
+
+            # Scaling efficiency compares the workers' throughput running together with
+            # that of the same number of workers which each have the machine to themselves
+            alone_rate=measure_workers(['cpu'], placements[:1], sample, config.CPU_CALIBRATION_ROUNDS)['steady_state_embedding_rate']
+
+            if candidate == 1:
+                rate=alone_rate
+
+            else:
+                rate=measure_workers(
+                    ['cpu'] * candidate,
+                    placements,
+                    sample,
+                    config.CPU_CALIBRATION_ROUNDS
+                )['steady_state_embedding_rate']
+
+            calibration.append({
+                'workers': candidate,
+                'threads_per_worker': [placement['threads'] for placement in placements],
+                'embedding_rate': rate,
+                'scaling_efficiency': rate / (candidate * alone_rate)
+            })
+
+        best=max(calibration, key=lambda result: result['embedding_rate'])
+        n_workers=best['workers']
+
+        topology_summary['cpu_calibration']=calibration
+        topology_summary['scaling_efficiency']=best['scaling_efficiency']
+
+    placements=cpu_topology.plan_workers(cores, n_workers, config.CPU_THREADS_PER_WORKER)
+    topology_summary['cpu_worker_layout']=placements
+
+    return placements, topology_summary
+
+
+def measure_workers(devices: list, placements: list, sample: list, rounds: int) -> dict:
+    '''Runs a worker for each device, pinned to its placement if placements are given,
+    on rounds copies of sample each. Returns summarize_workers' summary of the run. The
+    workers wait for each other to load their models so that they are measured running
+    together.'''
+
+    input_queue=mp.Queue()
+    output_queue=mp.Queue()
+
+    workers=start_workers(
+        devices,
+        input_queue,
+        output_queue,
+        placements,
+        mp.Barrier(len(devices))
+    )
+
+    for _ in range(len(devices) * rounds):
+        input_queue.put((None, sample))
+
+    for _ in workers:
+        input_queue.put('done')
+
+    # Throw away the embeddings, keep the worker summaries
+    worker_summaries=[]
+
+    try:
+
+        while len(worker_summaries) < len(workers):
+
+            batch_id, result=dispatch.get_checked(output_queue, workers)
+
+            if batch_id == 'done':
+                worker_summaries.append(result)
+
+    # Stop the rest if a worker failed, e.g. ran out of memory
+    except BaseException:
+
+        for worker in workers:
+            if worker.is_alive() is True:
+                worker.terminate()
+
+        raise
+
+    for worker in workers:
+        worker.join()
+
+    return summarize_workers(worker_summaries)
+
+
+def embedding_worker(
+    device: str,
+    input_queue: mp.Queue,
+    output_queue: mp.Queue,
+    placement: dict = None,
+    barrier=None
+) -> None:
+
+    '''Loads tokenizer and model once, then takes batches of text from the input
+    queue and puts their embeddings on the output queue, along with the batch's
+    id, until done is received. Sends run statistics for this worker with its own
+    done signal on exit.'''
+
+    # Pin CPU workers to their cores, before any thread pools are started
+    threads=None
+
+    if placement is not None:
+        cpu_topology.pin_worker(placement)
+        threads=placement['threads']
+
+    # Load the model and tokenizer, timing it
+    start_time=time.time()
+    tokenizer, model=load_model(device, threads)
+
+    # Wait for the other workers, so that they all start together
+    if barrier is not None:
+        barrier.wait()
+
+    ready_time=time.time()
+
+    # Counters for this worker's run statistics
+    embedded_texts=0
+    real_tokens=0
+    padded_tokens=0
+    compute_time=0
+
+    # Loop until we receive done from the main process
+    while True:
+
+        # Get a batch of text from the queue
+        work=input_queue.get()
+
+        if work == 'done':
+            break
+
+        batch_id, batch=work
+
+        # Embed the batch and send it back with its id
+        batch_start_time=time.time()
+        result, batch_real_tokens, batch_padded_tokens=calculate_embeddings(batch, tokenizer, model, device)
+        compute_time+=time.time() - batch_start_time
+
+        output_queue.put((batch_id, result))
+        embedded_texts+=len(batch)
+        real_tokens+=batch_real_tokens
+        padded_tokens+=batch_padded_tokens
+
+    # Tell the main process we are done and how it went
+    worker_summary={
+        'device': device,
+        'cpus': placement['cpus'] if placement is not None else None,
+        'model_load_time_seconds': ready_time - start_time,
+        'embedded_texts': embedded_texts,
+        'real_tokens': real_tokens,
+        'padded_tokens': padded_tokens,
+        'compute_time_seconds': compute_time,
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'ready_time': ready_time,
+        'finish_time': time.time()
+    }
+
+    output_queue.put(('done', worker_summary))
+
+
+def load_model(device: str, threads: int = None) -> tuple:
+    '''Takes device string, loads tokenizer and model onto that device.
+    CPU workers are limited to threads, or by default the configured number
+    of torch threads. With the ONNX backend, the model is an ONNX Runtime
+    session instead.'''
+
+    # Load the tokenizer, the same one for either backend
     tokenizer=AutoTokenizer.from_pretrained(config.EMBEDDING_MODEL)
-    model=AutoModel.from_pretrained(config.EMBEDDING_MODEL, device_map=gpu)
 
-    result=[]
+    if config.EMBEDDING_BACKEND == 'onnx':
+        return tokenizer, onnx_backend.load_session(onnx_backend.prepare_model(config.ONNX_QUANTIZE), threads)
+
+    # Keep CPU workers from fighting over every core on the machine
+    if device == 'cpu':
+        torch.set_num_threads(threads if threads is not None else config.CPU_WORKER_THREADS)
+
+    # Load the model
+    model=AutoModel.from_pretrained(config.EMBEDDING_MODEL, device_map=device)
+    model.eval()
+
+    return tokenizer, model
+
+
+def calculate_embeddings(batch: list, tokenizer, model, device: str) -> tuple:
+    '''Takes batch of text or of chunk token ids from the parse step, pre-loaded
+    tokenizer and model and device identifier, calculates text embeddings. Texts are
+    sorted by token length and grouped into model batches by token budget to keep
+    padding to a minimum. Returns embeddings as a float32 array in the original order
+    along with real and padded token counts.'''
+
+    # Tokenize the whole batch once, without padding, unless
+    # we already have the token ids from the parse step
+    if isinstance(batch[0], str):
+        input_ids=tokenizer(batch, truncation=True)['input_ids']
+
+    else:
+        input_ids=batch
+
+    # Holder for results, filled in by original position
+    result=np.empty((len(batch), config.EMBEDDING_DIMENSION), dtype=np.float32)
+
+    # Token counters for the padding ratio
+    real_tokens=0
+    padded_tokens=0
+
+    # Loop on model batches of similar length texts
+    for indices in yield_token_budget_batches(input_ids):
+
+        # Pad this model batch to its longest member
+        encoded_input=pad_batch(
+            [input_ids[i] for i in indices],
+            tokenizer.pad_token_id
+        )
+
+        # ONNX Runtime sessions take the padded batch as numpy arrays
+        if config.EMBEDDING_BACKEND == 'onnx':
+            embeddings=onnx_backend.run_model(
+                model,
+                encoded_input['input_ids'].numpy(),
+                encoded_input['attention_mask'].numpy()
+            )
+
+        else:
+
+            # Compute token embeddings
+            encoded_input=encoded_input.to(device)
+
+            with torch.no_grad():
+                model_output=model(**encoded_input, return_dict=True)
+
+            # Perform pooling
+            embeddings=model_output.last_hidden_state[:,0].float().cpu().numpy()
+
+        # Put each result back where its text came from
+        result[indices]=embeddings
+
+        real_tokens+=int(encoded_input['attention_mask'].sum())
+        padded_tokens+=encoded_input['attention_mask'].numel()
+
+    return result, real_tokens, padded_tokens
+
+
+def create_output(output: h5py.File) -> None:
+    '''Creates the resizable embedding dataset and the chunk id dataset which
+    links each of its rows back to a parsed chunk.'''
+
+    output.create_dataset(
+        'embeddings',
+        shape=(0, config.EMBEDDING_DIMENSION),
+        maxshape=(None, config.EMBEDDING_DIMENSION),
+        dtype=config.EMBEDDING_DTYPE,
+        chunks=(config.EMBEDDING_CHUNK_ROWS, config.EMBEDDING_DIMENSION),
+        compression=config.EMBEDDING_COMPRESSION
+    )
+
+    output.create_dataset(
+        'chunk_ids',
+        shape=(0,),
+        maxshape=(None,),
+        dtype=np.int64,
+        chunks=(config.EMBEDDING_CHUNK_ROWS,)
+    )
+
+
+def save_embeddings(output: h5py.File, chunk_ids: np.ndarray, embeddings: np.ndarray) -> None:
+    '''Appends a batch of embeddings and their chunk ids to the output datasets.'''
+
+    start=output['embeddings'].shape[0]
+    end=start + len(embeddings)
+
+    output['embeddings'].resize(end, axis=0)
+    output['embeddings'][start:end]=embeddings
+
+    output['chunk_ids'].resize(end, axis=0)
+    output['chunk_ids'][start:end]=chunk_ids
+
+
+def pad_batch(input_ids: list, pad_token_id: int) -> BatchEncoding:
+    '''Takes list of token id sequences, builds padded input id
+    and attention mask tensors directly from them.'''
+
+    padded_length=max(len(ids) for ids in input_ids)
+
+    padded_ids=torch.full((len(input_ids), padded_length), pad_token_id, dtype=torch.long)
+    attention_mask=torch.zeros((len(input_ids), padded_length), dtype=torch.long)
+
+    for i, ids in enumerate(input_ids):
+        padded_ids[i, :len(ids)]=torch.as_tensor(np.asarray(ids, dtype=np.int64))
+        attention_mask[i, :len(ids)]=1
+
+    return BatchEncoding({'input_ids': padded_ids, 'attention_mask': attention_mask})
+
+
+def summarize_workers(worker_summaries: list) -> dict:
+    '''Takes list of per worker run statistics, returns model load
+    and steady state throughput numbers for the embedding summary.'''
+
+    # Steady state rates are the sum of each worker's rate after its model was loaded
+    steady_state_rate=0
+    token_rate=0
+
+    # Token totals for padding ratio
+    real_tokens=0
+    padded_tokens=0
+
+    for worker_summary in worker_summaries:
+        run_time=worker_summary['finish_time'] - worker_summary['ready_time']
+
+        if run_time > 0:
+            steady_state_rate+=worker_summary['embedded_texts'] / run_time
+            token_rate+=worker_summary['real_tokens'] / run_time
+
+        real_tokens+=worker_summary['real_tokens']
+        padded_tokens+=worker_summary['padded_tokens']
+
+    load_times=[worker_summary['model_load_time_seconds'] for worker_summary in worker_summaries]
+
+    summary={
+        'max_model_load_time_seconds': max(load_times, default=0),
+        'mean_model_load_time_seconds': sum(load_times) / max(len(load_times), 1),
+        'steady_state_embedding_rate': steady_state_rate,
+        'steady_state_token_rate': token_rate,
+        'embedding_token_budget': config.EMBEDDING_TOKEN_BUDGET,
+        'padding_ratio': (padded_tokens - real_tokens) / max(padded_tokens, 1),
+        'total_peak_rss_bytes': sum(worker_summary['peak_rss_bytes'] for worker_summary in worker_summaries),
+        'worker_summaries': worker_summaries
+    }
+
+    return summary
 
-    # Loop on aggregate batch by generating chunks of EMBEDDING_BATCH_SIZE
-    for text in yield_batches(batch):
 
-        # Tokenize the texts
-        encoded_input=tokenizer(
-            text,
-            padding=True,
-            truncation=True,
-            return_tensors='pt'
-        ).to(gpu)
+def yield_token_budget_batches(input_ids: list):
+    '''Takes list of token id lists, yields lists of indices into it. Indices are
+    sorted by token count and each list holds as many texts as fit in the token
+    budget once they are padded to the longest one.'''
 
-        # Compute token embeddings
-        with torch.no_grad():
-            model_output=model(**encoded_input, return_dict=True)
+    # Sort the texts by length so that each model batch holds similar length texts
+    order=sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]))
 
-        # Perform pooling
-        embeddings=model_output.last_hidden_state[:,0]
+    indices=[]
 
-        # Collect the result
-        result.extend(embeddings.tolist())
+    for i in order:
 
-    # Return the embeddings as list
-    return result
+        # Texts are sorted, so this one sets the padded length of the batch
+        padded_length=len(input_ids[i])
 
+        # Yield the current batch if adding this text would go over budget
+        if len(indices) > 0 and (len(indices) + 1) * padded_length > config.EMBEDDING_TOKEN_BUDGET:
+            yield indices
+            indices=[]
 
-def yield_batches(batch: list):
-    '''Yields individual batches from master batch sent to GPU worker.'''
+        indices.append(i)
 
-    for i in range(0, len(batch), config.EMBEDDING_BATCH_SIZE):
-        yield batch[i:i + config.EMBEDDING_BATCH_SIZE]
\ No newline at end of file
+    if len(indices) > 0:
+        yield indices
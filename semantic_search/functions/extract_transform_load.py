@@ -4,17 +4,31 @@
 import time
 import json
 import pathlib
+import functools
+import contextlib
 import multiprocessing as mp
+from threading import Thread
 
 # PyPI imports
 import h5py
-from opensearchpy import exceptions # pylint: disable = import-error
+import numpy as np
 
 # Internal imports
 import semantic_search.configuration as config
 import semantic_search.functions.embedding as embed_funcs
+import semantic_search.functions.deduplication as dedup_funcs
 import semantic_search.functions.parsing as parse_funcs
 import semantic_search.functions.opensearch_loader as loader_funcs
+import semantic_search.functions.side_store as side_store
+import semantic_search.functions.luigi_helper as helper
+import semantic_search.functions.watchdog as watchdog
+import semantic_search.functions.dispatch as dispatch
+import semantic_search.functions.intermediate as intermediate
+import semantic_search.functions.shared_batches as shared_batches
+import semantic_search.functions.vector_reader as vector_reader
+import semantic_search.functions.tuning as tuning
+from semantic_search.classes.embedding_cache import EmbeddingCache
+from semantic_search.classes.hdf5_writer import HDF5Writer
 from semantic_search.functions.wikipedia_extractor import wikipedia_extractor # pylint: disable = unused-import
 
 
@@ -36,8 +50,9 @@ def extract_data(data_source: str) -> dict:
     return extraction_summary
 
 
-def parse_data(data_source: str) -> dict:
-    '''Runs data normalization and chunking on pre-batched data.'''
+def parse_data(data_source: str, shard: int = None) -> dict:
+    '''Runs data normalization and chunking on pre-batched data. If given a
+    shard number, only parses that shard's range of extracted batches.'''
 
     # Load the data source configuration
     source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
@@ -47,119 +62,232 @@ def parse_data(data_source: str) -> dict:
 
     # Start the transform summary with the data from the source configuration
     transform_summary=source_config
+    index_name=source_config['target_index_name']
 
-    # Prepare the hdf5 output
-    output_file=f"{config.DATA_PATH}/{source_config['target_index_name']}/{config.PARSED_TEXT}"
+    # Prepare the hdf5 or arrow output, written from its own thread
+    output_file=intermediate.text_file(index_name, 'parsed', shard)
+    pathlib.Path(output_file).parent.mkdir(parents=True, exist_ok=True)
     pathlib.Path(output_file).unlink(missing_ok=True)
-    output=h5py.File(output_file, 'w')
-    output_batch_group=output.require_group('batches')
+    writer=HDF5Writer(output_file, output=intermediate.open_output(output_file, 'parsed'))
+
+    # Start a new side store for the chunk text, titles and page ids
+    store=side_store.open_store(helper.data_file(index_name, config.SIDE_STORE, shard), create=True)
 
     # Open the input
-    input_file_path=f"{config.DATA_PATH}/{source_config['target_index_name']}/{config.EXTRACTED_TEXT}"
-    input_data=h5py.File(input_file_path, 'r')
+    input_file_path=intermediate.text_file(index_name, 'extracted')
+    input_data=intermediate.open_input(input_file_path)
+
+    # Pick the extracted batches to parse, all of them or just the shard's
+    batch_nums=intermediate.batch_nums(input_data)
+
+    if shard is not None:
+        shard_batch_nums=helper.shard_batches(source_config, shard)
+        batch_nums=[batch_num for batch_num in batch_nums if batch_num in shard_batch_nums]
+
+    # Workers are sent the texts to parse from hdf5, or the rows
+    # to read from arrow, which they memory map themselves
+    if intermediate.use_arrow() is True:
+        tasks=intermediate.yield_extracted_ranges(input_file_path, input_data, batch_nums, config.PARSE_TASK_CHARACTERS)
+
+    else:
+        tasks=parse_funcs.yield_parse_tasks(input_data, batch_nums, config.PARSE_TASK_CHARACTERS)
 
     # Set number of workers to one less than the CPU count
     n_workers=mp.cpu_count() - 1
 
-    # Counters and accumulators for batch loop
+    # Counters for the result loop. Chunk ids start at the
+    # shard's offset, so that they are unique across shards
+    first_chunk_id=0 if shard is None else shard * config.SHARD_CHUNK_ID_STRIDE
     batch_count=0
-    chunk_count=0
+    chunk_count=first_chunk_id
     record_count=0
-    batches=[]
-
-    # Start the timer
-    start_time = time.time()
-
-    # Loop on the batches
-    for batch_num in input_data['batches']:
 
-        # Grab the batch from the hdf5 connection
-        batch=input_data[f'batches/{batch_num}']
+    # Slowest and quarantined articles from every task, and time spent on each task
+    report=watchdog.new_report()
+    tracker=dispatch.new_tracker()
 
-        # Strings come out of hdf5 as bytes, decode them
-        decoded_batch=[]
+    # Window limits the number of tasks read ahead of the one being saved
+    window=config.DISPATCH_BATCHES_IN_FLIGHT * n_workers
 
-        for text in batch:
-            record_count+=1
-            decoded_batch.append(text.decode('utf-8'))
+    # Tasks and results go through shared memory if configured,
+    # so only the names of their segments are pickled
+    worker_function=parse_funcs.parse_batch
+    prefix=None
 
-        # Add the decoded batch to this round
-        batches.append(decoded_batch)
+    if config.SHARED_MEMORY_HANDOFF is True:
+        prefix=shared_batches.new_prefix()
+        worker_function=functools.partial(shared_batches.handoff, parse_funcs.parse_batch, prefix)
+        tasks=(shared_batches.pack(task, prefix) for task in tasks)
 
-        # There are three ways we to enter job submission:
-        #
-        # 1. We have a batch for every worker.
-        # 2. The number of batches left to submit in order to complete the number of
-        #    batches requested by the user is less than the number of workers.
-        # 3. We have reached the end of the input.
-        #
-        # Each of these three cases also has a different thing to do after. For number
-        # we submit the jobs and keep going. For number two, we break the line loop and stop.
-        # for number three, we have already left the line loop and can just end after
-        # the last batches.
-
-        # 1. If we have a batch for each worker, submit
-        if len(batches) == n_workers:
+    # Start the timer
+    start_time = time.time()
 
-            batch_count, chunk_count=parse_funcs.submit_batches(n_workers, batches, output_batch_group, batch_count, chunk_count)
+    try:
 
-            # Reset batches for next round
-            batches=[]
+        # Start the pool, with each worker's memory limited if configured
+        with mp.Pool(
+            processes=n_workers,
+            initializer=watchdog.limit_memory,
+            initargs=(config.WATCHDOG_PARSE_MEMORY_LIMIT,)
+        ) as pool:
 
-        # 2. If the number of batches left to fulfill a user request for a specific number of
-        # batches is less than the number of workers, submit that number of batches
-        # once we have them.
-        if source_config['num_batches'] != 'all':
+            # Workers take the next task as soon as they finish one, the results
+            # come back in order. The extraction step has already stopped at the
+            # number of batches requested by the user.
+            results=dispatch.windowed_imap(
+                pool,
+                functools.partial(dispatch.timed_call, worker_function),
+                tasks,
+                window
+            )
 
-            batches_remaining=source_config['num_batches'] - batch_count
+            # Save each result as a batch in the hdf5 file and its chunks in the side store
+            for result, seconds in results:
 
-            if batches_remaining < n_workers and len(batches) == batches_remaining:
+                if prefix is not None:
+                    result=shared_batches.unpack(result)
 
-                n_workers=batches_remaining
-                batch_count, chunk_count=parse_funcs.submit_batches(n_workers, batches, output_batch_group, batch_count, chunk_count)
+                writer.submit(parse_funcs.save_batch, batch_count, result)
+                side_store.write_chunks(store, chunk_count, result)
+                batch_count+=1
+                chunk_count+=len(result['chunks'])
+                record_count+=len(result['titles'])
 
-                # Break the line loop to end the run
-                break
-            
-            # Also break the line loop if we have completed the exact number of batches
-            # requested by the user
-            if batch_count == source_config['num_batches']:
-                break
+                dispatch.record_task(tracker, seconds)
+                watchdog.merge_reports(report, result['watchdog'])
 
-    # 3. If we are extracting all of the data, i.e. the user has not requested a specific
-    # number of batches to run, submit whatever is left over after the last extraction
-    # round after we have finished reading the input file
-    if source_config['num_batches'] == 'all':
+    finally:
 
-        # If we have batches that did not get processed because we ran out of input
-        # before collecting enough batches for a full extraction round, start a
-        # round with what we have
-        if len(batches) != 0:
+        # Remove any segments left behind if the stage failed
+        if prefix is not None:
+            shared_batches.remove_segments(prefix)
 
-            n_workers=len(batches)
-            batch_count, chunk_count=parse_funcs.submit_batches(n_workers, batches, output_batch_group, batch_count, chunk_count)
+    # Wait for the last batches to be written
+    write_timings=writer.close()
 
     dT=time.time() - start_time # pylint: disable = invalid-name
 
     # Add some stuff the the summary
+    transform_summary['shard']=shard
     transform_summary['run_time_seconds']=dT
     transform_summary['worker_processes']=n_workers
     transform_summary['parsed_batches']=batch_count
     transform_summary['parsed_records']=record_count
-    transform_summary['output_chunks']=chunk_count
+    transform_summary['output_chunks']=chunk_count - first_chunk_id
     transform_summary['observed_parse_rate']=(record_count/dT)
     transform_summary['estimated_total_parse_time']=(config.WIKIPEDIA_RECORD_COUNT / transform_summary['observed_parse_rate'])
+    transform_summary['parse_task_characters']=config.PARSE_TASK_CHARACTERS
+    transform_summary['intermediate_format']=config.INTERMEDIATE_FORMAT
+    transform_summary['shared_memory_handoff']=config.SHARED_MEMORY_HANDOFF
+    transform_summary.update(dispatch.summarize(tracker, n_workers, dT))
+    transform_summary.update(watchdog.summarize(report, helper.data_file(index_name, config.PARSE_QUARANTINE, shard)))
+    transform_summary.update(write_timings)
 
-    # Close the hdf5
-    input_data.close()
-    output.close()
+    # Close the input and the side store
+    intermediate.close_input(input_data)
+    store.close()
 
     return transform_summary
 
 
-def embed_data(data_source: str) -> dict:
+def deduplicate_data(data_source: str, shard: int = None) -> dict:
+    '''Finds clusters of near-duplicate chunks in the parsed data, or in one shard
+    of it, with MinHash and LSH banding. Saves the representative of every chunk as
+    its position in the parsed data.'''
+
+    # Load the data source configuration
+    source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
+
+    with open(source_config_path, encoding='UTF-8') as source_config_file:
+        source_config=json.load(source_config_file)
+
+    # Start the deduplication summary with the data from the source configuration
+    deduplication_summary=source_config
+    index_name=source_config['target_index_name']
+
+    deduplication_summary['shard']=shard
+    deduplication_summary['deduplication']=config.DEDUPLICATION
+
+    # Nothing to do if deduplication is off, the embed stage embeds every chunk
+    if config.DEDUPLICATION is False:
+        return deduplication_summary
+
+    # Open the input
+    input_file_path=intermediate.text_file(index_name, 'parsed', shard)
+    input_data=intermediate.open_input(input_file_path)
+
+    # Signatures are built from the chunk token ids saved by the parse step
+    if intermediate.has_token_ids(input_data) is False:
+        raise ValueError(
+            'Deduplication needs chunk token ids, set STORE_TOKEN_IDS=True and re-run ParseData, '
+            'or set DEDUPLICATION=False'
+        )
+
+    # Set number of workers to one less than the CPU count
+    n_workers=mp.cpu_count() - 1
+
+    # Start the timer
+    start_time=time.time()
+
+    # Hash the batches in parallel, in chunk id order. Workers are sent the token
+    # ids from hdf5, or the batch to read from arrow, which they memory map themselves
+    if intermediate.use_arrow() is True:
+        batches=intermediate.yield_batch_ranges(input_file_path, input_data)
+
+    else:
+        batches=(
+            intermediate.read_token_ids(input_data, batch_num)
+            for batch_num in intermediate.batch_nums(input_data)
+        )
+
+    with mp.Pool(processes=n_workers) as pool:
+        results=list(pool.imap(dedup_funcs.compute_band_hashes, batches))
+
+    intermediate.close_input(input_data)
+
+    band_hashes=np.concatenate([result[0] for result in results])
+    signatures=np.concatenate([result[1] for result in results])
+    has_shingles=np.concatenate([result[2] for result in results])
+
+    # Cluster the chunks and pick a representative for each cluster
+    representatives=dedup_funcs.find_representatives(band_hashes, signatures, has_shingles)
+
+    # Save the representative of each chunk
+    output_file=helper.data_file(index_name, config.CHUNK_REPRESENTATIVES, shard)
+    pathlib.Path(output_file).unlink(missing_ok=True)
+
+    with h5py.File(output_file, 'w') as output:
+        output.create_dataset('representatives', data=representatives)
+
+    dT=time.time() - start_time # pylint: disable = invalid-name
+
+    # Duplicates are chunks which are not their own representative, each one
+    # saves a forward pass in EmbedData and an entry in the KNN index
+    chunk_count=len(representatives)
+    duplicate_count=int(np.sum(representatives != np.arange(chunk_count)))
+    cluster_sizes=np.bincount(representatives)
+
+    # Add some stuff to the summary
+    deduplication_summary['run_time_seconds']=dT
+    deduplication_summary['worker_processes']=n_workers
+    deduplication_summary['minhash_permutations']=config.DEDUPLICATION_HASHES
+    deduplication_summary['lsh_bands']=config.DEDUPLICATION_BANDS
+    deduplication_summary['input_chunks']=chunk_count
+    deduplication_summary['representative_chunks']=chunk_count - duplicate_count
+    deduplication_summary['duplicate_clusters']=int(np.sum(cluster_sizes > 1))
+    deduplication_summary['largest_cluster']=int(cluster_sizes.max(initial=0))
+    deduplication_summary['saved_model_calls']=duplicate_count
+    deduplication_summary['saved_index_entries']=duplicate_count
+    deduplication_summary['duplicate_fraction']=duplicate_count / max(chunk_count, 1)
+    deduplication_summary['observed_deduplication_rate']=chunk_count / dT
+
+    return deduplication_summary
+
+
+def embed_data(data_source: str, shard: int = None) -> dict:
     '''Uses HuggingFace transformers to pre-calculate embeddings for indexing.
-    Parallelizes embedding over batches'''
+    Parallelizes embedding over batches. If given a shard number, only embeds
+    that shard's parsed data.'''
 
     # Load the data source configuration
     source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
@@ -169,85 +297,290 @@ def embed_data(data_source: str) -> dict:
 
     # Start the transform summary with the data from the source configuration
     embedding_summary=source_config
+    index_name=source_config['target_index_name']
 
-    # Prepare the hdf5 output
-    output_file=f"{config.DATA_PATH}/{source_config['target_index_name']}/{config.EMBEDDED_TEXT}"
+    # Prepare the hdf5 output, written from its own thread
+    output_file=helper.data_file(index_name, config.EMBEDDED_TEXT, shard)
     pathlib.Path(output_file).unlink(missing_ok=True)
-    output=h5py.File(output_file, 'w')
-    output_batch_group=output.require_group('batches')
+    writer=HDF5Writer(output_file)
+    writer.submit(embed_funcs.create_output)
 
     # Open the input
-    input_file_path=f"{config.DATA_PATH}/{source_config['target_index_name']}/{config.PARSED_TEXT}"
-    input_data=h5py.File(input_file_path, 'r')
+    input_file_path=intermediate.text_file(index_name, 'parsed', shard)
+    input_data=intermediate.open_input(input_file_path)
 
-    # Set number of workers using the GPU list from the configuration file
-    n_workers=len(config.WORKER_GPUS)
+    # Use the tune task's recommended worker layout and token budget, if there is one
+    if config.USE_TUNED_EMBEDDING_CONFIG is True:
+        embedding_summary['tuned_embedding_settings']=tuning.load_recommended_config()
 
-    # Counters and accumulators for batch loop
-    batch_count=0
-    record_count=0
-    batches=[]
-    decoded_batch=[]
+    # Set number of workers using the GPU list from the configuration file,
+    # or the number of CPU workers for the ONNX backend
+    devices=embed_funcs.worker_devices()
+    placements=None
+
+    # Pin CPU workers to their own cores, picking how many to run by a short
+    # calibration on the first chunks if configured
+    if config.CPU_TOPOLOGY_PINNING is True and all(device == 'cpu' for device in devices):
+
+        calibration_start_time=time.time()
+
+        placements, topology_summary=embed_funcs.plan_cpu_workers(
+            len(devices),
+            tuning.read_chunk_sample(input_data, config.CPU_CALIBRATION_TEXTS)
+        )
+
+        devices=['cpu'] * len(placements)
+        embedding_summary.update(topology_summary)
+        embedding_summary['cpu_calibration_seconds']=time.time() - calibration_start_time
+
+    n_workers=len(devices)
+
+    # Queues to send batches to and get embeddings back from the workers
+    input_queue=mp.Queue(maxsize=2 * n_workers)
+    output_queue=mp.Queue()
+
+    # Only the representative chunk of each near-duplicate cluster gets embedded,
+    # or every chunk if deduplication is off
+    representatives=None
+
+    if config.DEDUPLICATION is True:
+
+        representatives_file=helper.data_file(index_name, config.CHUNK_REPRESENTATIVES, shard)
+
+        with h5py.File(representatives_file, 'r') as representatives_data:
+            representatives=representatives_data['representatives'][()]
+
+    # Open the persistent embedding cache, if we are using it
+    cache=EmbeddingCache() if config.USE_EMBEDDING_CACHE is True else None
+
+    # Counters for the batch loop, updated in place by the reader thread
+    first_chunk_id=0 if shard is None else shard * config.SHARD_CHUNK_ID_STRIDE
+    counts={'chunks': 0, 'records': 0, 'duplicates': 0, 'worker_batches': 0, 'cache_hits': 0}
+    worker_summaries=[]
+    reader_done=False
 
     # Start the timer
     start_time = time.time()
 
-    # Loop on the batches
-    for batch_num in input_data['batches']:
+    # Start the long-lived embedding workers, each one loads its model once
+    workers=embed_funcs.start_workers(devices, input_queue, output_queue, placements)
+
+    # Read the input in a separate thread so that we can collect and save
+    # results while the workers are still being fed
+    reader=Thread(
+        target=read_embedding_batches,
+        args=(input_data, representatives, first_chunk_id, input_queue, output_queue, cache, counts, workers)
+    )
+
+    reader.start()
+
+    try:
+
+        # Collect results until the reader and every worker have sent their done signals
+        while len(worker_summaries) < n_workers or reader_done is False:
+
+            batch_id, result=dispatch.get_checked(output_queue, workers)
+
+            if batch_id == 'done':
+
+                # The reader's done signal has no run statistics
+                if result is None:
+                    reader_done=True
+
+                    # Fail the stage if the reader stopped on an error
+                    if 'error' in counts:
+                        raise counts['error']
+
+                else:
+                    worker_summaries.append(result)
+
+                continue
 
-        # Grab the batch from the hdf5 connection
-        batch=input_data[f'batches/{batch_num}']
+            # Results are either cached vectors from the reader or
+            # new embeddings from a worker, which we add to the cache
+            chunk_ids, keys=batch_id
+            writer.submit(embed_funcs.save_embeddings, chunk_ids, result)
 
-        # Strings come out of hdf5 as bytes, decode them
-        for text in batch:
-            record_count+=1
-            decoded_batch.append(text.decode('utf-8'))
+            if cache is not None and keys is not None:
+                cache.insert(keys, result)
 
-            # If the batch is full...
-            if len(decoded_batch) == config.EMBEDDING_BATCH_SIZE * config.WORKER_BATCHES_PER_ROUND:
+        # Clean up the reader thread and the worker processes
+        reader.join()
 
-                # Add the decoded batch to this round
-                batches.append(decoded_batch)
-                decoded_batch=[]
+        for worker in workers:
+            worker.join()
 
-                # Once we have a batch for each worker, run this round
-                if len(batches) == n_workers:
+    # On a failure, stop the workers that are left, which also
+    # stops the reader if it is waiting to feed them
+    except BaseException:
 
-                    batch_count=embed_funcs.submit_batches(n_workers, batches, output_batch_group, batch_count)
+        for worker in workers:
+            if worker.is_alive() is True:
+                worker.terminate()
 
-                    # Reset batches for next round
-                    batches=[]
+        reader.join()
 
-    # Once we reach the end of the input batches, make sure we submit anything left over for embedding
-    if len(decoded_batch) > 0:
-        batches.append(decoded_batch)
+        # Close the output without hiding the original error
+        with contextlib.suppress(Exception):
+            writer.close()
 
-    if len(batches) > 0:
-        n_workers=len(batches)
-        batch_count=embed_funcs.submit_batches(n_workers, batches, output_batch_group, batch_count)
+        raise
 
+    if cache is not None:
+        cache.close()
+
+    # Wait for the last embeddings to be written
+    write_timings=writer.close()
 
     dT=time.time() - start_time # pylint: disable = invalid-name
+    record_count=counts['records']
 
     # Add some stuff the the summary
+    embedding_summary['shard']=shard
     embedding_summary['run_time_seconds']=dT
     embedding_summary['worker_processes']=n_workers
     embedding_summary['worker_batches_per_worker']=config.WORKER_BATCHES_PER_ROUND
-    embedding_summary['embedded_batches']=batch_count * config.WORKER_BATCHES_PER_ROUND
+    embedding_summary['embedded_batches']=counts['worker_batches'] * config.WORKER_BATCHES_PER_ROUND
     embedding_summary['embedding_batch_size']=config.EMBEDDING_BATCH_SIZE
+    embedding_summary['embedding_backend']=config.EMBEDDING_BACKEND
     embedding_summary['embedded_records']=record_count
+    embedding_summary['skipped_duplicates']=counts['duplicates']
+    embedding_summary['embedding_cache']=config.USE_EMBEDDING_CACHE
+    embedding_summary['embedding_cache_hits']=counts['cache_hits']
+    embedding_summary['embedding_cache_hit_rate']=counts['cache_hits'] / max(record_count, 1)
     embedding_summary['observed_embedding_rate']=(record_count/dT)
     embedding_summary['estimated_total_embedding_time']=(config.WIKIPEDIA_ESTIMATED_CHUNK_COUNT / embedding_summary['observed_embedding_rate'])
+    embedding_summary['embedding_dtype']=config.EMBEDDING_DTYPE
+    embedding_summary['embedding_compression']=config.EMBEDDING_COMPRESSION
+    embedding_summary.update(embed_funcs.summarize_workers(worker_summaries))
+    embedding_summary.update(write_timings)
+
+    # Close the input
+    intermediate.close_input(input_data)
+
+    embedding_summary['embedded_file_size_bytes']=pathlib.Path(output_file).stat().st_size
 
-    # Close the hdf5s
-    input_data.close()
-    output.close()
-    
     return embedding_summary
 
 
-def load_data(data_source: str) -> dict:
-    '''Loads embedded data into OpenSearch KNN vector database for semantic search.'''
+def read_embedding_batches(
+    input_data,
+    representatives: np.ndarray,
+    first_chunk_id: int,
+    input_queue: mp.Queue,
+    output_queue: mp.Queue,
+    cache: EmbeddingCache,
+    counts: dict,
+    workers: list
+) -> None:
+
+    '''Reads parsed text from hdf5 or arrow, skips chunks which are near-duplicates of another
+    chunk, unless representatives is None, and looks the rest up in the embedding cache, if any. Cached vectors go straight to the output queue, the rest are grouped into worker
+    batches and put on the embedding worker input queue. Both are sent with their chunk
+    ids and cache keys. Chunk ids count chunks in batch order from first_chunk_id. Sends chunk token ids
+    instead of text if the parse step saved them. Stops the workers when the input
+    runs out. Any error is kept in counts for the main loop to raise.'''
+
+    try:
+
+        # Accumulators for batch loop, chunk ids count chunks in batch order
+        worker_batch=[]
+        worker_chunk_ids=[]
+        worker_keys=[]
+
+        # Use the token ids from the parse step if we have them
+        use_token_ids=intermediate.has_token_ids(input_data)
+
+        # Loop on the batches in numerical order
+        for input_batch_num in intermediate.batch_nums(input_data):
+
+            # Strings come out as bytes, which is what we hash for the cache keys
+            texts=intermediate.read_texts(input_data, input_batch_num)
+
+            # Grab the chunk token ids, or decode the text
+            if use_token_ids is True:
+                chunks=list(parse_funcs.yield_chunk_token_ids(*intermediate.read_token_ids(input_data, input_batch_num)))
+
+            else:
+                chunks=[text.decode('utf-8') for text in texts]
+
+            chunk_ids=np.arange(counts['chunks'], counts['chunks'] + len(chunks))
+            counts['chunks']+=len(chunks)
+
+            # Drop the duplicates, they share their representative's vector
+            if representatives is not None:
+                keep=np.flatnonzero(representatives[chunk_ids] == chunk_ids)
+
+            else:
+                keep=np.arange(len(chunks))
+
+            counts['records']+=len(keep)
+            counts['duplicates']+=len(chunks) - len(keep)
+
+            chunks=[chunks[i] for i in keep]
+            texts=texts[keep]
+            chunk_ids=chunk_ids[keep] + first_chunk_id
+
+            # Without a cache, every chunk is a miss
+            keys=[None] * len(chunks)
+            misses=range(len(chunks))
+
+            # Send cached vectors straight to the output, only the misses go to the workers
+            if cache is not None:
+                keys=cache.make_keys(texts)
+                hit_positions, hit_vectors=cache.lookup(keys)
+
+                if len(hit_positions) > 0:
+                    output_queue.put(((chunk_ids[hit_positions], None), hit_vectors))
+
+                counts['cache_hits']+=len(hit_positions)
+                misses=np.setdiff1d(np.arange(len(chunks)), hit_positions)
+
+            for i in misses:
+                worker_batch.append(chunks[i])
+                worker_chunk_ids.append(chunk_ids[i])
+                worker_keys.append(keys[i])
+
+                # If the batch is full, send it to the workers with its chunk ids and cache keys
+                if len(worker_batch) == config.EMBEDDING_BATCH_SIZE * config.WORKER_BATCHES_PER_ROUND:
+                    dispatch.put_checked(
+                        input_queue,
+                        ((np.array(worker_chunk_ids), worker_keys if cache is not None else None), worker_batch),
+                        workers
+                    )
+                    counts['worker_batches']+=1
+
+                    worker_batch=[]
+                    worker_chunk_ids=[]
+                    worker_keys=[]
+
+        # Once we reach the end of the input batches, make sure we submit anything left over for embedding
+        if len(worker_batch) > 0:
+            dispatch.put_checked(
+                input_queue,
+                ((np.array(worker_chunk_ids), worker_keys if cache is not None else None), worker_batch),
+                workers
+            )
+            counts['worker_batches']+=1
+
+        # Send each worker a done signal so it shuts down once the queue is empty
+        for _ in workers:
+            dispatch.put_checked(input_queue, 'done', workers)
+
+    # Keep the error for the main loop to raise, it stops the stage
+    except Exception as error: # pylint: disable = broad-exception-caught
+        counts['error']=error
+
+    # Tell the main loop that there are no more cached vectors coming
+    finally:
+        output_queue.put(('done', None))
+
+
+def load_data(data_source: str, shard: int = None) -> dict:
+    '''Loads embedded data into OpenSearch KNN vector database for semantic search.
+    Bulk requests are sent by a pool of loader workers, each with its own connection.
+    Resumes from the last checkpointed embedding offset if a previous run was interrupted.
+    If given a shard number, loads that shard into the index made by create_index.'''
 
     # Load the data source configuration
     source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
@@ -259,70 +592,209 @@ def load_data(data_source: str) -> dict:
     load_summary=source_config
 
     # Open the input
-    input_file_path=(f"{config.DATA_PATH}/{source_config['target_index_name']}" +
-        f'/{config.EMBEDDED_TEXT}')
+    input_file_path=helper.data_file(source_config['target_index_name'], config.EMBEDDED_TEXT, shard)
 
-    input_data=h5py.File(input_file_path, 'r')
+    # Pick up where we left off, if we have a checkpoint
+    checkpoint_file=helper.data_file(source_config['target_index_name'], config.LOAD_CHECKPOINT, shard)
+    start_offset=loader_funcs.read_checkpoint(checkpoint_file)
 
-    # Create the OpenSearch index
-    loader_funcs.initialize_index(source_config['target_index_name'])
+    # Create the OpenSearch index, unless we are resuming into it. Shards
+    # share one index, which is created once for all of them
+    if start_offset == 0 and shard is None:
+        loader_funcs.initialize_index(source_config['target_index_name'])
 
-    # Initialize the OpenSearch client
-    client=loader_funcs.start_client()
+    # Set number of loader workers from the configuration file
+    n_workers=config.LOAD_WORKERS
 
-    # Count records and batches
-    record_count=0
-    batch_count=0
+    # Queues to send blocks to and get acknowledgements back from the workers
+    input_queue=mp.Queue(maxsize=2 * n_workers)
+    output_queue=mp.Queue()
 
-    # Holder to collect batch for bulk insert
-    bulk_insert_batch=[]
+    # Load statistics, updated by the collector thread
+    load_stats={'indexed_records': 0, 'indexed_batches': 0, 'request_bytes': 0}
+
+    # Time spent waiting for input from the vector reader
+    input_wait_time=0
 
     # Start the timer
     start_time = time.time()
 
-    # Loop on the batches
-    for batch_num in input_data['batches']:
+    # Start the loader workers
+    workers=[]
+
+    for worker_num in range(n_workers):
+
+        worker=mp.Process(
+            target=loader_funcs.loader_worker,
+            args=(worker_num, source_config['target_index_name'], input_queue, output_queue)
+        )
+
+        worker.start()
+        workers.append(worker)
+
+    # Collect acknowledgements and advance the checkpoint in a separate thread
+    collector=Thread(
+        target=collect_load_results,
+        args=(output_queue, checkpoint_file, start_offset, load_stats)
+    )
+
+    collector.start()
+
+    wait_start_time=time.time()
+
+    try:
+
+        # Loop on large blocks of vectors, read ahead in the background
+        for offset, chunk_ids, block in vector_reader.read_vector_blocks(input_file_path, start_offset):
+
+            input_wait_time+=time.time() - wait_start_time
 
-        # Grab the batch from the hdf5 connection
-        batch=input_data[f'batches/{batch_num}']
-        print(f'Input batch {batch_num} has {len(batch)} embeddings')
+            # Send the workers bulk insert sized pieces of the block,
+            # failing the stage if any of them has died
+            for start in range(0, len(block), config.BULK_INSERT_BATCH_SIZE):
 
-        # Loop on the embedded texts in the input batch, collecting them for indexing
-        for embeddings in batch:
-            bulk_insert_batch.append(embeddings)
+                end=start + config.BULK_INSERT_BATCH_SIZE
+                dispatch.put_checked(input_queue, (offset + start, chunk_ids[start:end], block[start:end]), workers)
 
-            # If the batch is full, insert it
-            if len(bulk_insert_batch) == config.BULK_INSERT_BATCH_SIZE:
-                print(f'Indexing batch of {len(bulk_insert_batch)} embeddings')
+            wait_start_time=time.time()
 
-                # Insert, Catching any connection timeout errors from OpenSearch
-                try:
+        # Shut down the workers, then check that they all finished cleanly
+        for _ in workers:
+            dispatch.put_checked(input_queue, 'done', workers)
 
-                    record_count=loader_funcs.index_batch(client, bulk_insert_batch, source_config, record_count)
-                    batch_count+=1
-                    bulk_insert_batch=[]
+        for worker in workers:
+            worker.join()
 
-                # If we catch a connection timeout or transport error, sleep for a bit and
-                # don't clear the batch before continuing the loop
-                except (exceptions.ConnectionTimeout, exceptions.TransportError):
-                    time.sleep(10)
+        dispatch.check_workers(workers)
 
-    # If we finish consuming the input and have embeddings that did not get indexed
-    # because we did not have enough to fill the last bulk indexing batch, index them
-    if len(bulk_insert_batch) > 0:
-        record_count=loader_funcs.index_batch(client, bulk_insert_batch, source_config, record_count)
+    # Stop any workers left after a failure and the collector either way,
+    # the checkpoint holds what was indexed for the next run to resume from
+    finally:
+
+        for worker in workers:
+            if worker.is_alive() is True:
+                worker.terminate()
+
+        output_queue.put('done')
+        collector.join()
 
     dT=time.time() - start_time # pylint: disable = invalid-name
 
     # Add some stuff the the summary
+    load_summary['shard']=shard
     load_summary['run_time_seconds']=dT
-    load_summary['indexed_batches']=batch_count
+    load_summary['loader_workers']=n_workers
+    load_summary['opensearch_hosts']=len(config.OPENSEARCH_HOSTS)
+    load_summary['resumed_from_offset']=start_offset
     load_summary['indexing_batch_size']=config.BULK_INSERT_BATCH_SIZE
-    load_summary['indexed_records']=record_count
-    load_summary['observed_indexing_rate']=(record_count/dT)
+    load_summary.update(load_stats)
+    load_summary['observed_indexing_rate']=(load_stats['indexed_records']/dT)
+    load_summary['observed_request_byte_rate']=(load_stats['request_bytes']/dT)
     load_summary['estimated_total_indexing_time']=(config.WIKIPEDIA_ESTIMATED_CHUNK_COUNT / load_summary['observed_indexing_rate'])
-
-    # Close the hdf5s
-    input_data.close()
+    load_summary['input_wait_time_seconds']=input_wait_time
 
     return load_summary
+
+
+def create_index(data_source: str) -> dict:
+    '''Creates the OpenSearch index which every shard is loaded into.'''
+
+    # Load the data source configuration
+    source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
+
+    with open(source_config_path, encoding='UTF-8') as source_config_file:
+        source_config=json.load(source_config_file)
+
+    # Start the index summary with the data from the source configuration
+    index_summary=source_config
+
+    loader_funcs.initialize_index(source_config['target_index_name'])
+
+    index_summary['created_time']=time.time()
+
+    return index_summary
+
+
+def merge_shard_summaries(data_source: str, n_shards: int) -> dict:
+    '''Reads the per-shard summaries of each stage, returns one summary for the
+    whole run with the shard summaries and the totals of their counters.'''
+
+    # Load the data source configuration
+    source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
+
+    with open(source_config_path, encoding='UTF-8') as source_config_file:
+        source_config=json.load(source_config_file)
+
+    # Start the merged summary with the data from the source configuration
+    merged_summary=source_config
+    merged_summary['shards']=n_shards
+
+    # Counters to add up over the shards for each stage
+    stage_counters={
+        config.PARSE_SUMMARY: ['run_time_seconds', 'parsed_records', 'output_chunks'],
+        config.DEDUPLICATION_SUMMARY: ['run_time_seconds', 'input_chunks', 'saved_model_calls', 'saved_index_entries'],
+        config.EMBEDDING_SUMMARY: ['run_time_seconds', 'embedded_records', 'skipped_duplicates', 'embedding_cache_hits'],
+        config.LOAD_SUMMARY: ['run_time_seconds', 'indexed_records', 'request_bytes']
+    }
+
+    for summary_file, counters in stage_counters.items():
+
+        stage=summary_file.split('-')[1].removesuffix('_summary.json')
+        stage_summary={counter: 0 for counter in counters}
+        stage_summary['shard_summaries']=[]
+
+        for shard in range(n_shards):
+
+            with open(helper.data_file(source_config['target_index_name'], summary_file, shard), encoding='UTF-8') as shard_summary_file:
+                shard_summary=json.load(shard_summary_file)
+
+            for counter in counters:
+                stage_summary[counter]+=shard_summary.get(counter, 0)
+
+            stage_summary['shard_summaries'].append(shard_summary)
+
+        merged_summary[stage]=stage_summary
+
+    return merged_summary
+
+
+def collect_load_results(
+    output_queue: mp.Queue,
+    checkpoint_file: str,
+    checkpoint_offset: int,
+    load_stats: dict
+) -> None:
+
+    '''Takes finished bulk requests from the loader workers, counts them and
+    advances the checkpoint offset past every block which has been indexed along
+    with all of the blocks before it. Saves the checkpoint every so often.'''
+
+    # Finished blocks past the checkpoint, waiting for the ones before them
+    finished={}
+
+    last_save_time=time.time()
+
+    while True:
+
+        result=output_queue.get()
+
+        if result == 'done':
+            break
+
+        offset, count, request_bytes=result
+
+        load_stats['indexed_records']+=count
+        load_stats['indexed_batches']+=1
+        load_stats['request_bytes']+=request_bytes
+
+        # Advance the checkpoint as far as the finished blocks allow
+        finished[offset]=count
+
+        while checkpoint_offset in finished:
+            checkpoint_offset+=finished.pop(checkpoint_offset)
+
+        if time.time() - last_save_time > config.LOAD_CHECKPOINT_INTERVAL:
+            loader_funcs.write_checkpoint(checkpoint_file, checkpoint_offset)
+            last_save_time=time.time()
+
+    loader_funcs.write_checkpoint(checkpoint_file, checkpoint_offset)
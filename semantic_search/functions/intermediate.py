@@ -0,0 +1,235 @@
+'''Storage backends for the extracted and parsed text files. Both are written as
+hdf5, with a group per field and a dataset per batch, or as Arrow IPC files, with
+one record batch per stage batch. Arrow readers memory map the file, so parse and
+deduplication workers are sent the rows to read, rather than pickled lists of
+strings, and read them straight out of the page cache.'''
+
+# Standard imports
+import functools
+
+# PyPI imports
+import h5py
+import numpy as np
+
+# PyPI imports, pyarrow is optional
+try:
+    import pyarrow as pa # pylint: disable = import-error
+    import pyarrow.compute as pc # pylint: disable = import-error
+    ARROW_AVAILABLE=True
+
+except ImportError:
+    ARROW_AVAILABLE=False
+
+# Internal imports
+import semantic_search.configuration as config
+import semantic_search.functions.luigi_helper as helper
+
+# Text file names for each stage and format
+TEXT_FILES={
+    'extracted': {'hdf5': config.EXTRACTED_TEXT, 'arrow': config.EXTRACTED_TEXT_ARROW},
+    'parsed': {'hdf5': config.PARSED_TEXT, 'arrow': config.PARSED_TEXT_ARROW}
+}
+
+
+def use_arrow() -> bool:
+    '''Returns True if the text files are configured to be Arrow, raises
+    if they are but pyarrow is not installed.'''
+
+    if config.INTERMEDIATE_FORMAT != 'arrow':
+        return False
+
+    if ARROW_AVAILABLE is False:
+        raise ImportError("INTERMEDIATE_FORMAT='arrow' needs pyarrow, install it or use 'hdf5'")
+
+    return True
+
+
+def text_file(index_name: str, stage: str, shard: int = None) -> str:
+    '''Returns path of the extracted or parsed text file in the configured format.'''
+
+    file_format='arrow' if use_arrow() else 'hdf5'
+
+    return helper.data_file(index_name, TEXT_FILES[stage][file_format], shard)
+
+
+def schema(stage: str):
+    '''Returns the Arrow schema of a stage's record batches. Extracted batches hold
+    article page ids, titles and texts. Parsed batches hold chunk texts and, if
+    configured, each chunk's token ids.'''
+
+    if stage == 'extracted':
+        return pa.schema([
+            ('page_id', pa.int64()),
+            ('title', pa.large_string()),
+            ('text', pa.large_string())
+        ])
+
+    fields=[('text', pa.large_string())]
+
+    if config.STORE_TOKEN_IDS is True:
+        fields.append(('token_ids', pa.large_list(pa.from_numpy_dtype(np.dtype(config.TOKEN_ID_DTYPE)))))
+
+    return pa.schema(fields)
+
+
+def open_output(output_file: str, stage: str):
+    '''Opens a stage's text file for writing, returns hdf5 file or Arrow
+    IPC file writer. Either one is finished by calling its close method.'''
+
+    if use_arrow() is True:
+        return pa.ipc.new_file(output_file, schema(stage))
+
+    return h5py.File(output_file, 'w')
+
+
+def write_record_batch(output, stage: str, columns: dict) -> None:
+    '''Appends a batch to an Arrow text file as one record batch. Batches are
+    numbered by the order they are written in. Takes dictionary of column name
+    to values, with token ids as a (flat token ids, chunk offsets) tuple.'''
+
+    if 'token_ids' in columns:
+        token_ids, token_offsets=columns['token_ids']
+        columns['token_ids']=pa.LargeListArray.from_arrays(pa.array(token_offsets), pa.array(token_ids))
+
+    output.write_batch(pa.record_batch(columns, schema=schema(stage)))
+
+
+def open_input(input_file_path: str):
+    '''Opens a stage's text file for reading, returns hdf5 file or Arrow IPC
+    file reader over a memory map of the file.'''
+
+    if use_arrow() is True:
+        return pa.ipc.open_file(pa.memory_map(input_file_path, 'r'))
+
+    return h5py.File(input_file_path, 'r')
+
+
+@functools.cache
+def open_shared_input(input_file_path: str):
+    '''Worker side open_input for Arrow files, opened once per worker process.
+    Every worker maps the same file, so the pages are only read from disk once.'''
+
+    return pa.ipc.open_file(pa.memory_map(input_file_path, 'r'))
+
+
+def close_input(input_data) -> None:
+    '''Closes a stage's text file. Arrow memory maps are released
+    with the reader, which has nothing to close.'''
+
+    if isinstance(input_data, h5py.File):
+        input_data.close()
+
+
+def batch_nums(input_data) -> list:
+    '''Returns the numbers of the batches in a stage's text file, in order.'''
+
+    if isinstance(input_data, h5py.File):
+        return sorted((int(batch_num) for batch_num in input_data['batches']))
+
+    return list(range(input_data.num_record_batches))
+
+
+def has_token_ids(input_data) -> bool:
+    '''Returns True if the parsed text file holds chunk token ids.'''
+
+    if isinstance(input_data, h5py.File):
+        return 'token_ids' in input_data
+
+    return 'token_ids' in input_data.schema.names
+
+
+def read_texts(input_data, batch_num: int) -> np.ndarray:
+    '''Returns a batch's texts as an object array of utf-8 bytes.'''
+
+    if isinstance(input_data, h5py.File):
+        return input_data[f'batches/{batch_num}'][()]
+
+    texts=input_data.get_batch(batch_num).column('text').cast(pa.large_binary())
+
+    return np.array(texts.to_pylist(), dtype=object)
+
+
+def read_token_ids(input_data, batch_num: int) -> tuple:
+    '''Returns a parsed batch's (flat token ids, chunk offsets) arrays. From
+    Arrow files, both are views of the memory map rather than copies.'''
+
+    if isinstance(input_data, h5py.File):
+        return input_data[f'token_ids/{batch_num}'][()], input_data[f'token_offsets/{batch_num}'][()]
+
+    token_ids=input_data.get_batch(batch_num).column('token_ids')
+
+    return token_ids.values.to_numpy(), token_ids.offsets.to_numpy()
+
+
+def yield_extracted_ranges(input_file_path: str, input_data, input_batch_nums: list, max_characters: int):
+    '''Arrow version of parsing.yield_parse_tasks. Yields range descriptors, i.e.
+    dictionaries of the file, batch and rows for a worker to read, splitting batches
+    so that the texts in each range add up to about max_characters. Only the text
+    lengths are read, from the Arrow offsets, the texts themselves stay on disk.'''
+
+    for batch_num in input_batch_nums:
+
+        lengths=pc.utf8_length(input_data.get_batch(batch_num).column('text')).to_numpy()
+
+        # Close a range once its texts reach the character budget
+        range_start=0
+        range_characters=0
+
+        for text_num, length in enumerate(lengths):
+
+            range_characters+=length
+
+            if range_characters >= max_characters or text_num == len(lengths) - 1:
+
+                yield {
+                    'file': input_file_path,
+                    'batch': batch_num,
+                    'start': range_start,
+                    'end': text_num + 1
+                }
+
+                range_start=text_num + 1
+                range_characters=0
+
+
+def yield_batch_ranges(input_file_path: str, input_data):
+    '''Yields a range descriptor covering each whole batch of an Arrow file.'''
+
+    for batch_num in batch_nums(input_data):
+        yield {
+            'file': input_file_path,
+            'batch': batch_num,
+            'start': 0,
+            'end': input_data.get_batch(batch_num).num_rows
+        }
+
+
+def read_range(task: dict):
+    '''Worker side, takes range descriptor, returns the record batch slice it points to.'''
+
+    batch=open_shared_input(task['file']).get_batch(task['batch'])
+
+    return batch.slice(task['start'], task['end'] - task['start'])
+
+
+def read_extracted_range(task: dict) -> dict:
+    '''Worker side, takes range descriptor for an extracted text file, returns the
+    parse task it describes, i.e. dictionary of texts, titles and page ids.'''
+
+    batch=read_range(task)
+
+    return {
+        'texts': batch.column('text').to_pylist(),
+        'titles': batch.column('title').to_pylist(),
+        'page_ids': batch.column('page_id').to_numpy()
+    }
+
+
+def read_token_id_range(task: dict) -> tuple:
+    '''Worker side, takes range descriptor for a parsed text file, returns its
+    (flat token ids, chunk offsets) arrays, offsets starting from zero.'''
+
+    token_ids=read_range(task).column('token_ids')
+    token_offsets=token_ids.offsets.to_numpy()
+
+    return token_ids.values.to_numpy()[token_offsets[0]:token_offsets[-1]], token_offsets - token_offsets[0]
@@ -7,25 +7,24 @@ import pathlib
 import semantic_search.configuration as config
 
 def force_from(data_dir: str, task_name: str = None):
-    '''Forces all to be re-run starting with given task by removing their output'''
+    '''Forces all to be re-run starting with given task by removing their output.
+    Per-shard outputs are removed from every shard directory.'''
 
-    # Dictionary of string task names and their output files
+    # Dictionary of string task names and their output file names
     tasks = {
-        'ExtractData': [
-            f'{config.DATA_PATH}/{data_dir}/{config.EXTRACTION_SUMMARY}',
-            f'{config.DATA_PATH}/{data_dir}/{config.EXTRACTED_TEXT}'
-        ],
-        'ParseData': [
-            f'{config.DATA_PATH}/{data_dir}/{config.PARSE_SUMMARY}',
-            f'{config.DATA_PATH}/{data_dir}/{config.PARSED_TEXT}'
-        ],
-        'EmbedData': [
-            f'{config.DATA_PATH}/{data_dir}/{config.EMBEDDING_SUMMARY}',
-            f'{config.DATA_PATH}/{data_dir}/{config.EMBEDDED_TEXT}'
-        ],
-        'LoadData': [f'{config.DATA_PATH}/{data_dir}/{config.LOAD_SUMMARY}']
+        'ExtractData': [config.EXTRACTION_SUMMARY, config.EXTRACTED_TEXT, config.EXTRACTED_TEXT_ARROW, config.EXTRACTION_QUARANTINE],
+        'ParseData': [config.PARSE_SUMMARY, config.PARSED_TEXT, config.PARSED_TEXT_ARROW, config.SIDE_STORE, config.PARSE_QUARANTINE],
+        'DeduplicateData': [config.DEDUPLICATION_SUMMARY, config.CHUNK_REPRESENTATIVES],
+        'EmbedData': [config.EMBEDDING_SUMMARY, config.EMBEDDED_TEXT],
+        'LoadData': [config.INDEX_SUMMARY, config.LOAD_SUMMARY, config.LOAD_CHECKPOINT],
+        'MergeShards': [config.MERGED_SUMMARY],
+        'StreamData': [config.STREAMING_SUMMARY]
     }
 
+    # Top level data directory and each shard's directory
+    output_dirs=[pathlib.Path(f'{config.DATA_PATH}/{data_dir}')]
+    output_dirs.extend(pathlib.Path(f'{config.DATA_PATH}/{data_dir}/{config.SHARD_DIRECTORY}').glob('*'))
+
     # Flag to determine if we remove each file or not
     remove_output=False
 
@@ -38,7 +37,38 @@ def force_from(data_dir: str, task_name: str = None):
         if task == task_name:
             remove_output = True
 
-        # If the flag has been flipped remove the output file
+        # If the flag has been flipped remove the output files
         if remove_output is True:
-            for output_file in output_files:
-                pathlib.Path(output_file).unlink(missing_ok = True)
+            for output_dir in output_dirs:
+                for output_file in output_files:
+                    pathlib.Path(f'{output_dir}/{output_file}').unlink(missing_ok = True)
+
+
+def data_file(index_name: str, file_name: str, shard: int = None) -> str:
+    '''Returns path of a pipeline data file. Per-shard files live
+    in their own directory for each shard.'''
+
+    if shard is None:
+        return f'{config.DATA_PATH}/{index_name}/{file_name}'
+
+    return f'{config.DATA_PATH}/{index_name}/{config.SHARD_DIRECTORY}/{shard}/{file_name}'
+
+
+def shard_batches(source_config: dict, shard: int) -> range:
+    '''Takes data source configuration and shard number, returns the range of
+    extracted batch numbers in the shard. Every shard holds the same number of
+    batches, so at most SHARD_RECORDS records, fewer if batches were closed early
+    by their byte budget.'''
+
+    batches_per_shard=max(config.SHARD_RECORDS // source_config['batch_size'], 1)
+
+    return range(shard * batches_per_shard, (shard + 1) * batches_per_shard)
+
+
+def shard_count(source_config: dict, extracted_batches: int) -> int:
+    '''Takes data source configuration and number of extracted batches,
+    returns the number of shards needed to cover them.'''
+
+    batches_per_shard=max(config.SHARD_RECORDS // source_config['batch_size'], 1)
+
+    return -(-extracted_batches // batches_per_shard)
@@ -0,0 +1,107 @@
+'''ONNX Runtime embedding backend for CPU only hosts. The embedding model is exported
+to ONNX once, optionally quantized to int8 weights, and run by ONNX Runtime sessions
+with a fixed number of intra- and inter-op threads per worker.'''
+
+# Standard imports
+import pathlib
+
+# PyPI imports
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModel
+
+# PyPI imports, onnxruntime is optional
+try:
+    import onnxruntime as ort # pylint: disable = import-error
+    from onnxruntime.quantization import quantize_dynamic, QuantType # pylint: disable = import-error
+    ONNX_AVAILABLE=True
+
+except ImportError:
+    ONNX_AVAILABLE=False
+
+# Internal imports
+import semantic_search.configuration as config
+
+
+def model_file(quantized: bool = config.ONNX_QUANTIZE) -> str:
+    '''Returns path of the exported embedding model, or of its int8 version.'''
+
+    model_name=config.EMBEDDING_MODEL.replace('/', '--')
+    suffix='-int8' if quantized is True else ''
+
+    return f'{config.ONNX_MODEL_PATH}/{model_name}{suffix}.onnx'
+
+
+def prepare_model(quantized: bool = config.ONNX_QUANTIZE) -> str:
+    '''Exports the embedding model to ONNX and quantizes it if asked, unless that
+    has already been done. Returns path of the model for the sessions to load.'''
+
+    if ONNX_AVAILABLE is False:
+        raise ImportError("EMBEDDING_BACKEND='onnx' needs onnxruntime, install it or use 'torch'")
+
+    pathlib.Path(config.ONNX_MODEL_PATH).mkdir(parents=True, exist_ok=True)
+
+    if pathlib.Path(model_file(False)).exists() is False:
+        export_model(model_file(False))
+
+    if quantized is True and pathlib.Path(model_file(True)).exists() is False:
+        quantize_dynamic(model_file(False), model_file(True), weight_type=QuantType.QInt8)
+
+    return model_file(quantized)
+
+
+def export_model(output_file: str) -> None:
+    '''Exports the embedding model to ONNX, with the batch size and sequence
+    length left dynamic. The output is the last hidden state, the CLS pooling
+    is done on the result, the same as in the torch backend.'''
+
+    tokenizer=AutoTokenizer.from_pretrained(config.EMBEDDING_MODEL)
+
+    # Torchscript mode makes the model return plain tuples, which export cleanly
+    model=AutoModel.from_pretrained(config.EMBEDDING_MODEL, torchscript=True)
+    model.eval()
+
+    example_input=tokenizer(['An example input for tracing the model.'], return_tensors='pt')
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (example_input['input_ids'], example_input['attention_mask']),
+            output_file,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['last_hidden_state'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'sequence'},
+                'attention_mask': {0: 'batch', 1: 'sequence'},
+                'last_hidden_state': {0: 'batch', 1: 'sequence'}
+            },
+            opset_version=config.ONNX_OPSET
+        )
+
+
+def load_session(model_path: str, threads: int = None):
+    '''Takes path of an ONNX model, returns CPU inference session using threads,
+    or by default the configured intra-op threads, for each operator and the
+    configured inter-op threads for running independent operators at the same time.'''
+
+    options=ort.SessionOptions()
+    options.intra_op_num_threads=threads if threads is not None else config.ONNX_INTRA_OP_THREADS
+    options.inter_op_num_threads=config.ONNX_INTER_OP_THREADS
+    options.graph_optimization_level=ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    # Inter-op threads are only used by the parallel executor
+    if config.ONNX_INTER_OP_THREADS > 1:
+        options.execution_mode=ort.ExecutionMode.ORT_PARALLEL
+
+    return ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+
+
+def run_model(session, input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    '''Takes session and padded model batch, returns the CLS embeddings as float32.'''
+
+    last_hidden_state=session.run(
+        ['last_hidden_state'],
+        {'input_ids': input_ids, 'attention_mask': attention_mask}
+    )[0]
+
+    return last_hidden_state[:, 0].astype(np.float32)
@@ -1,24 +1,29 @@
 '''Collection of functions for loading data into OpenSearch.'''
 
 # Standard imports
+import os
 import time
+import json
+import pathlib
+import multiprocessing as mp
 
 # PyPI imports
-from opensearchpy import OpenSearch # pylint: disable = import-error
+import numpy as np
+from opensearchpy import OpenSearch, exceptions # pylint: disable = import-error
 
 # Internal imports
 import semantic_search.configuration as config
 
-def start_client() -> OpenSearch:
-    '''Fires up the OpenSearch client'''
+def start_client(hosts: list = None) -> OpenSearch:
+    '''Fires up the OpenSearch client, connected to the configured
+    cluster nodes unless given a list of hosts.'''
 
-    # Set host and port
-    host='localhost'
-    port=9200
+    if hosts is None:
+        hosts=config.OPENSEARCH_HOSTS
 
     # Create the client with SSL/TLS and hostname verification disabled.
     client=OpenSearch(
-        hosts=[{'host': host, 'port': port}],
+        hosts=hosts,
         http_compress=False,
         timeout=30,
         use_ssl=False,
@@ -75,35 +80,147 @@ def initialize_index(index_name: str) -> None:
     client.close()
 
 
-def index_batch(client, bulk_insert_batch: list, source_config: dict, record_count: int):
-    '''Formats bulk insert batch for indexing and submits it to OpenSearch'''
+def loader_worker(
+    worker_num: int,
+    index_name: str,
+    input_queue: mp.Queue,
+    output_queue: mp.Queue
+) -> None:
 
-    # Build the requests
-    knn_requests=[]
+    '''Takes blocks of vectors from the input queue, builds their bulk request
+    body and sends it to OpenSearch over this worker's own connection until done
+    is received. Reports each finished block's offset, size and request bytes
+    on the output queue.'''
 
-    for embedded_text in bulk_insert_batch:
+    # Rotate the host list so that the workers start out spread across the cluster nodes
+    hosts=config.OPENSEARCH_HOSTS
+    first_host=worker_num % len(hosts)
+    client=start_client(hosts[first_host:] + hosts[:first_host])
 
-        record_count+=1
+    # Loop until we receive done from the main process
+    while True:
 
-        knn_request_header={
-            'index': {
-                '_index': source_config['target_index_name'],
-                '_id': record_count
-            }
-        }
+        work=input_queue.get()
+
+        if work == 'done':
+            break
+
+        offset, chunk_ids, vectors=work
+
+        # Build the request body once and send it
+        body=build_bulk_body(index_name, chunk_ids, vectors)
+        index_batch(client, body)
+
+        output_queue.put((offset, len(vectors), len(body)))
+
+    client.close()
+
+
+def build_bulk_body(index_name: str, chunk_ids: np.ndarray, vectors: np.ndarray) -> bytes:
+    '''Formats a block of vectors as a newline delimited JSON bulk request
+    body. Documents are indexed under their chunk id.'''
+
+    lines=[]
+
+    for chunk_id, vector in zip(chunk_ids.tolist(), vectors.astype(np.float32).tolist()):
+
+        lines.append(json.dumps({'index': {'_index': index_name, '_id': chunk_id}}))
+        lines.append(json.dumps({'text_embedding': vector}))
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def index_batch(client: OpenSearch, body: bytes) -> None:
+    '''Submits a pre-built bulk request body to OpenSearch, sleeping and retrying
+    if the request times out or the cluster is overloaded or unavailable. Documents
+    which fail for the same reasons, e.g. a full write queue, are resent on their
+    own. Raises on any other error, or if any document failed for any other reason.'''
+
+    while True:
+
+        response=send_bulk(client, body)
+
+        if response['errors'] is False:
+            return
+
+        # Each action is a header line and a document line, in the same order as the items
+        lines=body.splitlines(keepends=True)
+        retry_lines=[]
+        failed_items=[]
+
+        for item_num, item in enumerate(response['items']):
+
+            result=next(iter(item.values()))
+
+            if result.get('error') is None:
+                continue
+
+            if retryable_status(result.get('status')) is False:
+                failed_items.append(item)
+
+            else:
+                retry_lines.extend(lines[2 * item_num:2 * item_num + 2])
+
+        if len(failed_items) > 0:
+            raise RuntimeError(f"Bulk insert failed for {len(failed_items)} documents: {failed_items[:5]}")
+
+        # Sleep for a bit and resend just the documents which were rejected
+        time.sleep(10)
+        body=b''.join(retry_lines)
+
+
+def send_bulk(client: OpenSearch, body: bytes) -> dict:
+    '''Sends a bulk request body, sleeping and retrying if the request times out
+    or the cluster is overloaded or unavailable. Returns the bulk response.'''
+
+    while True:
+
+        # Insert, catching any connection timeout errors from OpenSearch
+        try:
+            return client.bulk(body=body)
+
+        # If the request timed out, sleep for a bit and try again
+        except exceptions.ConnectionTimeout:
+            time.sleep(10)
+
+        # Same for too many requests and server errors, anything else is a bad request
+        except exceptions.TransportError as error:
+
+            if retryable_status(error.status_code) is False:
+                raise
+
+            time.sleep(10)
+
+
+def retryable_status(status_code) -> bool:
+    '''Returns True for the HTTP status codes worth retrying a bulk request or a
+    document on, too many requests and server errors. Connection errors have no
+    status.'''
+
+    if not isinstance(status_code, int):
+        return True
+
+    return status_code == 429 or status_code >= 500
+
+
+def read_checkpoint(checkpoint_file: str) -> int:
+    '''Returns the embedding dataset offset up to which all vectors
+    have been indexed, or zero if there is no checkpoint.'''
 
-        knn_requests.append(knn_request_header)
+    if pathlib.Path(checkpoint_file).exists() is False:
+        return 0
 
-        request_body={'text_embedding': embedded_text}
+    with open(checkpoint_file, encoding='UTF-8') as input_file:
+        return json.load(input_file)['offset']
 
-        knn_requests.append(request_body)
 
-        # Do the insert
-        _=client.bulk(knn_requests)
+def write_checkpoint(checkpoint_file: str, offset: int) -> None:
+    '''Saves the indexed offset, replacing the old checkpoint in
+    one step so an interrupted write can't corrupt it.'''
 
-    # Clear the batch
-    bulk_insert_batch=[]
+    temp_file=f'{checkpoint_file}.tmp'
 
-    # Return the updated record count
-    return record_count
+    with open(temp_file, 'w', encoding='UTF-8') as output_file:
+        json.dump({'offset': offset}, output_file)
 
+    os.replace(temp_file, checkpoint_file)
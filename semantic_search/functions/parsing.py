@@ -2,65 +2,127 @@
 run by multiprocessing pool workers'''
 
 # Standard imports
-import multiprocessing as mp
+import functools
 
 # PyPI imports
 import h5py
+import numpy as np
 from semantic_text_splitter import TextSplitter # pylint: disable = no-name-in-module
 from tokenizers import Tokenizer
 
 # Internal imports
 import semantic_search.configuration as config
+import semantic_search.functions.watchdog as watchdog
+import semantic_search.functions.intermediate as intermediate
 
-def submit_batches(
-    n_workers: int,
-    batches: list,
-    output_batch_group: h5py._hl.group.Group,
-    batch_count: int,
-    chunk_count: int,
-) -> int:
+def yield_parse_tasks(input_data: h5py.File, batch_nums: list, max_characters: int):
+    '''Reads extracted batches in order and yields them as parse tasks, i.e. dictionaries
+    of texts with their titles and page ids. Batches are split so that the texts in each
+    task add up to about max_characters, so that tasks take about the same time.'''
 
-    '''Takes batches list and current batch count, submits batches to worker pool for parsing.
-    Returns updated batch count after receiving and saving worker results.'''
+    for batch_num in batch_nums:
 
-    # Holder for results from workers
-    worker_results=[]
+        # Strings come out of hdf5 as bytes, decode them
+        texts=[text.decode('utf-8') for text in input_data[f'batches/{batch_num}']]
+        titles=[title.decode('utf-8') for title in input_data[f'titles/{batch_num}']]
+        page_ids=input_data[f'page_ids/{batch_num}'][()]
 
-    # Start the pool
-    pool=mp.Pool(processes=n_workers)
+        # Close a task once its texts reach the character budget
+        task_start=0
+        task_characters=0
 
-    # Holder for results from workers
-    worker_results=[]
+        for text_num, text in enumerate(texts):
 
-    # Submit each batch to a worker
-    for batch in batches:
-        worker_result=pool.apply_async(clean_and_chunk, (batch,))
-        worker_results.append(worker_result)
+            task_characters+=len(text)
 
-    # Collect the results from the workers
-    results=[worker_result.get() for worker_result in worker_results]
+            if task_characters >= max_characters or text_num == len(texts) - 1:
 
-    # Save each result as a batch in the hdf5 file
-    for result in results:
-        output_batch_group.create_dataset(str(batch_count), data=result)
-        batch_count+=1
-        chunk_count+=len(result)
+                yield {
+                    'texts': texts[task_start:text_num + 1],
+                    'titles': titles[task_start:text_num + 1],
+                    'page_ids': page_ids[task_start:text_num + 1]
+                }
 
-    return batch_count, chunk_count
+                task_start=text_num + 1
+                task_characters=0
 
 
-def clean_and_chunk(texts: list) -> list:
-    '''Cleans and chunks batch of text, returns list of chunks'''
+def save_batch(output: h5py.File, batch_num: int, result: dict) -> None:
+    '''Saves a parse worker result to hdf5. Chunk text goes in the batches group.
+    If configured, the chunk token ids are saved as one flat array per batch with
+    an offsets array marking where each chunk starts and ends. Arrow outputs get
+    the result as one record batch, with the token ids as a list column.'''
+
+    if intermediate.use_arrow() is True:
+
+        columns={'text': result['chunks']}
+
+        if config.STORE_TOKEN_IDS is True:
+            columns['token_ids']=(result['token_ids'], result['token_offsets'])
+
+        intermediate.write_record_batch(output, 'parsed', columns)
+
+        return
+
+    output.create_dataset(f'batches/{batch_num}', data=result['chunks'])
+
+    if config.STORE_TOKEN_IDS is True:
+        output.create_dataset(f'token_ids/{batch_num}', data=result['token_ids'])
+        output.create_dataset(f'token_offsets/{batch_num}', data=result['token_offsets'])
+
+
+def parse_batch(batch: dict) -> dict:
+    '''Takes an extracted batch of texts with their article titles and page ids,
+    or a range descriptor of one in an Arrow file, cleans and chunks the texts.
+    Returns the parse result with the titles and page ids attached, so that
+    chunks can be traced back to their article.'''
+
+    # Read the rows a range descriptor points to straight from the file
+    if 'file' in batch:
+        batch=intermediate.read_extracted_range(batch)
+
+    result=clean_and_chunk(batch['texts'], batch['titles'], batch['page_ids'])
+    result['titles']=batch['titles']
+    result['page_ids']=batch['page_ids']
+
+    return result
+
+
+@functools.cache
+def load_tokenizers() -> tuple:
+    '''Returns the semantic chunk splitter and the tokenizer for the chunk token ids.
+    Loaded once per worker process, rather than for every task.'''
 
     # Fire up the semantic chunk splitter
     tokenizer=Tokenizer.from_pretrained(config.TOKENIZER_NAME)
     splitter=TextSplitter.from_huggingface_tokenizer(tokenizer, config.MAX_TOKENS)
 
-    # Holder for results
+    # Separate tokenizer for the chunk token ids, with special
+    # tokens added and truncated to the model's input size
+    encoder=Tokenizer.from_pretrained(config.TOKENIZER_NAME)
+    encoder.enable_truncation(config.MAX_TOKENS)
+
+    return splitter, encoder
+
+
+def clean_and_chunk(texts: list, titles: list = None, page_ids: list = None) -> dict:
+    '''Cleans and chunks batch of text. Returns dictionary with the list of chunks, the
+    token ids of all of the chunks as one flat array, the offsets of each chunk in that
+    array, the position in texts of the text each chunk came from and the batch's
+    watchdog report, which names articles by their titles and page ids if given.'''
+
+    # Get the worker's chunk splitter and tokenizer
+    splitter, encoder=load_tokenizers()
+
+    # Holders for results
     transformed_text=[]
+    record_nums=[]
+
+    # Slowest and quarantined articles in this batch
+    report=watchdog.new_report()
 
     # Loop on texts in the batch
-    for text in texts:
+    for record_num, text in enumerate(texts):
 
         # Do some string replacements
         text=fix_bad_symbols(text)
@@ -68,13 +130,54 @@ def clean_and_chunk(texts: list) -> list:
         # Clean up newlines
         text=clean_newlines(text)
 
-        # Split the text into chunks
-        chunks=splitter.chunks(text)
+        # Split the text into chunks. Articles over the time or memory
+        # budget only get their beginning chunked, or are dropped
+        chunks=watchdog.run_guarded(
+            splitter.chunks,
+            lambda text: splitter.chunks(text[:config.WATCHDOG_RETRY_CHARACTERS]),
+            text,
+            page_ids[record_num] if page_ids is not None else record_num,
+            titles[record_num] if titles is not None else None,
+            report
+        )
+
+        if chunks is None:
+            continue
 
         # Add the chunks to the result
         transformed_text.extend(chunks)
+        record_nums.extend([record_num] * len(chunks))
+
+    # Encode all of the chunks in one call
+    encodings=encoder.encode_batch(transformed_text)
+
+    # Flatten the token ids and record where each chunk's ids start and end
+    token_offsets=np.zeros(len(encodings) + 1, dtype=np.int64)
+    token_offsets[1:]=np.cumsum([len(encoding.ids) for encoding in encodings])
+
+    token_ids=np.fromiter(
+        (token_id for encoding in encodings for token_id in encoding.ids),
+        dtype=config.TOKEN_ID_DTYPE,
+        count=token_offsets[-1]
+    )
+
+    result={
+        'chunks': transformed_text,
+        'token_ids': token_ids,
+        'token_offsets': token_offsets,
+        'record_nums': record_nums,
+        'watchdog': report
+    }
+
+    return result
+
+
+def yield_chunk_token_ids(token_ids: np.ndarray, token_offsets: np.ndarray):
+    '''Takes a batch's flat token id array and chunk offsets, yields
+    the token ids of each chunk.'''
 
-    return transformed_text
+    for start, end in zip(token_offsets[:-1], token_offsets[1:]):
+        yield token_ids[start:end]
 
 
 def fix_bad_symbols(source_string: str) -> str:
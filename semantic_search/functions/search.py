@@ -0,0 +1,106 @@
+'''Semantic search tool. Embeds a query, runs a KNN search against the vector
+index and hydrates the hits with chunk text, title and page id from the side store.'''
+
+# Standard imports
+import json
+import pathlib
+
+# Internal imports
+import semantic_search.configuration as config
+import semantic_search.functions.embedding as embed_funcs
+import semantic_search.functions.opensearch_loader as loader_funcs
+import semantic_search.functions.side_store as side_store
+import semantic_search.functions.luigi_helper as helper
+
+def run(data_source: str, query: str) -> list:
+    '''Takes data source name and query string, returns list of search hits
+    as dictionaries with score, chunk id, page id, title and chunk text.'''
+
+    # Load the data source configuration
+    source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
+
+    with open(source_config_path, encoding='UTF-8') as source_config_file:
+        source_config=json.load(source_config_file)
+
+    # Embed the query with the same model used for the index
+    tokenizer, model=embed_funcs.load_model('cpu')
+    query_embedding, _, _=embed_funcs.calculate_embeddings([query], tokenizer, model, 'cpu')
+
+    # Search the index, the documents only hold vectors so skip the source
+    query_body={
+        'size': config.SEARCH_RESULTS,
+        '_source': False,
+        'query': {
+            'knn': {
+                'text_embedding': {
+                    'vector': query_embedding[0].tolist(),
+                    'k': config.SEARCH_RESULTS
+                }
+            }
+        }
+    }
+
+    client=loader_funcs.start_client()
+    response=client.search(body=query_body, index=source_config['target_index_name'])
+    client.close()
+
+    hits=response['hits']['hits']
+
+    # Fetch the payloads for all of the hits from the side stores
+    chunks=fetch_hit_chunks(source_config['target_index_name'], [int(hit['_id']) for hit in hits])
+
+    # Holder for results
+    results=[]
+
+    for hit in hits:
+
+        chunk_id=int(hit['_id'])
+        page_id, title, text=chunks.get(chunk_id, (None, None, None))
+
+        results.append({
+            'score': hit['_score'],
+            'chunk_id': chunk_id,
+            'page_id': page_id,
+            'title': title,
+            'text': text
+        })
+
+    return results
+
+
+def fetch_hit_chunks(index_name: str, chunk_ids: list) -> dict:
+    '''Takes index name and list of chunk ids, fetches their payloads in one batch per
+    side store. Sharded runs have a store per shard, which is picked out of the chunk
+    id. Streaming runs have a single store for the whole index.'''
+
+    chunks={}
+
+    # Group the chunk ids by shard
+    shard_chunk_ids={}
+
+    for chunk_id in chunk_ids:
+        shard_chunk_ids.setdefault(chunk_id // config.SHARD_CHUNK_ID_STRIDE, []).append(chunk_id)
+
+    for shard, shard_ids in shard_chunk_ids.items():
+
+        store_file=helper.data_file(index_name, config.SIDE_STORE, shard)
+
+        if pathlib.Path(store_file).exists() is False:
+            store_file=helper.data_file(index_name, config.SIDE_STORE)
+
+        store=side_store.open_store(store_file)
+        chunks.update(side_store.fetch_chunks(store, shard_ids))
+        store.close()
+
+    return chunks
+
+
+def print_results(results: list) -> None:
+    '''Prints search hits with a short snippet of each chunk's text.'''
+
+    for rank, result in enumerate(results, start=1):
+
+        snippet=(result['text'] or '').replace('\n', ' ')[:200]
+
+        print(f"{rank}. {result['title']} (page id: {result['page_id']}, score: {result['score']:.4f})")
+        print(f'   {snippet}\n')
@@ -0,0 +1,98 @@
+'''Record decoding for CirrusSearch JSON lines. Lines are pre-filtered at the byte
+level so that records we would throw away are never decoded, the rest are decoded
+with orjson if it is installed, otherwise with the standard library, and only the
+fields we need are kept, in a compact typed record. Walking the raw line in Python
+to decode single fields turned out slower than either C decoder on whole records.
+The keyword search record decoder uses the same decoder, encoder and prefilter.'''
+
+# Standard imports
+import json
+from typing import NamedTuple
+
+# PyPI imports, orjson is optional
+try:
+    import orjson # pylint: disable = import-error
+    FAST_DECODER=True
+
+except ImportError:
+    FAST_DECODER=False
+
+# Decoder for whole records, orjson if we have it
+loads=orjson.loads if FAST_DECODER is True else json.loads
+
+# Category of disambiguation pages, which we skip
+DISAMBIGUATION=b'Disambiguation pages'
+
+
+class ArticleRecord(NamedTuple):
+    '''The fields of a CirrusSearch record used by the pipelines.'''
+
+    title: str
+    namespace: int
+    category: list
+    text: str
+
+
+def dumps(record: dict) -> bytes:
+    '''Encodes record as compact JSON bytes, with orjson if we have it.'''
+
+    if FAST_DECODER is True:
+        return orjson.dumps(record)
+
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def in_namespace(line: bytes, namespace: int) -> bool:
+    '''Cheap byte level namespace check on a CirrusSearch record line. Quotes inside
+    string values are escaped, so the key can't show up anywhere else, and the value
+    has to end at the next comma or brace, so namespace 1 doesn't match 10.'''
+
+    key=f'"namespace":{namespace}'.encode('utf-8')
+
+    return key + b',' in line or key + b'}' in line
+
+
+def prefilter(line: bytes) -> bool:
+    '''Cheap byte level check. Returns False for lines which can't be namespace 0
+    articles, i.e. where the decoded record would be thrown away anyway. Lines
+    which pass still have to be checked once decoded.'''
+
+    return in_namespace(line, 0)
+
+
+def decode_article(line: bytes, text_field: str = 'text', skip_disambiguation: bool = True) -> ArticleRecord:
+    '''Takes CirrusSearch record line, returns ArticleRecord with the text taken from
+    text_field, or None if the record is not a namespace 0 article, is a disambiguation
+    page (unless asked not to skip them) or is missing any of the fields.'''
+
+    # Reject lines without decoding them where we can
+    if prefilter(line) is False:
+        return None
+
+    record=decode_fields(line, ('namespace', 'title', 'category', text_field))
+
+    try:
+        article=ArticleRecord(record['title'], record['namespace'], record['category'], record[text_field])
+
+    except KeyError:
+        return None
+
+    if article.namespace != 0:
+        return None
+
+    # Only look through the categories if the name shows up somewhere in the line
+    if skip_disambiguation is True and DISAMBIGUATION in line and 'Disambiguation pages' in article.category:
+        return None
+
+    return article
+
+
+def decode_fields(line: bytes, fields: tuple) -> dict:
+    '''Takes JSON object line and tuple of top level keys, returns dictionary of just
+    those keys and their values, so the rest of the record can be freed right away.
+    Keys which are not in the record are left out, so missing fields raise KeyError
+    like they would on the full record.'''
+
+    record=loads(line)
+
+    return {field: record[field] for field in fields if field in record}
@@ -0,0 +1,154 @@
+'''Batch handoff to and from pool workers through shared memory. The strings and
+arrays in a batch are packed into one shared memory segment, strings as one utf-8
+buffer with an offsets array, and only the segment's name and layout are pickled.
+The receiving side copies the batch out and unlinks the segment, so each segment
+lives from pack to unpack. Segment names start with the stage's prefix, so that
+any left behind by a failed stage or worker can be found and removed.'''
+
+# Standard imports
+import os
+import pathlib
+import itertools
+from multiprocessing import shared_memory, resource_tracker
+
+# PyPI imports
+import numpy as np
+
+# Counter for unique segment names within a process
+_segment_count=itertools.count()
+
+
+def new_prefix() -> str:
+    '''Returns a segment name prefix for a stage run. Call before starting the
+    stage's pool, so that the workers share the resource tracker of the process
+    which starts them, rather than each starting their own. Shared memory names
+    are short on some platforms, so the prefix is too.'''
+
+    resource_tracker.ensure_running()
+
+    return f'ss{os.getpid()}_{next(_segment_count)}_'
+
+
+def pack(batch: dict, prefix: str) -> dict:
+    '''Takes dictionary batch, packs its lists of strings or bytes and its numpy
+    arrays into a new shared memory segment. Returns the packed batch, i.e. the
+    segment's name and layout, with the batch's other values as they are.'''
+
+    packed={'segment': None, 'strings': {}, 'arrays': {}, 'values': {}}
+
+    # Sort the batch's values into strings, arrays and everything else
+    encoded=[]
+    arrays=[]
+
+    for key, value in batch.items():
+
+        if isinstance(value, np.ndarray):
+            arrays.append((key, np.ascontiguousarray(value)))
+
+        elif isinstance(value, list) and all(isinstance(item, (str, bytes)) for item in value):
+
+            is_text=len(value) == 0 or isinstance(value[0], str)
+            packed['strings'][key]=(len(encoded), len(value), is_text)
+            encoded.extend(item.encode('utf-8') if is_text is True else item for item in value)
+
+        else:
+            packed['values'][key]=value
+
+    # Nothing to put in shared memory, e.g. an Arrow range descriptor
+    if len(packed['strings']) == 0 and len(arrays) == 0:
+        return packed
+
+    # Segment layout is the string offsets, the string data then the arrays
+    offsets=np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:]=np.cumsum([len(item) for item in encoded])
+
+    data_start=offsets.nbytes
+    position=data_start + int(offsets[-1])
+
+    for key, array in arrays:
+        packed['arrays'][key]=(array.dtype.str, array.shape, position)
+        position+=array.nbytes
+
+    packed['segment']=f'{prefix}{os.getpid()}_{next(_segment_count)}'
+    packed['string_count']=len(encoded)
+
+    segment=shared_memory.SharedMemory(name=packed['segment'], create=True, size=max(position, 1))
+
+    segment.buf[:data_start]=offsets.tobytes()
+    segment.buf[data_start:data_start + int(offsets[-1])]=b''.join(encoded)
+
+    for key, array in arrays:
+        _, _, array_start=packed['arrays'][key]
+        segment.buf[array_start:array_start + array.nbytes]=array.tobytes()
+
+    segment.close()
+
+    return packed
+
+
+def unpack(packed: dict) -> dict:
+    '''Takes packed batch, copies the batch out of its shared memory segment and
+    unlinks the segment. Returns the batch as it was given to pack.'''
+
+    batch=dict(packed['values'])
+
+    if packed['segment'] is None:
+        return batch
+
+    segment=shared_memory.SharedMemory(name=packed['segment'])
+
+    try:
+
+        # Copy everything out of the segment before it is closed
+        offsets=np.frombuffer(segment.buf, dtype=np.int64, count=packed['string_count'] + 1).copy()
+        data_start=offsets.nbytes
+        data=bytes(segment.buf[data_start:data_start + int(offsets[-1])])
+
+        for key, (dtype, shape, array_start) in packed['arrays'].items():
+            batch[key]=np.frombuffer(
+                segment.buf,
+                dtype=np.dtype(dtype),
+                count=int(np.prod(shape)),
+                offset=array_start
+            ).reshape(shape).copy()
+
+    finally:
+        segment.close()
+        segment.unlink()
+
+    for key, (first, count, is_text) in packed['strings'].items():
+
+        items=[data[start:end] for start, end in zip(offsets[first:first + count], offsets[first + 1:first + count + 1])]
+        batch[key]=[item.decode('utf-8') for item in items] if is_text is True else items
+
+    return batch
+
+
+def handoff(function, prefix: str, packed: dict) -> dict:
+    '''Worker side, unpacks a batch, runs function on it and returns the result
+    packed into a new segment for the main process to unpack.'''
+
+    return pack(function(unpack(packed)), prefix)
+
+
+def remove_segments(prefix: str) -> int:
+    '''Unlinks any segments with prefix which were never unpacked, e.g. batches
+    read ahead of a failed stage. Returns the number removed. Only finds segments
+    where shared memory is mounted at /dev/shm, elsewhere the resource tracker
+    removes them when the stage's process exits.'''
+
+    removed=0
+
+    for path in pathlib.Path('/dev/shm').glob(f'{prefix}*'):
+
+        try:
+            segment=shared_memory.SharedMemory(name=path.name)
+
+        except FileNotFoundError:
+            continue
+
+        segment.close()
+        segment.unlink()
+        removed+=1
+
+    return removed
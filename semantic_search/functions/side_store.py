@@ -0,0 +1,71 @@
+'''Functions for the local chunk side store. Keeps chunk text, article title
+and page id in SQLite, keyed by the same id as the chunk's vector in the
+KNN index, so the index itself only has to hold vectors.'''
+
+# Standard imports
+import sqlite3
+import pathlib
+
+# Internal imports
+import semantic_search.configuration as config
+
+def open_store(store_file: str, create: bool = False) -> sqlite3.Connection:
+    '''Opens the side store. If create is True, any old store is removed and
+    a new, empty one is set up for fast bulk writing.'''
+
+    if create is True:
+        pathlib.Path(store_file).unlink(missing_ok=True)
+
+    connection=sqlite3.connect(store_file, check_same_thread=False)
+
+    if create is True:
+
+        # We write the store from scratch every run, so we don't need a journal
+        connection.execute('PRAGMA journal_mode=OFF')
+        connection.execute('PRAGMA synchronous=OFF')
+
+        connection.execute(
+            'CREATE TABLE chunks ('
+            'chunk_id INTEGER PRIMARY KEY, '
+            'page_id INTEGER, '
+            'title TEXT, '
+            'text TEXT)'
+        )
+
+    return connection
+
+
+def write_chunks(connection: sqlite3.Connection, first_chunk_id: int, result: dict) -> None:
+    '''Takes a parse worker result and the id of its first chunk, writes a
+    row with the text, article title and page id of each chunk.'''
+
+    rows=(
+        (first_chunk_id + i, int(result['page_ids'][record_num]), result['titles'][record_num], chunk)
+        for i, (chunk, record_num) in enumerate(zip(result['chunks'], result['record_nums']))
+    )
+
+    connection.executemany('INSERT INTO chunks VALUES (?, ?, ?, ?)', rows)
+    connection.commit()
+
+
+def fetch_chunks(connection: sqlite3.Connection, chunk_ids: list) -> dict:
+    '''Takes list of chunk ids, returns dictionary of chunk id to
+    (page id, title, text) tuples, fetched in as few queries as possible.'''
+
+    chunks={}
+
+    # SQLite limits the number of parameters in a single query
+    for i in range(0, len(chunk_ids), config.SIDE_STORE_FETCH_SIZE):
+
+        id_batch=[int(chunk_id) for chunk_id in chunk_ids[i:i + config.SIDE_STORE_FETCH_SIZE]]
+        placeholders=','.join('?' * len(id_batch))
+
+        rows=connection.execute(
+            f'SELECT chunk_id, page_id, title, text FROM chunks WHERE chunk_id IN ({placeholders})',
+            id_batch
+        )
+
+        for chunk_id, page_id, title, text in rows:
+            chunks[chunk_id]=(page_id, title, text)
+
+    return chunks
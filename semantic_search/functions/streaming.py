@@ -0,0 +1,394 @@
+'''Streaming execution mode for the ETL pipeline. Runs extraction, parsing,
+embedding and loading concurrently as a bounded pipeline instead of four
+stages which each have to finish before the next one starts.'''
+
+# Standard imports
+import time
+import json
+import pathlib
+import functools
+import threading
+import multiprocessing as mp
+
+# PyPI imports
+import h5py
+import numpy as np
+
+# Internal imports
+import semantic_search.configuration as config
+import semantic_search.functions.embedding as embed_funcs
+import semantic_search.functions.parsing as parse_funcs
+import semantic_search.functions.opensearch_loader as loader_funcs
+import semantic_search.functions.side_store as side_store
+import semantic_search.functions.wikipedia_extractor as wikipedia_funcs
+import semantic_search.functions.watchdog as watchdog
+import semantic_search.functions.dispatch as dispatch
+import semantic_search.functions.intermediate as intermediate
+import semantic_search.functions.tuning as tuning
+
+# Source specific batch generator and extraction worker function
+# for each extractor function named in a data source configuration
+STREAMING_EXTRACTORS={
+    'wikipedia_extractor': (
+        wikipedia_funcs.yield_line_batches,
+        wikipedia_funcs.extract_wikipedia_text
+    )
+}
+
+
+def stream_data(data_source: str, checkpoints: bool = False) -> dict:
+    '''Runs the whole pipeline as a stream. Batches flow from the reader to the
+    extraction and parse pools, on to the embedding workers and finally to OpenSearch
+    as soon as they are produced. Optionally saves each stage's output to the usual
+    intermediate files as a checkpoint.'''
+
+    # Load the data source configuration
+    source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
+
+    with open(source_config_path, encoding='UTF-8') as source_config_file:
+        source_config=json.load(source_config_file)
+
+    # Start the streaming summary with the data from the source configuration
+    streaming_summary=source_config
+
+    # Pick the batch generator and extraction worker for this data source
+    batch_generator, extractor_worker=STREAMING_EXTRACTORS[source_config['extractor_function']]
+
+    # Split the CPUs between the extraction and parse pools
+    n_extract_workers=max((mp.cpu_count() - 1) // 2, 1)
+    n_parse_workers=max(mp.cpu_count() - 1 - n_extract_workers, 1)
+
+    # Use the tune task's recommended embedding settings, if there are any
+    if config.USE_TUNED_EMBEDDING_CONFIG is True:
+        streaming_summary['tuned_embedding_settings']=tuning.load_recommended_config()
+
+    embedding_devices=embed_funcs.worker_devices()
+    embedding_placements=None
+
+    # Pin CPU embedding workers to their own cores. There is no parsed
+    # text to calibrate on yet, so the configured number of workers is used
+    if config.CPU_TOPOLOGY_PINNING is True and all(device == 'cpu' for device in embedding_devices):
+        embedding_placements, topology_summary=embed_funcs.plan_cpu_workers(len(embedding_devices))
+        embedding_devices=['cpu'] * len(embedding_placements)
+        streaming_summary.update(topology_summary)
+
+    n_embedding_workers=len(embedding_devices)
+
+    # Open checkpoint files if asked
+    checkpoint_files=open_checkpoints(source_config, checkpoints)
+
+    # Start a new side store for the chunk text, titles and page ids
+    store=side_store.open_store(
+        f"{config.DATA_PATH}/{source_config['target_index_name']}/{config.SIDE_STORE}",
+        create=True
+    )
+
+    # Windows limit the number of batches in flight between stages so that a
+    # fast upstream stage can't fill memory while it waits for a slow one
+    extract_window=config.STREAMING_BATCHES_IN_FLIGHT * n_extract_workers
+    parse_window=config.STREAMING_BATCHES_IN_FLIGHT * n_parse_workers
+
+    # Set on a failure, stops the feeder thread before the pools are terminated
+    stop=threading.Event()
+
+    # Per stage counters, updated from the stage threads
+    counts={
+        'extracted_batches': 0,
+        'extracted_records': 0,
+        'parsed_batches': 0,
+        'output_chunks': 0,
+        'embedded_records': 0,
+        'indexed_records': 0
+    }
+
+    # Slowest and quarantined articles from each pool, updated from the stage threads
+    reports={'extraction': watchdog.new_report(), 'parse': watchdog.new_report()}
+
+    # Queues to send batches to and get embeddings back from the embedding workers
+    embedding_input_queue=mp.Queue(maxsize=2 * n_embedding_workers)
+    embedding_output_queue=mp.Queue()
+
+    # Start the timer
+    start_time=time.time()
+
+    # Start the long-lived embedding workers first, so their models are
+    # loading while the first batches are extracted and parsed
+    embedding_workers=embed_funcs.start_workers(
+        embedding_devices,
+        embedding_input_queue,
+        embedding_output_queue,
+        embedding_placements
+    )
+
+    # Start the pools, with each worker's memory limited if configured
+    extract_pool=mp.Pool(
+        processes=n_extract_workers,
+        initializer=watchdog.limit_memory,
+        initargs=(config.WATCHDOG_EXTRACT_MEMORY_LIMIT,)
+    )
+
+    parse_pool=mp.Pool(
+        processes=n_parse_workers,
+        initializer=watchdog.limit_memory,
+        initargs=(config.WATCHDOG_PARSE_MEMORY_LIMIT,)
+    )
+
+    # Chain the extraction and parse pools, each pool's results are dispatched
+    # to the next one as they finish, in whatever order they finish in. Both
+    # are submitted from the feeder thread, which takes the parse results
+    extracted_batches=dispatch.windowed_imap_unordered(
+        extract_pool,
+        functools.partial(
+            extractor_worker,
+            text_source=source_config.get('text_source', config.DEFAULT_TEXT_SOURCE)
+        ),
+        batch_generator(source_config),
+        extract_window,
+        stop
+    )
+
+    parsed_batches=dispatch.windowed_imap_unordered(
+        parse_pool,
+        parse_funcs.parse_batch,
+        pass_extracted_batches(extracted_batches, checkpoint_files, counts, reports['extraction']),
+        parse_window,
+        stop
+    )
+
+    # Feed the embedding workers from a separate thread
+    feeder=threading.Thread(
+        target=feed_embedding_workers,
+        args=(parsed_batches, embedding_input_queue,
+            embedding_workers, checkpoint_files, store, counts, reports['parse'], stop),
+        daemon=True
+    )
+
+    feeder.start()
+
+    # Index the embeddings into OpenSearch as they come back from the workers
+    loader_funcs.initialize_index(source_config['target_index_name'])
+    client=loader_funcs.start_client()
+
+    worker_summaries=[]
+
+    try:
+
+        while len(worker_summaries) < n_embedding_workers:
+
+            first_chunk_id, result=dispatch.get_checked(embedding_output_queue, embedding_workers)
+
+            if first_chunk_id == 'done':
+                worker_summaries.append(result)
+                continue
+
+            counts['embedded_records']+=len(result)
+
+            if checkpoint_files is not None:
+                embed_funcs.save_embeddings(
+                    checkpoint_files['embedded'],
+                    np.arange(first_chunk_id, first_chunk_id + len(result)),
+                    result
+                )
+
+            index_embeddings(client, first_chunk_id, result, source_config)
+            counts['indexed_records']+=len(result)
+
+    # On a failure, stop the feeder, then the embedding workers and the pools
+    except BaseException:
+
+        stop.set()
+
+        for embedding_worker in embedding_workers:
+            if embedding_worker.is_alive() is True:
+                embedding_worker.terminate()
+
+        for pool in (extract_pool, parse_pool):
+            pool.terminate()
+
+        feeder.join()
+
+        raise
+
+    # Clean up
+    feeder.join()
+
+    for embedding_worker in embedding_workers:
+        embedding_worker.join()
+
+    # Fail the run if an upstream stage failed, the workers
+    # only stopped because the feeder sent them done early
+    if 'error' in counts:
+
+        for pool in (extract_pool, parse_pool):
+            pool.terminate()
+
+        raise counts.pop('error')
+
+    for pool in (extract_pool, parse_pool):
+        pool.close()
+        pool.join()
+
+    close_checkpoints(checkpoint_files)
+    store.close()
+
+    dT=time.time() - start_time # pylint: disable = invalid-name
+
+    # Add some stuff to the summary
+    streaming_summary['run_time_seconds']=dT
+    streaming_summary['extraction_worker_processes']=n_extract_workers
+    streaming_summary['parse_worker_processes']=n_parse_workers
+    streaming_summary['embedding_worker_processes']=n_embedding_workers
+    streaming_summary['batches_in_flight_per_worker']=config.STREAMING_BATCHES_IN_FLIGHT
+    streaming_summary['checkpoints']=checkpoints
+    streaming_summary.update(counts)
+    streaming_summary['observed_indexing_rate']=counts['indexed_records'] / dT
+    streaming_summary['estimated_total_run_time']=(config.WIKIPEDIA_ESTIMATED_CHUNK_COUNT / streaming_summary['observed_indexing_rate'])
+    streaming_summary.update(embed_funcs.summarize_workers(worker_summaries))
+
+    # Watchdog results for each pool
+    for stage, quarantine_file in (('extraction', config.EXTRACTION_QUARANTINE), ('parse', config.PARSE_QUARANTINE)):
+        streaming_summary[f'{stage}_watchdog']=watchdog.summarize(
+            reports[stage],
+            f"{config.DATA_PATH}/{source_config['target_index_name']}/{quarantine_file}"
+        )
+
+    return streaming_summary
+
+
+def pass_extracted_batches(
+    extracted_batches,
+    checkpoint_files: dict,
+    counts: dict,
+    report: dict
+):
+
+    '''Takes extraction results as they finish, adds their watchdog reports
+    to report, checkpoints them if asked and yields them on to the parse pool.'''
+
+    for extracted_batch in extracted_batches:
+
+        if checkpoint_files is not None:
+            wikipedia_funcs.save_batch(checkpoint_files['extracted'], counts['extracted_batches'], extracted_batch)
+
+        counts['extracted_batches']+=1
+        counts['extracted_records']+=len(extracted_batch['texts'])
+        watchdog.merge_reports(report, extracted_batch['watchdog'])
+
+        yield extracted_batch
+
+
+def feed_embedding_workers(
+    parsed_batches,
+    input_queue: mp.Queue,
+    workers: list,
+    checkpoint_files: dict,
+    store,
+    counts: dict,
+    report: dict,
+    stop: threading.Event
+) -> None:
+
+    '''Takes parse results as they finish, writes their chunks to the side store, adds
+    their watchdog reports to report, regroups the chunks into embedding worker batches
+    and puts them on the embedding input queue. Always sends the workers their done
+    signals, even if an upstream stage fails, in which case the error is kept in
+    counts for stream_data to raise. Stops early, without the done signals, once
+    stop is set.'''
+
+    # Counter and accumulator for batch loop, chunk ids count
+    # chunks in the order they come out of the parse pool
+    chunk_count=0
+    worker_batch=[]
+
+    try:
+
+        for parsed_batch in parsed_batches:
+
+            if stop.is_set() is True:
+                return
+
+            if checkpoint_files is not None:
+                parse_funcs.save_batch(checkpoint_files['parsed'], counts['parsed_batches'], parsed_batch)
+
+            # Chunks in the side store share their ids with the vectors in the index
+            side_store.write_chunks(store, counts['output_chunks'], parsed_batch)
+
+            counts['parsed_batches']+=1
+            counts['output_chunks']+=len(parsed_batch['chunks'])
+            watchdog.merge_reports(report, parsed_batch['watchdog'])
+
+            # Send the workers the chunk token ids, so they don't have to tokenize
+            for chunk in parse_funcs.yield_chunk_token_ids(parsed_batch['token_ids'], parsed_batch['token_offsets']):
+                worker_batch.append(chunk)
+                chunk_count+=1
+
+                # If the batch is full, send it to the workers with the id of its first chunk
+                if len(worker_batch) == config.EMBEDDING_BATCH_SIZE * config.WORKER_BATCHES_PER_ROUND:
+                    dispatch.put_checked(input_queue, (chunk_count - len(worker_batch), worker_batch), workers)
+                    worker_batch=[]
+
+        # Once we reach the end of the parsed batches, make sure we submit anything left over
+        if len(worker_batch) > 0:
+            dispatch.put_checked(input_queue, (chunk_count - len(worker_batch), worker_batch), workers)
+
+    # Keep the error for stream_data to raise once the workers have stopped
+    except Exception as error: # pylint: disable = broad-exception-caught
+        counts['error']=error
+
+    # Send each worker a done signal so it shuts down once the queue is empty
+    if stop.is_set() is False:
+        for _ in workers:
+            dispatch.put_checked(input_queue, 'done', workers)
+
+
+def index_embeddings(client, first_chunk_id: int, embeddings: np.ndarray, source_config: dict) -> None:
+    '''Indexes a worker's worth of embeddings, which hold consecutive
+    chunks starting at first_chunk_id, in bulk insert sized pieces.'''
+
+    chunk_ids=np.arange(first_chunk_id, first_chunk_id + len(embeddings))
+
+    for start in range(0, len(embeddings), config.BULK_INSERT_BATCH_SIZE):
+
+        end=start + config.BULK_INSERT_BATCH_SIZE
+
+        body=loader_funcs.build_bulk_body(
+            source_config['target_index_name'],
+            chunk_ids[start:end],
+            embeddings[start:end]
+        )
+
+        loader_funcs.index_batch(client, body)
+
+
+def open_checkpoints(source_config: dict, checkpoints: bool) -> dict:
+    '''Opens the intermediate files for writing if checkpoints were asked for,
+    text files in the configured format. Returns dictionary of open files or None.'''
+
+    if checkpoints is False:
+        return None
+
+    checkpoint_files={}
+
+    for stage in ('extracted', 'parsed'):
+
+        output_file=intermediate.text_file(source_config['target_index_name'], stage)
+        pathlib.Path(output_file).unlink(missing_ok=True)
+        checkpoint_files[stage]=intermediate.open_output(output_file, stage)
+
+    output_file=f"{config.DATA_PATH}/{source_config['target_index_name']}/{config.EMBEDDED_TEXT}"
+    pathlib.Path(output_file).unlink(missing_ok=True)
+    checkpoint_files['embedded']=h5py.File(output_file, 'w')
+
+    embed_funcs.create_output(checkpoint_files['embedded'])
+
+    return checkpoint_files
+
+
+def close_checkpoints(checkpoint_files: dict) -> None:
+    '''Closes the checkpoint files, if any.'''
+
+    if checkpoint_files is None:
+        return
+
+    for checkpoint_file in checkpoint_files.values():
+        checkpoint_file.close()
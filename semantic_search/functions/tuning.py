@@ -0,0 +1,252 @@
+'''Embedding throughput tuner. Runs the embedding workers on a sample of parsed chunks
+for each candidate worker count and thread count on the available devices, then for
+each token budget on the fastest layout. Writes the fastest settings which fit the
+memory limit to a recommended configuration file, which the embed stage loads over
+the configuration module's values.'''
+
+# Standard imports
+import json
+import time
+import pathlib
+
+# PyPI imports
+import torch
+
+# Internal imports
+import semantic_search.configuration as config
+import semantic_search.functions.embedding as embed_funcs
+import semantic_search.functions.cpu_topology as cpu_topology
+import semantic_search.functions.intermediate as intermediate
+import semantic_search.functions.parsing as parse_funcs
+
+# Configuration values the tuner sets and the recommended configuration may override
+TUNED_SETTINGS=[
+    'WORKER_GPUS',
+    'ONNX_WORKERS',
+    'CPU_WORKER_THREADS',
+    'ONNX_INTRA_OP_THREADS',
+    'CPU_THREADS_PER_WORKER',
+    'CPU_TOPOLOGY_CALIBRATE',
+    'EMBEDDING_TOKEN_BUDGET'
+]
+
+
+def run(data_source: str) -> dict:
+    '''Tunes the embedding workers on the data source's parsed text,
+    writes the recommended configuration. Returns dictionary of results.'''
+
+    # Load the data source configuration
+    source_config_path=f'{config.DATA_SOURCE_CONFIG_PATH}/{data_source}.json'
+
+    with open(source_config_path, encoding='UTF-8') as source_config_file:
+        source_config=json.load(source_config_file)
+
+    # Start the tuning summary with the data from the source configuration
+    tuning_summary=source_config
+    tuning_summary['embedding_backend']=config.EMBEDDING_BACKEND
+
+    sample=read_sample(source_config['target_index_name'], config.TUNE_SAMPLE_CHUNKS)
+    tuning_summary['sample_chunks']=len(sample)
+
+    # Sweep the worker layouts at the configured token budget
+    results=[measure(settings, sample) for settings in candidate_layouts()]
+    best=pick_best(results)
+
+    # Then the token budgets with the fastest layout
+    for token_budget in config.TUNE_TOKEN_BUDGETS:
+        if token_budget != config.EMBEDDING_TOKEN_BUDGET:
+            results.append(measure({**best['settings'], 'EMBEDDING_TOKEN_BUDGET': token_budget}, sample))
+
+    best=pick_best(results)
+
+    tuning_summary['results']=results
+    tuning_summary['recommended_settings']=best['settings']
+
+    # Write the recommended configuration
+    recommended_config={
+        'embedding_backend': config.EMBEDDING_BACKEND,
+        'tuned_on': source_config['target_index_name'],
+        'tuned_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'embedding_rate': best['embedding_rate'],
+        'total_peak_rss_bytes': best['total_peak_rss_bytes'],
+        'settings': best['settings']
+    }
+
+    pathlib.Path(config.TUNED_EMBEDDING_CONFIG).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(config.TUNED_EMBEDDING_CONFIG, 'w', encoding='UTF-8') as output_file:
+        json.dump(recommended_config, output_file, indent=4)
+
+    tuning_summary['tuned_embedding_config']=config.TUNED_EMBEDDING_CONFIG
+
+    return tuning_summary
+
+
+def read_sample(index_name: str, n_chunks: int) -> list:
+    '''Returns the first n_chunks chunks of the index's parsed text, from the first
+    shard if the pipeline was sharded, as the embedding workers get them.'''
+
+    for shard in (0, None):
+
+        input_file_path=intermediate.text_file(index_name, 'parsed', shard)
+
+        if pathlib.Path(input_file_path).exists() is True:
+            break
+
+    else:
+        raise FileNotFoundError(f'No parsed text for {index_name}, run the pipeline up to the parse step first')
+
+    input_data=intermediate.open_input(input_file_path)
+    sample=read_chunk_sample(input_data, n_chunks)
+    intermediate.close_input(input_data)
+
+    return sample
+
+
+def read_chunk_sample(input_data, n_chunks: int) -> list:
+    '''Returns the first n_chunks chunks of the parsed text, as token ids if the parse
+    step saved them, otherwise as text, the same way the embedding workers get them.'''
+
+    sample=[]
+
+    for batch_num in intermediate.batch_nums(input_data):
+
+        if intermediate.has_token_ids(input_data) is True:
+            sample.extend(parse_funcs.yield_chunk_token_ids(*intermediate.read_token_ids(input_data, batch_num)))
+
+        else:
+            sample.extend(text.decode('utf-8') for text in intermediate.read_texts(input_data, batch_num))
+
+        if len(sample) >= n_chunks:
+            break
+
+    return sample[:n_chunks]
+
+
+def candidate_layouts() -> list:
+    '''Returns list of the worker layouts to try, as dictionaries of configuration
+    values. Every TUNE_WORKER_COUNTS count per GPU, if there are any and the backend
+    is torch, and every count and TUNE_THREAD_COUNTS thread count on the CPU that
+    doesn't need more threads than there are physical cores.'''
+
+    candidates=[]
+
+    # GPU workers, threads only matter for CPU workers
+    if config.EMBEDDING_BACKEND == 'torch' and torch.cuda.is_available() is True:
+
+        gpus=[f'cuda:{gpu}' for gpu in range(torch.cuda.device_count())]
+
+        for n_workers in config.TUNE_WORKER_COUNTS:
+            candidates.append({'WORKER_GPUS': gpus * n_workers})
+
+    # CPU workers, with the configured worker count calibration turned
+    # off so that the embed stage runs the tuned count
+    n_cores=len(cpu_topology.read_topology())
+
+    for n_workers in config.TUNE_WORKER_COUNTS:
+        for threads in config.TUNE_THREAD_COUNTS:
+
+            if n_workers * threads > n_cores:
+                continue
+
+            settings={'CPU_THREADS_PER_WORKER': threads, 'CPU_TOPOLOGY_CALIBRATE': False}
+
+            if config.EMBEDDING_BACKEND == 'onnx':
+                settings.update({'ONNX_WORKERS': n_workers, 'ONNX_INTRA_OP_THREADS': threads})
+
+            else:
+                settings.update({'WORKER_GPUS': ['cpu'] * n_workers, 'CPU_WORKER_THREADS': threads})
+
+            candidates.append(settings)
+
+    return candidates
+
+
+def measure(settings: dict, sample: list) -> dict:
+    '''Runs the embedding workers with settings applied, the way the embed stage
+    starts them, on TUNE_ROUNDS copies of sample each. Returns dictionary of the
+    settings with the workers' combined embedding rate and total peak RSS, or with
+    the error if the layout couldn't be started or a worker died, e.g. ran out of
+    memory, so the sweep can go on.'''
+
+    devices=None
+    placements=None
+
+    previous_settings=apply_settings(settings)
+
+    try:
+        devices=embed_funcs.worker_devices()
+
+        if config.CPU_TOPOLOGY_PINNING is True and all(device == 'cpu' for device in devices):
+            placements, _=embed_funcs.plan_cpu_workers(len(devices))
+
+        worker_summary=embed_funcs.measure_workers(devices, placements, sample, config.TUNE_ROUNDS)
+
+    # Record the layout as failed
+    except (RuntimeError, MemoryError, OSError) as error:
+        return {
+            'settings': settings,
+            'workers': len(devices) if devices is not None else None,
+            'failed': f'{type(error).__name__}: {error}'
+        }
+
+    finally:
+        apply_settings(previous_settings)
+
+    return {
+        'settings': settings,
+        'workers': len(devices),
+        'failed': None,
+        'embedding_rate': worker_summary['steady_state_embedding_rate'],
+        'token_rate': worker_summary['steady_state_token_rate'],
+        'padding_ratio': worker_summary['padding_ratio'],
+        'total_peak_rss_bytes': worker_summary['total_peak_rss_bytes'],
+        'max_model_load_time_seconds': worker_summary['max_model_load_time_seconds']
+    }
+
+
+def pick_best(results: list) -> dict:
+    '''Returns the fastest result which didn't fail and whose peak
+    RSS is within TUNE_MAX_RSS_BYTES.'''
+
+    allowed=[
+        result for result in results
+        if result['failed'] is None
+        and (config.TUNE_MAX_RSS_BYTES is None or result['total_peak_rss_bytes'] <= config.TUNE_MAX_RSS_BYTES)
+    ]
+
+    if len(allowed) == 0:
+        raise ValueError(f'No embedding worker layout ran and fit in TUNE_MAX_RSS_BYTES={config.TUNE_MAX_RSS_BYTES}')
+
+    return max(allowed, key=lambda result: result['embedding_rate'])
+
+
+def apply_settings(settings: dict) -> dict:
+    '''Sets configuration values, returns dictionary of the values they replaced.'''
+
+    previous_settings={name: getattr(config, name) for name in settings}
+
+    for name, value in settings.items():
+        setattr(config, name, value)
+
+    return previous_settings
+
+
+def load_recommended_config() -> dict:
+    '''Applies the recommended configuration's settings, if there is one and it was
+    tuned for the configured embedding backend. Returns the settings applied, or
+    None. Workers started afterwards, which are forked, see the new values.'''
+
+    if pathlib.Path(config.TUNED_EMBEDDING_CONFIG).exists() is False:
+        return None
+
+    with open(config.TUNED_EMBEDDING_CONFIG, encoding='UTF-8') as input_file:
+        recommended_config=json.load(input_file)
+
+    if recommended_config['embedding_backend'] != config.EMBEDDING_BACKEND:
+        return None
+
+    settings={name: value for name, value in recommended_config['settings'].items() if name in TUNED_SETTINGS}
+    apply_settings(settings)
+
+    return settings
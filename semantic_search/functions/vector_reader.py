@@ -0,0 +1,105 @@
+'''Functions for reading embedding vectors from hdf5 in large blocks, with
+a prefetch thread so that disk reads overlap with indexing.'''
+
+# Standard imports
+import queue
+import threading
+
+# PyPI imports
+import h5py
+import numpy as np
+
+# Internal imports
+import semantic_search.configuration as config
+
+def read_vector_blocks(input_file_path: str, start: int = 0):
+    '''Generator, yields (offset, chunk ids, vectors) tuples for consecutive blocks
+    of rows of the embedding dataset, starting at row start. A background thread
+    reads ahead, so the next blocks are already in memory while the caller works
+    on this one.'''
+
+    # Queue of blocks read ahead by the prefetch thread
+    block_queue=queue.Queue(maxsize=config.VECTOR_PREFETCH_BLOCKS)
+
+    # Start the prefetch thread
+    prefetcher=threading.Thread(
+        target=prefetch_blocks,
+        args=(input_file_path, start, block_queue),
+        daemon=True
+    )
+
+    prefetcher.start()
+
+    # Hand out blocks until the prefetch thread says it is done
+    while True:
+
+        block=block_queue.get()
+
+        if block == 'done':
+            break
+
+        # Pass along any error from the prefetch thread
+        if isinstance(block, Exception):
+            raise block
+
+        yield block
+
+    prefetcher.join()
+
+
+def prefetch_blocks(input_file_path: str, start: int, block_queue: queue.Queue) -> None:
+    '''Reads the embedding and chunk id datasets in large contiguous blocks
+    and puts them on the block queue. Sends done when the input runs out.'''
+
+    try:
+
+        with h5py.File(input_file_path, 'r') as input_data:
+
+            embeddings=input_data['embeddings']
+            chunk_ids=input_data['chunk_ids'][()]
+
+            # Memory map the vectors if we can, otherwise read slabs
+            vectors=memory_map(input_file_path, embeddings)
+
+            for offset in range(start, len(embeddings), config.VECTOR_READ_BLOCK_ROWS):
+
+                end=min(offset + config.VECTOR_READ_BLOCK_ROWS, len(embeddings))
+
+                if vectors is not None:
+                    block=vectors[offset:end]
+
+                # One read call for the whole block, straight into a new array
+                else:
+                    block=np.empty((end - offset, embeddings.shape[1]), dtype=embeddings.dtype)
+                    embeddings.read_direct(block, source_sel=np.s_[offset:end])
+
+                block_queue.put((offset, chunk_ids[offset:end], block))
+
+    # Send any error to the consumer, rather than leaving it waiting forever
+    except Exception as error: # pylint: disable = broad-exception-caught
+        block_queue.put(error)
+
+    block_queue.put('done')
+
+
+def memory_map(input_file_path: str, embeddings: h5py.Dataset) -> np.memmap:
+    '''Returns a read only memory map of the embedding dataset if it is stored
+    contiguously and uncompressed in the file, e.g. after repacking it with
+    h5repack -l CONTI. Returns None for chunked or compressed datasets.'''
+
+    if embeddings.chunks is not None or embeddings.compression is not None:
+        return None
+
+    offset=embeddings.id.get_offset()
+
+    # Datasets which have never been written to have no storage yet
+    if offset is None:
+        return None
+
+    return np.memmap(
+        input_file_path,
+        mode='r',
+        dtype=embeddings.dtype,
+        offset=offset,
+        shape=embeddings.shape
+    )
@@ -0,0 +1,209 @@
+'''Per-article time and memory budgets for the extraction and parse workers. Articles
+which go over budget are quarantined, i.e. recorded with their page id and timings,
+and optionally retried with a cheaper cleaning path, so that a few pathological pages
+can't hold up a whole round of batches. Every worker result also carries the timings
+of its slowest articles, which are merged into a report for the run.
+
+The time budget is enforced with SIGALRM, which Python only handles between bytecodes,
+so an article stuck inside a single call into C or Rust code is only stopped once that
+call returns. Articles over WATCHDOG_MAX_CHARACTERS skip straight to the cheap path
+for that reason. The memory budget is a limit on how far each worker's address space may
+grow past what it inherited from the process which forked it, set when the pool starts,
+and shows up as a MemoryError in the article which hits it. A stage fails if more than
+WATCHDOG_MAX_DROPPED_FRACTION of its articles were dropped.'''
+
+# Standard imports
+import os
+import json
+import time
+import heapq
+import signal
+import resource
+import threading
+import contextlib
+
+# Internal imports
+import semantic_search.configuration as config
+
+class PageTimeout(Exception):
+    '''Raised in a worker when an article runs over its time budget.'''
+
+
+def limit_memory(memory_limit: int = None) -> None:
+    '''Pool initializer, limits the worker's address space to memory_limit bytes
+    more than it started with. Workers forked from a process which has loaded
+    torch or the tokenizers inherit gigabytes of mapped address space, which
+    would otherwise use up the budget before the first article. Does nothing
+    if memory_limit is None.'''
+
+    if memory_limit is None:
+        return
+
+    memory_limit+=address_space_size()
+
+    _, hard_limit=resource.getrlimit(resource.RLIMIT_AS)
+
+    if hard_limit != resource.RLIM_INFINITY:
+        memory_limit=min(memory_limit, hard_limit)
+
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard_limit))
+
+
+def address_space_size() -> int:
+    '''Returns the calling process's address space size in bytes, zero where
+    there is no /proc to read it from.'''
+
+    try:
+        with open('/proc/self/statm', encoding='utf-8') as statm:
+            return int(statm.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+
+    except (OSError, ValueError):
+        return 0
+
+
+def raise_timeout(signum, frame):
+    '''SIGALRM handler.'''
+
+    raise PageTimeout
+
+
+@contextlib.contextmanager
+def time_limit(seconds: float = None):
+    '''Raises PageTimeout in the block if it runs for longer than seconds. Signals
+    only reach the main thread, so elsewhere, or if seconds is None, there is no limit.'''
+
+    if seconds is None or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    previous_handler=signal.signal(signal.SIGALRM, raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+
+    try:
+        yield
+
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def new_report() -> dict:
+    '''Returns an empty watchdog report.'''
+
+    return {'articles': 0, 'quarantined': [], 'slowest': []}
+
+
+def record_time(report: dict, seconds: float, page_id: int, title: str) -> None:
+    '''Adds an article's timing to the report, keeping only the slowest ones.'''
+
+    heapq.heappush(report['slowest'], (seconds, int(page_id), title))
+
+    if len(report['slowest']) > config.WATCHDOG_SLOWEST_PAGES:
+        heapq.heappop(report['slowest'])
+
+
+def run_guarded(function, cheap_function, text: str, page_id: int, title: str, report: dict):
+    '''Runs function on an article's text within the time and memory budgets, adding
+    its timing to the report. Returns function's result, or if the article went over
+    budget, quarantines it and returns cheap_function's result if retries are on,
+    otherwise None, meaning the article should be dropped.'''
+
+    start_time=time.time()
+    reason=None
+    report['articles']+=1
+
+    # Articles this long are not worth trying the expensive way
+    if len(text) > config.WATCHDOG_MAX_CHARACTERS:
+        reason='size'
+
+    else:
+        try:
+            with time_limit(config.WATCHDOG_TIME_LIMIT):
+                result=function(text)
+
+        except PageTimeout:
+            reason='time'
+
+        except MemoryError:
+            reason='memory'
+
+    seconds=time.time() - start_time
+    record_time(report, seconds, page_id, title)
+
+    if reason is None:
+        return result
+
+    # Retry the cheap way, with the same budgets
+    result=None
+    retry_seconds=None
+
+    if config.WATCHDOG_RETRY is True:
+
+        retry_start_time=time.time()
+
+        try:
+            with time_limit(config.WATCHDOG_TIME_LIMIT):
+                result=cheap_function(text)
+
+        except (PageTimeout, MemoryError):
+            result=None
+
+        retry_seconds=time.time() - retry_start_time
+
+    report['quarantined'].append({
+        'page_id': int(page_id),
+        'title': title,
+        'reason': reason,
+        'characters': len(text),
+        'seconds': seconds,
+        'retry_seconds': retry_seconds,
+        'recovered': result is not None
+    })
+
+    return result
+
+
+def merge_reports(report: dict, worker_report: dict) -> None:
+    '''Adds a worker result's report to the run's report.'''
+
+    report['articles']+=worker_report['articles']
+    report['quarantined'].extend(worker_report['quarantined'])
+
+    for seconds, page_id, title in worker_report['slowest']:
+        record_time(report, seconds, page_id, title)
+
+
+def summarize(report: dict, quarantine_file: str) -> dict:
+    '''Writes the quarantined articles to a JSON lines file, returns dictionary
+    of watchdog results for the stage's summary, slowest articles first. Raises
+    if the fraction of articles dropped is over WATCHDOG_MAX_DROPPED_FRACTION,
+    so that the stage fails rather than succeeding with pages missing.'''
+
+    with open(quarantine_file, 'w', encoding='utf-8') as output:
+        for entry in report['quarantined']:
+            output.write(json.dumps(entry) + '\n')
+
+    slowest=sorted(report['slowest'], reverse=True)
+
+    dropped_pages=sum(1 for entry in report['quarantined'] if entry['recovered'] is False)
+    dropped_fraction=dropped_pages / max(report['articles'], 1)
+
+    if dropped_fraction > config.WATCHDOG_MAX_DROPPED_FRACTION:
+        raise RuntimeError(
+            f"Watchdog dropped {dropped_pages} of {report['articles']} articles, more than "
+            f'WATCHDOG_MAX_DROPPED_FRACTION={config.WATCHDOG_MAX_DROPPED_FRACTION}, see {quarantine_file}'
+        )
+
+    return {
+        'watchdog_time_limit_seconds': config.WATCHDOG_TIME_LIMIT,
+        'watchdog_articles': report['articles'],
+        'quarantined_pages': len(report['quarantined']),
+        'recovered_pages': len(report['quarantined']) - dropped_pages,
+        'dropped_pages': dropped_pages,
+        'dropped_fraction': dropped_fraction,
+        'quarantine_file': quarantine_file,
+        'slowest_pages': [
+            {'page_id': page_id, 'title': title, 'seconds': seconds}
+            for seconds, page_id, title in slowest
+        ]
+    }
@@ -4,218 +4,297 @@
 import time
 import json
 import pathlib
+import functools
 import multiprocessing as mp
 from gzip import GzipFile
 
 # PyPI imports
 import h5py
-import mwparserfromhell
 
 # Internal imports
 import semantic_search.configuration as config
+import semantic_search.functions.watchdog as watchdog
+import semantic_search.functions.dispatch as dispatch
+import semantic_search.functions.intermediate as intermediate
+import semantic_search.functions.shared_batches as shared_batches
+from semantic_search.classes.hdf5_writer import HDF5Writer
+from semantic_search.functions.selective_json import decode_article
+from semantic_search.functions.wikitext import strip_wikicode, fast_strip
 
 
 def wikipedia_extractor(source_config: dict) -> dict:
-    '''Runs text extraction and batching on CirrusSearch Wikipedia dump.'''
+    '''Runs text extraction and batching on CirrusSearch Wikipedia dump. Batches are
+    dispatched to the worker pool as a dynamic work queue and saved in dump order.'''
 
     # Start the extraction summary with the data from the source configuration
     extraction_summary=source_config
 
-    # Prepare the hdf5 output
-    output_file=f"{config.DATA_PATH}/{source_config['target_index_name']}/{config.EXTRACTED_TEXT}"
+    # Prepare the hdf5 or arrow output, written from its own thread
+    output_file=intermediate.text_file(source_config['target_index_name'], 'extracted')
     pathlib.Path(output_file).unlink(missing_ok=True)
-    output=h5py.File(output_file, 'w')
-    batch_group=output.require_group('batches')
+    writer=HDF5Writer(output_file, output=intermediate.open_output(output_file, 'extracted'))
 
-    # Open the input file stream
-    gzip_data_file_path=f"{config.RAW_DATA_PATH}/{source_config['raw_data_file']}"
-    file=GzipFile(gzip_data_file_path)
+    # Pick the record field to take the article text from
+    text_source=source_config.get('text_source', config.DEFAULT_TEXT_SOURCE)
 
     # Set number of workers to one less than the CPU count
     n_workers=mp.cpu_count() - 1
 
-    # Counters and accumulators for batching loop
+    # Slowest and quarantined articles from every batch, and time spent on each batch
+    report=watchdog.new_report()
+    tracker=dispatch.new_tracker()
+
+    # Counters for the result loop
     batch_count=0
     record_count=0
-    batch=[]
-    batches=[]
-
-    # Start the timer
-    start_time = time.time()
-
-    # Loop on the lines from the input file stream and accumulate batches
-    for line_count, line in enumerate(file):
 
-        # Add article records (every other line is a metadata header) to the batch
-        if line_count % 2 != 0:
-            batch.append(line)
-            record_count+=1
+    # Window limits the number of batches read ahead of the one being saved
+    window=config.DISPATCH_BATCHES_IN_FLIGHT * n_workers
 
-        # Once the batch is full, add it to this round's batches and clear it
-        # to accumulate another batch
-        if len(batch) == source_config['batch_size']:
-            batches.append(batch)
-            batch=[]
+    # Worker function and batches to send it, the batches and results go through
+    # shared memory if configured, so only the names of their segments are pickled
+    worker_function=functools.partial(extract_wikipedia_text, text_source=text_source)
+    batches=yield_line_batches(source_config)
+    prefix=None
 
-        # There are three ways we to enter job submission:
-        #
-        # 1. We have a batch for every worker.
-        # 2. The number of batches left to submit in order to complete the number of
-        #    batches requested by the user is less than the number of workers.
-        # 3. We have reached the end of the input.
-        #
-        # Each of these three cases also has a different thing to do after. For number
-        # we submit the jobs and keep going. For number two, we break the line loop and stop.
-        # for number three, we have already left the line loop and can just end after
-        # the last batches.
+    if config.SHARED_MEMORY_HANDOFF is True:
+        prefix=shared_batches.new_prefix()
+        worker_function=functools.partial(
+            shared_batches.handoff,
+            functools.partial(extract_line_columns, text_source=text_source),
+            prefix
+        )
+        batches=(shared_batches.pack(line_columns(batch), prefix) for batch in batches)
 
-        # 1. If we have a batch for each worker, submit
-        if len(batches) == n_workers:
+    # Start the timer
+    start_time = time.time()
 
-            batch_count=submit_batches(n_workers, batches, batch_group, batch_count)
+    try:
 
-            # Empty the batches for the next round
-            batches=[]
+        # Start the pool, with each worker's memory limited
+        with mp.Pool(
+            processes=n_workers,
+            initializer=watchdog.limit_memory,
+            initargs=(config.WATCHDOG_EXTRACT_MEMORY_LIMIT,)
+        ) as pool:
 
-        # 2. If the number of batches left to fulfill a user request for a specific number of
-        # batches is less than the number of workers, submit that number of batches
-        # once we have them
-        if source_config['num_batches'] != 'all':
+            # Workers take the next batch as soon as they finish one, the
+            # results come back in dump order. The batch generator stops
+            # at the number of batches requested by the user
+            results=dispatch.windowed_imap(
+                pool,
+                functools.partial(dispatch.timed_call, worker_function),
+                batches,
+                window
+            )
 
-            batches_remaining=source_config['num_batches'] - batch_count
+            # Save each result as a batch in the hdf5 file
+            for result, seconds in results:
 
-            if batches_remaining < n_workers and len(batches) == batches_remaining:
+                if prefix is not None:
+                    result=shared_batches.unpack(result)
 
-                n_workers=batches_remaining
-                batch_count=submit_batches(n_workers, batches, batch_group, batch_count)
+                writer.submit(save_batch, batch_count, result)
+                batch_count+=1
+                record_count+=result['records']
 
-                # Break the line loop to end the run
-                break
-            
-            # Also break the line loop if we have completed the exact number of batches
-            # requested by the user
-            if batch_count == source_config['num_batches']:
-                break
+                dispatch.record_task(tracker, seconds)
+                watchdog.merge_reports(report, result['watchdog'])
 
-    # 3. If we are extracting all of the data, i.e. the user has not requested a specific
-    # number of batches to run, submit whatever is left over after the last extraction
-    # round after we have finished reading the input file
-    if source_config['num_batches'] == 'all':
+    finally:
 
-        # If there are records in the last batch, add it to the batch list for the last
-        # extraction round
-        if len(batch) != 0:
-            batches.append(batch)
+        # Remove any segments left behind if the stage failed
+        if prefix is not None:
+            shared_batches.remove_segments(prefix)
 
-        # If we have batches that did not get processed because we ran out of input
-        # before collecting enough batches for a full extraction round, start a
-        # round with what we have
-        if len(batches) != 0:
+    # Add some metadata to the hdf5 file and wait for the writes to finish. Arrow
+    # files have no attributes, their batches are counted by the file footer
+    if intermediate.use_arrow() is False:
+        metadata={'data_source': 'wikipedia','num_batches': batch_count}
+        writer.submit(lambda output: output.attrs.update(metadata))
 
-            n_workers=len(batches)
-            batch_count=submit_batches(n_workers, batches, batch_group, batch_count)
+    write_timings=writer.close()
 
-    # Stop the timer after the last round finishes
+    # Stop the timer after the last batch is saved
     dT=time.time() - start_time # pylint: disable = invalid-name
 
     # Add some stuff the the summary
     extraction_summary['num_batches']=batch_count
     extraction_summary['run_time_seconds']=dT
-    extraction_summary['run_time_seconds']=dT
     extraction_summary['worker_processes']=n_workers
     extraction_summary['extracted_batches']=batch_count
     extraction_summary['extraction_batch_size']=source_config['batch_size']
+    extraction_summary['extraction_batch_bytes']=source_config.get('batch_bytes', config.EXTRACTION_BATCH_BYTES)
     extraction_summary['extracted_records']=record_count
+    extraction_summary['text_source']=text_source
+    extraction_summary['intermediate_format']=config.INTERMEDIATE_FORMAT
+    extraction_summary['shared_memory_handoff']=config.SHARED_MEMORY_HANDOFF
     extraction_summary['observed_extraction_rate']=record_count/dT
 
     extraction_time=config.WIKIPEDIA_RECORD_COUNT / extraction_summary['observed_extraction_rate']
     extraction_summary['estimated_total_extraction_time']=extraction_time
+    extraction_summary.update(dispatch.summarize(tracker, n_workers, dT))
+    extraction_summary.update(watchdog.summarize(
+        report,
+        f"{config.DATA_PATH}/{source_config['target_index_name']}/{config.EXTRACTION_QUARANTINE}"
+    ))
+    extraction_summary.update(write_timings)
 
-    # Add some metadata to the hdf5 file
-    metadata={'data_source': 'wikipedia','num_batches': batch_count}
-    output.attrs.update(metadata)
+    return extraction_summary
 
-    # Close the hdf5 file
-    output.close()
 
-    return extraction_summary
+def yield_line_batches(source_config: dict):
+    '''Yields batches of (header, article record) line pairs from the CirrusSearch dump,
+    stopping after num_batches if the configuration asks for it. Batches are closed at
+    batch_size records or once their records add up to batch_bytes, whichever comes
+    first, so that batches of long articles don't take much longer than the rest.'''
 
+    # Open the input file stream
+    gzip_data_file_path=f"{config.RAW_DATA_PATH}/{source_config['raw_data_file']}"
+    file=GzipFile(gzip_data_file_path)
 
-def submit_batches(
-    n_workers: int,
-    batches: list,
-    batch_group: h5py._hl.group.Group,
-    batch_count: int
-) -> int:
+    # Record size budget for each batch
+    max_batch_bytes=source_config.get('batch_bytes', config.EXTRACTION_BATCH_BYTES)
 
-    '''Takes batches list and current batch count, submits batches to worker pool for text
-    extraction. Returns updated batch count after receiving and saving worker results.'''
+    # Counters and accumulator for the batching loop
+    batch_count=0
+    batch_bytes=0
+    batch=[]
 
-    # Holder for results from workers
-    worker_results=[]
+    # Loop on the lines from the input file stream and accumulate batches
+    for line_count, line in enumerate(file):
 
-    # Start the pool
-    pool=mp.Pool(processes=n_workers)
+        # Every other line is a metadata header, hold on to it for the page id
+        if line_count % 2 == 0:
+            header=line
+            continue
 
-    # Submit each batch to a worker
-    for batch in batches:
-        worker_result=pool.apply_async(extract_wikipedia_text, (batch,))
-        worker_results.append(worker_result)
+        # Add article records to the batch along with their headers
+        batch.append((header, line))
+        batch_bytes+=len(line)
 
-    # Collect the results from the workers
-    results=[worker_result.get() for worker_result in worker_results]
+        # Once the batch is full, yield it and start accumulating another one
+        if len(batch) == source_config['batch_size'] or batch_bytes >= max_batch_bytes:
+            yield batch
+            batch=[]
+            batch_bytes=0
+            batch_count+=1
 
-    # Save each result as a batch in the hdf5 file
-    for result in results:
-        batch_group.create_dataset(str(batch_count), data=result)
-        batch_count+=1
+            # Stop if we have produced the number of batches requested by the user
+            if source_config['num_batches'] != 'all' and batch_count == source_config['num_batches']:
+                break
 
-    return batch_count
+    # Send whatever is left over after we run out of input
+    if source_config['num_batches'] == 'all' and len(batch) != 0:
+        yield batch
 
+    file.close()
 
-def extract_wikipedia_text(lines: list) -> list:
-    '''Worker function to do text extraction and source specific cleaning on Wikipedia CirrusSearch
-    dump source. Takes a batch of lines from file stream, returns list of text chunks.'''
 
-    # Holder for result
-    cleaned_texts=[]
+def line_columns(lines: list) -> dict:
+    '''Takes a batch of (header, record) line pairs, returns dictionary of
+    the header lines and the record lines, for the shared memory handoff.'''
 
-    # Loop on input lines
-    for line in lines:
+    return {
+        'headers': [header for header, _ in lines],
+        'lines': [line for _, line in lines]
+    }
 
-        # Load record dictionary from JSON line
-        record=json.loads(line)
 
-        # Get the text from the record, catching key error
-        # in case this record doesn't have text for some reason
-        try:
+def extract_line_columns(batch: dict, text_source: str = config.DEFAULT_TEXT_SOURCE) -> dict:
+    '''Runs extract_wikipedia_text on a batch from line_columns.'''
 
-            # Only parse namespace 0 articles which are not disambiguation
-            if record['namespace'] == 0 and 'Disambiguation pages' not in record['category']:
+    return extract_wikipedia_text(list(zip(batch['headers'], batch['lines'])), text_source)
 
-                # Convert source string to wikicode
-                wikicode=mwparserfromhell.parse(record['source_text'])
 
-                # Strip garbage out of wikicode source
-                source_string=wikicode.strip_code(
-                    normalize=True,
-                    collapse=True,
-                    keep_template_params=False
-                )
+def save_batch(output: h5py.File, batch_num: int, result: dict) -> None:
+    '''Saves an extraction worker result to hdf5. Text goes in the batches
+    group, with the article titles and page ids in parallel datasets. Arrow
+    outputs get the result as one record batch, with the same three columns.'''
 
-                # Remove extra sections from the end of the document
-                source_string=remove_extra_sections(source_string)
+    if intermediate.use_arrow() is True:
+        intermediate.write_record_batch(output, 'extracted', {
+            'page_id': result['page_ids'],
+            'title': result['titles'],
+            'text': result['texts']
+        })
 
-                # Get rid of image thumbnail lines and leading spaces
-                source_string=remove_thumbnails(source_string)
+        return
 
-                # Add to results
-                cleaned_texts.append(source_string)
+    output.create_dataset(f'batches/{batch_num}', data=result['texts'])
+    output.create_dataset(f'titles/{batch_num}', data=result['titles'])
+    output.create_dataset(f'page_ids/{batch_num}', data=result['page_ids'], dtype='int64')
 
-        except KeyError:
-            pass
 
-    return cleaned_texts
+def extract_wikipedia_text(lines: list, text_source: str = config.DEFAULT_TEXT_SOURCE) -> dict:
+    '''Worker function to do text extraction and source specific cleaning on Wikipedia CirrusSearch
+    dump source. Takes a batch of (header, record) line pairs from file stream and the record field
+    to take the text from, returns dictionary of article texts along with their titles and page ids,
+    the number of records read and the batch's watchdog report.
+    The source_text field is wikicode, which is stripped to plain text. The text field is
+    plain text already rendered by CirrusSearch, which is used as is.'''
+
+    # Holders for result
+    cleaned_texts=[]
+    titles=[]
+    page_ids=[]
+
+    # Slowest and quarantined articles in this batch
+    report=watchdog.new_report()
+
+    # Loop on input lines
+    for header, line in lines:
+
+        # Decode only the fields we need, records which are not namespace 0
+        # articles or are disambiguation pages come back as None
+        article=decode_article(line, text_source)
+
+        if article is None:
+            continue
+
+        # The page id comes from the metadata header
+        page_id=int(json.loads(header)['index']['_id'])
+
+        # The pre-rendered text has no markup and no section
+        # headings to split on, so there is nothing to clean
+        if text_source == 'text':
+            source_string=article.text
+
+        else:
+
+            # Strip garbage out of wikicode source, with the fast path where we can
+            # and mwparserfromhell where we can't. Articles over the time or memory
+            # budget get the fast path whatever markup they have, or are dropped
+            source_string=watchdog.run_guarded(
+                strip_wikicode,
+                lambda source: fast_strip(source, strict=False),
+                article.text,
+                page_id,
+                article.title,
+                report
+            )
+
+            if source_string is None:
+                continue
+
+            # Remove extra sections from the end of the document
+            source_string=remove_extra_sections(source_string)
+
+            # Get rid of image thumbnail lines and leading spaces
+            source_string=remove_thumbnails(source_string)
+
+        # Add to results
+        cleaned_texts.append(source_string)
+        titles.append(article.title)
+        page_ids.append(page_id)
+
+    return {
+        'texts': cleaned_texts,
+        'titles': titles,
+        'page_ids': page_ids,
+        'records': len(lines),
+        'watchdog': report
+    }
 
 
 def remove_thumbnails(source_string: str) -> str:
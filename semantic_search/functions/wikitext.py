@@ -0,0 +1,256 @@
+'''Fast wikicode stripper. Handles the common constructs, i.e. comments, refs, templates,
+tables, links, files, categories, external links, bold, italics, headings, lists and
+HTML tags, with regexes and a few small scanners instead of building the full node tree
+mwparserfromhell makes. Pages it can't handle safely are detected and stripped with
+mwparserfromhell instead. The keyword search pipeline strips XML dump pages with
+this module too.'''
+
+# Standard imports
+import re
+import html
+
+# PyPI imports
+import mwparserfromhell
+
+# Internal imports
+import semantic_search.configuration as config
+
+# Markup which changes how everything inside it is parsed, pages
+# containing any of it go straight to mwparserfromhell
+UNSAFE_MARKUP=(
+    '{{{', '<nowiki', '<pre', '<math', '<syntaxhighlight', '<source',
+    '<gallery', '<timeline', '<score', '<poem', '<chem', '<ce>', '<hiero'
+)
+
+# Markup which should be gone after stripping, if any is left the page
+# had something the fast path got wrong, e.g. unbalanced brackets
+LEFTOVER_MARKUP=('{{', '}}', '[[', ']]', '{|', '<ref', '<!--')
+
+COMMENT=re.compile(r'<!--.*?-->', re.DOTALL)
+SELF_CLOSING_REF=re.compile(r'<ref[^>]*/>', re.IGNORECASE)
+REF=re.compile(r'<ref[^>/]*>.*?</ref\s*>', re.IGNORECASE | re.DOTALL)
+TEMPLATE_BRACES=re.compile(r'\{\{|\}\}')
+LINK_BRACKETS=re.compile(r'\[\[|\]\]')
+HIDDEN_LINK=re.compile(r'\[\[\s*(?:file|image|category)\s*:', re.IGNORECASE)
+LINK=re.compile(r'\[\[([^\[\]|]*)(?:\|([^\[\]]*))?\]\]')
+EXTERNAL_LINK=re.compile(r'\[(?:https?:|ftp:|//)[^\s\]]*(?:\s+([^\]]*))?\]')
+BOLD_ITALIC=re.compile(r"'{2,5}")
+HEADING=re.compile(r'^=+(.*?)=+[ \t]*$', re.MULTILINE)
+LIST_MARKER=re.compile(r'^[*#:;]+', re.MULTILINE)
+HORIZONTAL_RULE=re.compile(r'^-{4,}[ \t]*$', re.MULTILINE)
+MAGIC_WORD=re.compile(r'__[A-Z]+__')
+HTML_TAG=re.compile(r'</?[a-zA-Z][^<>]*>')
+
+
+def strip_wikicode(source: str) -> str:
+    '''Takes wikicode source string, returns it stripped to plain text. Uses the fast
+    path if it's enabled and the page is safe for it, otherwise mwparserfromhell.'''
+
+    if config.FAST_WIKITEXT_STRIP is True:
+
+        stripped=fast_strip(source)
+
+        if stripped is not None:
+            return stripped
+
+    return mwparserfromhell_strip(source)
+
+
+def mwparserfromhell_strip(source: str) -> str:
+    '''Strips wikicode source string with mwparserfromhell.'''
+
+    # Convert source string to wikicode
+    wikicode=mwparserfromhell.parse(source)
+
+    # Strip garbage out of wikicode source
+    return wikicode.strip_code(
+        normalize=True,
+        collapse=True,
+        keep_template_params=False
+    )
+
+
+def fast_strip(source: str, strict: bool = True) -> str:
+    '''Takes wikicode source string, returns plain text, or None if the page
+    has markup the fast path can't handle safely. If not strict, always returns
+    the best we can do, leaving in any nested markup with unbalanced brackets.'''
+
+    if strict is True and any(markup in source for markup in UNSAFE_MARKUP):
+        return None
+
+    # Comments and refs can contain anything, so they go first
+    text=COMMENT.sub('', source)
+    text=SELF_CLOSING_REF.sub('', text)
+    text=REF.sub('', text)
+
+    # Templates and files or categories, which can both nest
+    removed=remove_nested(text, TEMPLATE_BRACES, '{{')
+
+    if removed is None and strict is True:
+        return None
+
+    text=removed if removed is not None else text
+    removed=remove_hidden_links(text)
+
+    if removed is None and strict is True:
+        return None
+
+    text=removed if removed is not None else text
+
+    # Links and external links keep their text
+    text=LINK.sub(link_text, text)
+    text=EXTERNAL_LINK.sub(lambda match: match.group(1) or '', text)
+
+    # Tables, once links are gone the only pipes left are table markup
+    text=strip_tables(text)
+
+    # Formatting
+    text=BOLD_ITALIC.sub('', text)
+    text=HEADING.sub(r'\1', text)
+    text=LIST_MARKER.sub('', text)
+    text=HORIZONTAL_RULE.sub('', text)
+    text=MAGIC_WORD.sub('', text)
+    text=HTML_TAG.sub('', text)
+
+    if strict is True and any(markup in text for markup in LEFTOVER_MARKUP):
+        return None
+
+    text=html.unescape(text)
+
+    # Collapse runs of blank lines like mwparserfromhell does
+    while '\n\n\n' in text:
+        text=text.replace('\n\n\n', '\n\n')
+
+    return text
+
+
+def remove_nested(text: str, delimiters: re.Pattern, opener: str) -> str:
+    '''Removes everything between matched, possibly nested, delimiters. Returns
+    None if they are unbalanced.'''
+
+    pieces=[]
+    depth=0
+    position=0
+
+    for match in delimiters.finditer(text):
+
+        if match.group(0) == opener:
+
+            if depth == 0:
+                pieces.append(text[position:match.start()])
+
+            depth+=1
+
+        else:
+            depth-=1
+
+            if depth < 0:
+                return None
+
+            if depth == 0:
+                position=match.end()
+
+    if depth != 0:
+        return None
+
+    pieces.append(text[position:])
+
+    return ''.join(pieces)
+
+
+def remove_hidden_links(text: str) -> str:
+    '''Removes file, image and category links, along with any links nested in
+    their captions. Returns None if their brackets are unbalanced.'''
+
+    pieces=[]
+    position=0
+
+    for match in HIDDEN_LINK.finditer(text):
+
+        # Skip links nested in a caption we have already removed
+        if match.start() < position:
+            continue
+
+        pieces.append(text[position:match.start()])
+
+        # Find the matching closing brackets
+        depth=0
+
+        for bracket in LINK_BRACKETS.finditer(text, match.start()):
+
+            depth+=1 if bracket.group(0) == '[[' else -1
+
+            if depth == 0:
+                position=bracket.end()
+                break
+
+        else:
+            return None
+
+    pieces.append(text[position:])
+
+    return ''.join(pieces)
+
+
+def link_text(match: re.Match) -> str:
+    '''Returns the text shown for a wikilink, i.e. the text after
+    the pipe if there is one, otherwise the link target.'''
+
+    if match.group(2) is not None:
+        return match.group(2)
+
+    return match.group(1)
+
+
+def strip_tables(text: str) -> str:
+    '''Replaces table markup with the contents of the table's caption and
+    cells, one per line, dropping the table, row and cell attributes.'''
+
+    if '{|' not in text:
+        return text
+
+    lines=[]
+    depth=0
+
+    for line in text.split('\n'):
+
+        stripped=line.lstrip()
+
+        if stripped.startswith('{|'):
+            depth+=1
+            continue
+
+        if depth == 0:
+            lines.append(line)
+
+        elif stripped.startswith('|}'):
+            depth-=1
+
+        elif stripped.startswith('|-'):
+            continue
+
+        elif stripped.startswith('|+'):
+            lines.append(cell_text(stripped[2:]))
+
+        elif stripped.startswith('!'):
+            lines.extend(cell_text(cell) for cell in re.split(r'!!|\|\|', stripped[1:]))
+
+        elif stripped.startswith('|'):
+            lines.extend(cell_text(cell) for cell in stripped[1:].split('||'))
+
+        # Cell contents carried on from the line before
+        else:
+            lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def cell_text(cell: str) -> str:
+    '''Returns table cell contents without the cell attributes, if any.'''
+
+    _, pipe, contents=cell.partition('|')
+
+    if pipe == '':
+        return cell.strip()
+
+    return contents.strip()